@@ -0,0 +1,190 @@
+# Copyright (C) 2026  agent <agent@local>
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation;
+# version 2.1 of the License.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""
+Deduplicating store for disk images
+"""
+
+import os
+import hashlib
+import json
+import zlib
+import logging
+
+import oz.ozutil
+import oz.OzException
+
+class ChunkStore(object):
+    """
+    Class for a store that keeps disk images as a list of chunks.  Each image
+    is split into chunks of chunk_size bytes at aligned offsets; the chunks
+    are compressed and stored under the SHA256 of their contents, so chunks
+    that are the same in several images (or several times in one image) are
+    only stored once.  Chunks that are all zeros are not stored at all, and
+    are left as holes when the image is materialized again.  Since all of the
+    chunks live in their own files, the store can be copied to another host
+    with tools like rsync, which then only transfer the chunks that the other
+    host does not have yet.
+    """
+    def __init__(self, directory, chunk_size=256*1024):
+        self.directory = directory
+        self.chunk_size = chunk_size
+        self.chunk_dir = os.path.join(self.directory, "chunks")
+        self.index_dir = os.path.join(self.directory, "indexes")
+        self.log = logging.getLogger('%s.%s' % (__name__,
+                                                self.__class__.__name__))
+
+    def _chunk_path(self, digest):
+        """
+        Internal method to get the path of the file that holds a chunk.
+        """
+        return os.path.join(self.chunk_dir, digest[:2], digest)
+
+    def _index_path(self, name):
+        """
+        Internal method to get the path of the index file of an image.
+        """
+        if os.path.isabs(name) or '..' in name.split('/'):
+            raise oz.OzException.OzException("Invalid image name %s" % (name))
+        return os.path.join(self.index_dir, name + ".json")
+
+    def _write_atomic(self, path, data):
+        """
+        Internal method to write data to a file such that concurrent readers
+        either see the complete file or no file at all.
+        """
+        oz.ozutil.mkdir_p(os.path.dirname(path))
+        tmpfile = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmpfile, 'wb') as f:
+            f.write(data)
+        os.rename(tmpfile, path)
+
+    def contains(self, name):
+        """
+        Method to check whether an image is in the store.
+        """
+        return os.access(self._index_path(name), os.F_OK)
+
+    def list_images(self):
+        """
+        Method to get the names of all of the images in the store.
+        """
+        names = []
+        for root, dirs, files in os.walk(self.index_dir):
+            for f in files:
+                if f.endswith(".json"):
+                    path = os.path.join(root, f)[:-len(".json")]
+                    names.append(os.path.relpath(path, self.index_dir))
+
+        return sorted(names)
+
+    def _read_index(self, name):
+        """
+        Internal method to read the index of an image.
+        """
+        if not self.contains(name):
+            raise oz.OzException.OzException("Image %s is not in the chunk store" % (name))
+        with open(self._index_path(name), 'r') as f:
+            return json.load(f)
+
+    def check_in(self, filename, name):
+        """
+        Method to store the image in filename under name, replacing any image
+        of the same name.  Returns a tuple of the number of chunks that were
+        new to the store and the number of non-zero chunks in the image.
+        """
+        self.log.info("Checking %s into the chunk store as %s", filename, name)
+
+        chunks = []
+        new = 0
+        fd = os.open(filename, os.O_RDONLY)
+        try:
+            size = os.fstat(fd).st_size
+            offset = 0
+            while offset < size:
+                buf = oz.ozutil.read_bytes_from_fd(fd, min(self.chunk_size,
+                                                           size - offset))
+                if len(buf) == 0:
+                    break
+
+                if buf != '\0'*len(buf):
+                    digest = hashlib.sha256(buf).hexdigest()
+                    path = self._chunk_path(digest)
+                    if not os.access(path, os.F_OK):
+                        self._write_atomic(path, zlib.compress(buf, 1))
+                        new += 1
+                    chunks.append([offset, digest])
+
+                offset += len(buf)
+        finally:
+            os.close(fd)
+
+        index = {'size':size, 'chunk_size':self.chunk_size, 'chunks':chunks}
+        self._write_atomic(self._index_path(name), json.dumps(index))
+
+        self.log.debug("Stored %d new chunks out of %d", new, len(chunks))
+        return (new, len(chunks))
+
+    def materialize(self, name, filename):
+        """
+        Method to write the image stored under name to filename.  Chunks of
+        zeros are left as holes, so the resulting file is sparse.
+        """
+        self.log.info("Materializing %s from the chunk store to %s", name,
+                      filename)
+        index = self._read_index(name)
+
+        oz.ozutil.mkdir_p(os.path.dirname(filename))
+        fd = os.open(filename, os.O_WRONLY|os.O_CREAT|os.O_TRUNC)
+        try:
+            for offset, digest in index['chunks']:
+                with open(self._chunk_path(digest), 'rb') as f:
+                    buf = zlib.decompress(f.read())
+                if hashlib.sha256(buf).hexdigest() != digest:
+                    raise oz.OzException.OzException("Chunk %s of image %s is corrupt" % (digest, name))
+                os.lseek(fd, offset, os.SEEK_SET)
+                oz.ozutil.write_bytes_to_fd(fd, buf)
+
+            os.ftruncate(fd, index['size'])
+        finally:
+            os.close(fd)
+
+    def remove(self, name):
+        """
+        Method to remove an image from the store.  The chunks of the image are
+        left behind until garbage_collect() is called.
+        """
+        os.unlink(self._index_path(name))
+
+    def garbage_collect(self):
+        """
+        Method to remove all of the chunks that are not used by any image in
+        the store.  Returns the number of chunks that were removed.  This must
+        not be run while images are being checked in.
+        """
+        used = set()
+        for name in self.list_images():
+            for offset, digest in self._read_index(name)['chunks']:
+                used.add(digest)
+
+        removed = 0
+        for root, dirs, files in os.walk(self.chunk_dir):
+            for f in files:
+                if f not in used:
+                    os.unlink(os.path.join(root, f))
+                    removed += 1
+
+        return removed
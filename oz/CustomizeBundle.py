@@ -0,0 +1,182 @@
+# Copyright (C) 2026  agent <agent@local>
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation;
+# version 2.1 of the License.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""
+Bundling of customization steps into a single archive
+"""
+
+import os
+import re
+import uuid
+import pipes
+import tarfile
+from io import BytesIO
+
+import oz.ozutil
+
+class CustomizeBundle(object):
+    """
+    Class to collect all of the files and commands of a customization into
+    one tar archive, so that they can be sent to the guest and run there in
+    a single invocation.  The archive contains the files, one script per
+    step, and a driver script, run.sh, that runs the steps in order and
+    stops at the first one that fails.  For each step the driver prints the
+    output, the exit code, and the start and end time of the step between
+    marker lines, which parse_report() turns back into StepResults.
+    """
+    def __init__(self):
+        self.steps = []
+        self.files = []
+        # the markers must not show up in the output of the steps, so make
+        # them unique to this bundle
+        self.marker = "oz-step-%s" % (uuid.uuid4().hex)
+
+    def add_step(self, command):
+        """
+        Method to add a shell command to run in the guest.  The command is
+        run by the login shell of root, as it would be over ssh.
+        """
+        self.steps.append(command)
+
+    def _add_copy_step(self, destination):
+        """
+        Internal method to add a step that copies the last file added to the
+        bundle to destination in the guest.
+        """
+        self.add_step("mkdir -p %s && cp files/%d %s" % (pipes.quote(os.path.dirname(destination)),
+                                                         len(self.files),
+                                                         pipes.quote(destination)))
+
+    def add_file(self, filename, destination):
+        """
+        Method to add a step that copies the local file filename to
+        destination in the guest.
+        """
+        self.files.append((filename, None))
+        self._add_copy_step(destination)
+
+    def add_data(self, data, destination):
+        """
+        Method to add a step that writes the string data to destination in
+        the guest.
+        """
+        self.files.append((None, data))
+        self._add_copy_step(destination)
+
+    def _driver(self):
+        """
+        Internal method to generate the driver script.
+        """
+        driver = """#!/bin/sh
+cd "$(dirname "$0")" || exit 1
+mkdir -p out
+run_step() {
+    start=$(date +%%s.%%N)
+    "${SHELL:-/bin/sh}" "steps/$1" < /dev/null > "out/$1.out" 2> "out/$1.err"
+    rc=$?
+    end=$(date +%%s.%%N)
+    echo "%(marker)s begin $1"
+    cat "out/$1.out"
+    echo
+    echo "%(marker)s stderr $1"
+    cat "out/$1.err"
+    echo
+    echo "%(marker)s end $1 $rc $start $end"
+    return $rc
+}
+""" % {'marker':self.marker}
+
+        # a failed step still shows up in the report, so the driver itself
+        # only fails if it could not run at all
+        for index in range(len(self.steps)):
+            driver += "run_step %d || exit 0\n" % (index + 1)
+        driver += "sync\n"
+
+        return driver
+
+    def write(self, fileobj):
+        """
+        Method to write the bundle as a tar archive to fileobj.
+        """
+        def _add_string(tar, name, data, mode):
+            """Add the string data to tar as a file called name."""
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mode = mode
+            tar.addfile(info, BytesIO(data))
+
+        tar = tarfile.open(fileobj=fileobj, mode='w')
+        try:
+            _add_string(tar, "run.sh", self._driver(), 0o755)
+            for index, command in enumerate(self.steps):
+                _add_string(tar, "steps/%d" % (index + 1), command + "\n",
+                            0o644)
+            for index, (filename, data) in enumerate(self.files):
+                name = "files/%d" % (index + 1)
+                if filename is None:
+                    _add_string(tar, name, data, 0o644)
+                else:
+                    tar.add(filename, arcname=name)
+        finally:
+            tar.close()
+
+    def parse_report(self, output):
+        """
+        Method to parse the output of the driver script.  Returns a list of
+        StepResults, one for each step that was run.
+        """
+        marker = re.escape(self.marker)
+        regex = re.compile(r'^%s begin (\d+)\n(.*?)\n%s stderr \1\n(.*?)\n%s end \1 (-?\d+) (\S+) (\S+)$' % (marker, marker, marker),
+                           re.MULTILINE | re.DOTALL)
+
+        results = []
+        for match in regex.finditer(output):
+            index = int(match.group(1)) - 1
+            results.append(StepResult(self.steps[index], match.group(2),
+                                      match.group(3), int(match.group(4)),
+                                      _parse_time(match.group(6)) - _parse_time(match.group(5))))
+
+        return results
+
+def _parse_time(timestr):
+    """
+    Internal function to parse the output of date +%s.%N.  Some versions of
+    date don't know about %N, so fall back to whole seconds.
+    """
+    try:
+        return float(timestr)
+    except ValueError:
+        return float(timestr.split('.')[0])
+
+class StepResult(object):
+    """
+    Class for the result of one step of a CustomizeBundle.
+    """
+    def __init__(self, command, stdout, stderr, retcode, elapsed):
+        self.command = command
+        self.stdout = stdout
+        self.stderr = stderr
+        self.retcode = retcode
+        self.elapsed = elapsed
+
+    def check(self):
+        """
+        Method to raise the same exception as guest_execute_command() would
+        have if the step failed.
+        """
+        if self.retcode:
+            raise oz.ozutil.SubprocessException("'%s' failed(%d): %s" % (self.command, self.retcode, self.stderr),
+                                                self.retcode)
@@ -27,10 +27,20 @@ import oz.Guest
 import oz.ozutil
 import oz.OzException
 
+# messages that debian-installer (which Ubuntu uses as well) logs when a
+# step of the install failed
+debian_installer_failure_patterns = [r"Installation step failed",
+                                     r"main-menu\[\d+\]: WARNING \*\*: Configuring '.*' failed"]
+
 class DebianGuest(oz.Guest.CDGuest):
     """
     Class for Debian 5, 6, 7 and 8 installation.
     """
+    # debian-installer failures, as seen on the serial console when the
+    # installer runs there (for instance with console=ttyS0 in the kernel
+    # parameters)
+    install_failure_patterns = debian_installer_failure_patterns
+
     def __init__(self, tdl, config, auto, output_disk, netdev, diskbus,
                  macaddress):
         oz.Guest.CDGuest.__init__(self, tdl, config, auto, output_disk,
@@ -93,15 +103,15 @@ label customiso
         Method to create a new ISO based on the modified CD/DVD.
         """
         self.log.info("Generating new ISO")
-        oz.ozutil.subprocess_check_output(["genisoimage", "-r", "-V", "Custom",
-                                           "-J", "-l", "-no-emul-boot",
-                                           "-b", "isolinux/isolinux.bin",
-                                           "-c", "isolinux/boot.cat",
-                                           "-boot-load-size", "4",
-                                           "-cache-inodes", "-boot-info-table",
-                                           "-v", "-o", self.output_iso,
-                                           self.iso_contents],
-                                          printfn=self.log.debug)
+        oz.ozutil.subprocess_run(["genisoimage", "-r", "-V", "Custom",
+                                  "-J", "-l", "-no-emul-boot",
+                                  "-b", "isolinux/isolinux.bin",
+                                  "-c", "isolinux/boot.cat",
+                                  "-boot-load-size", "4",
+                                  "-cache-inodes", "-boot-info-table",
+                                  "-v", "-o", self.output_iso,
+                                  self.iso_contents],
+                                 printfn=self.log.debug)
 
 def get_class(tdl, config, auto, output_disk=None, netdev=None, diskbus=None,
               macaddress=None):
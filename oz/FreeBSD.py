@@ -40,12 +40,12 @@ class FreeBSD(oz.Guest.CDGuest):
         Method to create a new ISO based on the modified CD/DVD.
         """
         self.log.debug("Generating new ISO")
-        oz.ozutil.subprocess_check_output(["genisoimage",
-                                           "-R", "-no-emul-boot",
-                                           "-b", "boot/cdboot", "-v",
-                                           "-o", self.output_iso,
-                                           self.iso_contents],
-                                          printfn=self.log.debug)
+        oz.ozutil.subprocess_run(["genisoimage",
+                                  "-R", "-no-emul-boot",
+                                  "-b", "boot/cdboot", "-v",
+                                  "-o", self.output_iso,
+                                  self.iso_contents],
+                                 printfn=self.log.debug)
 
     def _modify_iso(self):
         """
@@ -34,8 +34,8 @@ import stat
 import lxml.etree
 import logging
 import random
-import guestfs
 import socket
+import select
 import struct
 import tempfile
 import M2Crypto
@@ -43,14 +43,136 @@ import base64
 import hashlib
 import errno
 import re
+import multiprocessing
+import math
+import pycurl
+import json
+import threading
 
 import oz.ozutil
 import oz.OzException
+import oz.ChunkStore
+import oz.Telemetry
+import oz.GuestfsPool
+
+# The libvirt event loop is per-process, so it (and the table of domain stop
+# events that its callbacks fill in) is shared by all of the Guest objects.
+_event_loop_lock = threading.Lock()
+_event_loop_thread = None
+_domain_stop_events = {}
+
+# The paravirtualized devices that the installers of each distribution (by
+# the Oz module that installs it) can use in the fast install profile, each
+# with the updates whose installers cannot.  The installed system also has
+# to boot on the devices of the libvirt XML handed back to the user, so the
+# virtio disk is only listed where the installed system finds its disks
+# whatever controller they are on.
+_install_capabilities = {
+    'Debian': {'virtio-blk':['5'], 'virtio-net':[]},
+    'Fedora': {'virtio-net':['7', '8']},
+    'FreeBSD': {'virtio-net':[]},
+    'Mageia': {'virtio-net':[]},
+    'OpenSUSE': {'virtio-net':['10.3']},
+    'RHEL_4': {'virtio-net':['GOLD', 'U1', 'U2', 'U3', 'U4', 'U5', 'U6',
+                             'U7']},
+    'RHEL_5': {'virtio-net':['GOLD', 'U1', 'U2']},
+    'RHEL_6': {'virtio-net':[]},
+    'RHEL_7': {'virtio-net':[]},
+    'Ubuntu': {'virtio-blk':['5.04', '5.10', '6.06', '6.06.1', '6.06.2',
+                             '6.10', '7.04', '7.10'],
+               'virtio-net':['5.04', '5.10', '6.06', '6.06.1', '6.06.2',
+                             '6.10', '7.04', '7.10']},
+}
+
+def _start_libvirt_event_loop():
+    """
+    Function to start the libvirt default event loop in a daemon thread, if it
+    isn't running yet.  This has to be done before any libvirt connection that
+    wants events is opened.  Returns True if the event loop is running, and
+    False if this version of libvirt does not support it.
+    """
+    global _event_loop_thread
+
+    with _event_loop_lock:
+        if _event_loop_thread is None:
+            try:
+                libvirt.virEventRegisterDefaultImpl()
+            except (AttributeError, libvirt.libvirtError):
+                return False
+
+            def _run_event_loop():
+                """
+                Function to dispatch libvirt events forever.
+                """
+                while True:
+                    libvirt.virEventRunDefaultImpl()
+
+            _event_loop_thread = threading.Thread(target=_run_event_loop,
+                                                  name="libvirt-events")
+            _event_loop_thread.daemon = True
+            _event_loop_thread.start()
+
+    return True
+
+def _get_domain_stop_event(uuidstr):
+    """
+    Function to get the event that is set when the domain with the given UUID
+    stops.
+    """
+    with _event_loop_lock:
+        if uuidstr not in _domain_stop_events:
+            _domain_stop_events[uuidstr] = threading.Event()
+        return _domain_stop_events[uuidstr]
+
+def _forget_domain_stop_event(uuidstr, stopped):
+    """
+    Function to drop the event of the domain with the given UUID after
+    waiting for it, so that a long-running process does not keep one event
+    around for every domain it ever started.  If the domain stops later on,
+    the callback creates a new event.  Unless the wait saw the domain stop
+    (stopped), an event that was set in the meantime is kept, so that the
+    next wait does not miss the stop.
+    """
+    with _event_loop_lock:
+        stop_event = _domain_stop_events.get(uuidstr)
+        if stop_event is not None and (stopped or not stop_event.is_set()):
+            del _domain_stop_events[uuidstr]
+
+def _domain_lifecycle_callback(conn, dom, event, detail, opaque):
+    """
+    Callback for libvirt domain lifecycle events.
+    """
+    if event not in [libvirt.VIR_DOMAIN_EVENT_STOPPED,
+                     libvirt.VIR_DOMAIN_EVENT_STARTED]:
+        return
+    uuidstr = dom.UUIDString()
+    # the event is changed with the lock held, so that it cannot be dropped
+    # by _forget_domain_stop_event between being looked up and being set
+    with _event_loop_lock:
+        if uuidstr not in _domain_stop_events:
+            _domain_stop_events[uuidstr] = threading.Event()
+        if event == libvirt.VIR_DOMAIN_EVENT_STOPPED:
+            _domain_stop_events[uuidstr].set()
+        else:
+            _domain_stop_events[uuidstr].clear()
+
+def _domain_reboot_callback(conn, dom, opaque):
+    """
+    Callback for libvirt domain reboot events.
+    """
+    logging.getLogger(__name__).debug("Domain %s rebooted", dom.name())
 
 class Guest(object):
     """
     Main class for guest installation.
     """
+    # regular expressions that match the lines the installer prints when an
+    # install has failed; subclasses fill these in for their installers
+    install_failure_patterns = []
+    # the name of the virtio-serial port the installer sends its log to, or
+    # None if the installer only logs to the first serial port
+    install_log_virtio_port = None
+
     def _discover_libvirt_type(self):
         """
         Internal method to discover the libvirt type (qemu, kvm, etc) that
@@ -113,7 +235,28 @@ class Guest(object):
             pass
 
         libvirt.registerErrorHandler(_libvirt_error_handler, 'context')
+
+        # lifecycle events let us notice that a domain has stopped as soon as
+        # it happens, rather than polling the domain every second; if they
+        # are not available, we fall back to polling
+        self.lifecycle_events = _start_libvirt_event_loop()
+
         self.libvirt_conn = libvirt.open(self.libvirt_uri)
+
+        if self.lifecycle_events:
+            try:
+                self.libvirt_conn.domainEventRegisterAny(None,
+                                                         libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE,
+                                                         _domain_lifecycle_callback,
+                                                         None)
+                self.libvirt_conn.domainEventRegisterAny(None,
+                                                         libvirt.VIR_DOMAIN_EVENT_ID_REBOOT,
+                                                         _domain_reboot_callback,
+                                                         None)
+            except libvirt.libvirtError:
+                self.log.debug("libvirt domain events not available, falling back to polling")
+                self.lifecycle_events = False
+
         self._discover_libvirt_bridge()
         self._discover_libvirt_type()
 
@@ -176,6 +319,59 @@ class Guest(object):
                                                            'memory', 1024)) * 1024
         self.image_type = oz.ozutil.config_get_key(config, 'libvirt',
                                                    'image_type', 'raw')
+        self.image_preallocation = oz.ozutil.config_get_key(config, 'libvirt',
+                                                            'image_preallocation',
+                                                            'off')
+        if self.image_preallocation not in ["off", "metadata", "falloc",
+                                            "full"]:
+            raise oz.OzException.OzException("Invalid image_preallocation %s; it must be one of off, metadata, falloc, or full" % (self.image_preallocation))
+        self.image_cluster_size = oz.ozutil.config_get_key(config, 'libvirt',
+                                                           'image_cluster_size',
+                                                           None)
+        self.image_lazy_refcounts = oz.ozutil.config_get_boolean_key(config,
+                                                                     'libvirt',
+                                                                     'image_lazy_refcounts',
+                                                                     False)
+        # the disk cache, io, and discard modes are only used while the
+        # operating system is being installed; the libvirt XML handed back
+        # to the user always uses the libvirt defaults
+        self.install_disk_cache = oz.ozutil.config_get_key(config, 'libvirt',
+                                                           'install_disk_cache',
+                                                           None)
+        if self.install_disk_cache not in [None, "default", "none",
+                                           "writethrough", "writeback",
+                                           "directsync", "unsafe"]:
+            raise oz.OzException.OzException("Invalid install_disk_cache %s" % (self.install_disk_cache))
+        self.install_disk_io = oz.ozutil.config_get_key(config, 'libvirt',
+                                                        'install_disk_io',
+                                                        None)
+        if self.install_disk_io not in [None, "native", "threads"]:
+            raise oz.OzException.OzException("Invalid install_disk_io %s" % (self.install_disk_io))
+        if self.install_disk_io == "native" and self.install_disk_cache not in ["none", "directsync"]:
+            raise oz.OzException.OzException("install_disk_io of native requires an install_disk_cache of none or directsync")
+        self.install_disk_discard = oz.ozutil.config_get_key(config, 'libvirt',
+                                                             'install_disk_discard',
+                                                             None)
+        if self.install_disk_discard not in [None, "unmap", "ignore"]:
+            raise oz.OzException.OzException("Invalid install_disk_discard %s" % (self.install_disk_discard))
+        # like the disk modes above, the install profile, huge pages, and
+        # headless mode only apply to the domain that runs the installer
+        self.install_profile = oz.ozutil.config_get_key(config, 'libvirt',
+                                                        'install_profile',
+                                                        'compat')
+        if self.install_profile not in ["compat", "fast"]:
+            raise oz.OzException.OzException("Invalid install_profile %s; it must be one of compat or fast" % (self.install_profile))
+        self.install_hugepages = oz.ozutil.config_get_boolean_key(config,
+                                                                  'libvirt',
+                                                                  'install_hugepages',
+                                                                  False)
+        self.install_headless = oz.ozutil.config_get_boolean_key(config,
+                                                                 'libvirt',
+                                                                 'install_headless',
+                                                                 False)
+        # the vCPUs and memory of the fast install profile, sized the first
+        # time they are needed
+        self.install_resources = None
 
         # configuration from 'cache' section
         self.cache_original_media = oz.ozutil.config_get_boolean_key(config,
@@ -189,13 +385,105 @@ class Guest(object):
         self.cache_jeos = oz.ozutil.config_get_boolean_key(config, 'cache',
                                                            'jeos', False)
 
+        self.cache_jeos_sparsify = oz.ozutil.config_get_boolean_key(config,
+                                                                    'cache',
+                                                                    'jeos_sparsify',
+                                                                    False)
+
         self.jeos_cache_dir = os.path.join(self.data_dir, "jeos")
 
+        self.chunk_store = None
+        if oz.ozutil.config_get_boolean_key(config, 'cache', 'chunk_store',
+                                            False):
+            chunk_size = int(oz.ozutil.config_get_key(config, 'cache',
+                                                      'chunk_size', 256))
+            self.chunk_store = oz.ChunkStore.ChunkStore(os.path.join(self.data_dir,
+                                                                     "chunkstore"),
+                                                        chunk_size * 1024)
+        self.chunk_store_images = oz.ozutil.config_get_boolean_key(config,
+                                                                   'cache',
+                                                                   'chunk_store_images',
+                                                                   False)
+
+        self.customize_layers = oz.ozutil.config_get_boolean_key(config,
+                                                                 'cache',
+                                                                 'customize_layers',
+                                                                 False)
+        self.customize_layer_dir = os.path.join(self.data_dir, "layers")
+
+        self.cache_inspection = oz.ozutil.config_get_boolean_key(config,
+                                                                 'cache',
+                                                                 'inspection',
+                                                                 True)
+        self.inspection_cache_dir = os.path.join(self.data_dir, "inspection")
+        # the inspections read or made by this guest, by disk image identity
+        self.inspection_cache = {}
+
+        # configuration from 'guestfs' section
+        pool_size = int(oz.ozutil.config_get_key(config, 'guestfs',
+                                                 'pool_size', 1))
+        self.guestfs_pool = oz.GuestfsPool.get_pool(pool_size)
+        # the Oz locks of the disk images of the guestfs handles that are set
+        # up, by handle
+        self.guestfs_disk_locks = {}
+        # the names and disk image files of the running libvirt domains, by
+        # domain ID and UUID
+        self.domain_disk_index = {}
+
+        # configuration from 'export' section
+        self.export_sparsify = oz.ozutil.config_get_boolean_key(config,
+                                                                'export',
+                                                                'sparsify',
+                                                                True)
+        self.export_workers = oz.ozutil.config_get_key(config, 'export',
+                                                       'workers', None)
+        if self.export_workers is None:
+            self.export_workers = multiprocessing.cpu_count()
+        else:
+            self.export_workers = int(self.export_workers)
+        if self.export_workers < 1:
+            raise oz.OzException.OzException("Invalid export workers %d" % (self.export_workers))
+
+        # configuration from 'customize' section
+        self.customize_transport = oz.ozutil.config_get_key(config,
+                                                            'customize',
+                                                            'transport',
+                                                            'ssh')
+        if self.customize_transport not in ["ssh", "agent"]:
+            raise oz.OzException.OzException("Invalid customize transport %s; it must be ssh or agent" % (self.customize_transport))
+        self.customize_bundle = oz.ozutil.config_get_boolean_key(config,
+                                                                 'customize',
+                                                                 'bundle',
+                                                                 False)
+        self.customize_offline = oz.ozutil.config_get_boolean_key(config,
+                                                                  'customize',
+                                                                  'offline',
+                                                                  False)
+        self.customize_package_cache = oz.ozutil.config_get_boolean_key(config,
+                                                                        'customize',
+                                                                        'package_cache',
+                                                                        False)
+        self.package_cache_dir = os.path.join(self.data_dir, "packagecache",
+                                              "%s-%s-%s" % (self.tdl.distro,
+                                                            self.tdl.update,
+                                                            self.tdl.arch))
+
         # configuration of "safe" ICICLE generation option
         self.safe_icicle_gen = oz.ozutil.config_get_boolean_key(config,
                                                                 'icicle',
                                                                 'safe_generation',
                                                                 False)
+        self.offline_icicle_gen = oz.ozutil.config_get_boolean_key(config,
+                                                                   'icicle',
+                                                                   'offline',
+                                                                   False)
+        self.cache_icicle = oz.ozutil.config_get_boolean_key(config, 'icicle',
+                                                             'cache', False)
+        self.cache_icicle_sample = oz.ozutil.config_get_boolean_key(config,
+                                                                    'icicle',
+                                                                    'cache_sample',
+                                                                    False)
+        self.icicle_cache_dir = os.path.join(self.data_dir, "icicle")
 
         # only pull a cached JEOS if it was built with the correct image type
         jeos_extension = self.image_type
@@ -207,6 +495,9 @@ class Guest(object):
                                           self.tdl.distro + self.tdl.update + self.tdl.arch + '.' + jeos_extension)
 
         self.diskimage = output_disk
+        # whether the contents of the diskimage are exactly those of the
+        # cached JEOS; only then can cached customization layers be used
+        self.diskimage_is_jeos = False
         if self.diskimage is None:
             ext = "." + self.image_type
             # compatibility with older versions of Oz
@@ -217,6 +508,94 @@ class Guest(object):
         if not os.path.isabs(self.diskimage):
             raise oz.OzException.OzException("Output disk image must be an absolute path")
 
+        self.state_file = self.diskimage + ".ozstate"
+        self.checkpoint_diskimage = self.diskimage + ".ozcheckpoint"
+        self.checkpoints = False
+        self.checkpoint_customize = oz.ozutil.config_get_boolean_key(config,
+                                                                     'cache',
+                                                                     'checkpoint',
+                                                                     False)
+
+        # configuration from 'telemetry' section
+        self.telemetry_file = self.diskimage + ".telemetry"
+        self.telemetry = None
+        self.record_telemetry = oz.ozutil.config_get_boolean_key(config,
+                                                                 'telemetry',
+                                                                 'record',
+                                                                 True)
+
+        # configuration from 'install_log' section
+        self.install_log = self.diskimage + ".install.log"
+        # the file that the logging channel of the install domain writes to;
+        # it has to be somewhere that qemu can write to, so keep it next to
+        # the disk image
+        self.install_console = self.diskimage + ".console"
+        self.install_console_offset = 0
+        self.install_log_started = False
+        self.install_log_partial = ''
+        self.install_log_tail = []
+        self.record_install_log = oz.ozutil.config_get_boolean_key(config,
+                                                                   'install_log',
+                                                                   'record',
+                                                                   True)
+        self.install_failure_regexes = []
+        if oz.ozutil.config_get_boolean_key(config, 'install_log', 'fail_fast',
+                                            True):
+            patterns = list(self.install_failure_patterns)
+            for key in ['failure_patterns',
+                        'failure_patterns_' + self.tdl.distro.lower()]:
+                extra = oz.ozutil.config_get_key(config, 'install_log', key,
+                                                 None)
+                if extra is not None:
+                    patterns.extend([p for p in extra.splitlines() if p.strip()])
+            for pattern in patterns:
+                try:
+                    self.install_failure_regexes.append(re.compile(pattern))
+                except re.error:
+                    raise oz.OzException.OzException("Invalid install failure pattern %s" % (pattern))
+
+        # configuration from 'timeouts' section
+        self.learn_timeouts = oz.ozutil.config_get_boolean_key(config,
+                                                               'timeouts',
+                                                               'learn', True)
+        self.timeout_factor = float(oz.ozutil.config_get_key(config,
+                                                             'timeouts',
+                                                             'factor', 2.0))
+        if self.timeout_factor < 1.0:
+            raise oz.OzException.OzException("Invalid timeout factor %s" % (self.timeout_factor))
+        self.timeout_min_samples = int(oz.ozutil.config_get_key(config,
+                                                                'timeouts',
+                                                                'min_samples',
+                                                                5))
+        if self.timeout_min_samples < 1:
+            raise oz.OzException.OzException("Invalid timeout min_samples %d" % (self.timeout_min_samples))
+        self.install_history_file = os.path.join(self.data_dir, "history",
+                                                 "installs.json")
+        # the longest install phase and the longest idle period of this
+        # build, which are added to the history once the install succeeds
+        self.longest_install_phase = 0
+        self.longest_install_idle = 0
+
+        # configuration from 'mirrors' section
+        self.mirror_probe_timeout = float(oz.ozutil.config_get_key(config,
+                                                                   'mirrors',
+                                                                   'probe_timeout',
+                                                                   10))
+        self.mirror_sample_size = int(oz.ozutil.config_get_key(config,
+                                                               'mirrors',
+                                                               'sample_size',
+                                                               256)) * 1024
+        self.mirror_max_probes = int(oz.ozutil.config_get_key(config,
+                                                               'mirrors',
+                                                               'max_probes',
+                                                               8))
+        self.mirror_max_connections = int(oz.ozutil.config_get_key(config,
+                                                                   'mirrors',
+                                                                   'max_connections',
+                                                                   4))
+        self.mirror_history_file = os.path.join(self.data_dir, "history",
+                                                "mirrors.json")
+
         self.icicle_tmp = os.path.join(self.data_dir, "icicletmp",
                                        self.tdl.name)
         self.listen_port = random.randrange(1024, 65535)
@@ -321,6 +700,121 @@ class Guest(object):
             if err.errno != errno.ENOENT:
                 raise
 
+    def _read_state(self):
+        """
+        Internal method to read the state file of this build.  Returns None
+        if there is no state file, or if it belongs to a different TDL.
+        """
+        if not os.access(self.state_file, os.F_OK):
+            return None
+
+        with open(self.state_file, 'r') as f:
+            state = json.load(f)
+
+        tdlsum = hashlib.sha256(lxml.etree.tostring(self.tdl.doc)).hexdigest()
+        if state.get('tdl') != tdlsum:
+            self.log.warning("State file %s was written for a different TDL, ignoring it", self.state_file)
+            return None
+
+        return state
+
+    def enable_checkpoints(self, resume=False):
+        """
+        Method to have this guest record the stages of the build that it has
+        completed in a state file next to the diskimage, and to keep a copy of
+        the diskimage from before customization, so that a failed build can
+        be resumed.  If resume is True, the state of an earlier run of the
+        same TDL is picked up, and the list of stages that it completed is
+        returned; otherwise, any earlier state is thrown away.
+        """
+        self.checkpoints = True
+
+        state = None
+        if resume:
+            state = self._read_state()
+
+        if state is None:
+            self.remove_checkpoints()
+            state = {'tdl':hashlib.sha256(lxml.etree.tostring(self.tdl.doc)).hexdigest(),
+                     'stages':[]}
+            self._write_state(state)
+
+        self.log.debug("Completed stages: %s", ', '.join(state['stages']))
+        return state['stages']
+
+    def _write_state(self, state):
+        """
+        Internal method to atomically replace the state file of this build.
+        """
+        tmpfile = self.state_file + ".tmp"
+        with open(tmpfile, 'w') as f:
+            json.dump(state, f)
+        os.rename(tmpfile, self.state_file)
+
+    def record_checkpoint(self, stage, data=None):
+        """
+        Method to record that a stage of the build has completed.  The
+        optional data (which must be JSON serializable) is stored with the
+        stage, and can be retrieved with checkpoint_data().
+        """
+        if not self.checkpoints:
+            return
+
+        state = self._read_state()
+        if stage not in state['stages']:
+            state['stages'].append(stage)
+        if data is not None:
+            state[stage] = data
+        self._write_state(state)
+
+    def checkpoint_data(self, stage):
+        """
+        Method to get the data recorded with a completed stage of the build.
+        """
+        state = self._read_state()
+        if state is None or stage not in state:
+            raise oz.OzException.OzException("No data recorded for stage %s" % (stage))
+        return state[stage]
+
+    def remove_checkpoints(self):
+        """
+        Method to remove the state file and the diskimage checkpoint of this
+        build.
+        """
+        for filename in [self.state_file, self.checkpoint_diskimage]:
+            try:
+                os.unlink(filename)
+            except OSError as err:
+                if err.errno != errno.ENOENT:
+                    raise
+
+    def _checkpoint_before_customize(self):
+        """
+        Internal method to make sure the diskimage is in its pre-customization
+        state before customization starts.  If the checkpoint key is turned
+        on, a sparse copy of the diskimage is saved on the first try, and on a
+        resumed build the diskimage is restored from that copy, throwing away
+        whatever a failed customization left behind.  Without that copy, a
+        build whose customization started but did not finish cannot be
+        resumed, since the customization would run again on top of the half
+        customized diskimage.
+        """
+        if not self.checkpoints:
+            return
+
+        if os.access(self.checkpoint_diskimage, os.F_OK):
+            self.log.info("Restoring diskimage from checkpoint %s",
+                          self.checkpoint_diskimage)
+            oz.ozutil.copyfile_sparse(self.checkpoint_diskimage, self.diskimage)
+        elif "customizing" in self._read_state()['stages']:
+            raise oz.OzException.OzException("The customization of the earlier run did not finish, and there is no copy of the diskimage from before it to start over from; turn on the checkpoint key of the cache section to be able to resume customization")
+        elif self.checkpoint_customize:
+            self.log.info("Saving diskimage checkpoint to %s",
+                          self.checkpoint_diskimage)
+            oz.ozutil.copyfile_sparse(self.diskimage, self.checkpoint_diskimage)
+
+        self.record_checkpoint("customizing")
+
     def check_for_guest_conflict(self):
         """
         Method to check if any of our future actions will conflict with an
@@ -413,26 +907,110 @@ class Guest(object):
         self.lxml_subelement(serial, "protocol", None, {'type':'raw'})
         self.lxml_subelement(serial, "target", None, {'port':'1'})
 
+    def _install_resources(self):
+        """
+        Method to size the domain that runs the installer for the fast install
+        profile from the headroom of the host: the idle CPUs, up to 4, and
+        half of the available memory, up to 4GB, but never less than the
+        configured cpus and memory.  Returns a tuple of the number of vCPUs
+        and the memory in kilobytes.
+        """
+        if self.install_resources is None:
+            idle = int(multiprocessing.cpu_count() - os.getloadavg()[0])
+            cpus = max(int(self.install_cpus), min(idle, 4))
+
+            meminfo = oz.ozutil.get_meminfo()
+            if 'MemAvailable' in meminfo:
+                available = meminfo['MemAvailable']
+            else:
+                # kernels before 3.14
+                available = meminfo.get('MemFree', 0) + meminfo.get('Cached', 0)
+            # round down to whole megabytes
+            memory = max(self.install_memory,
+                         min(available // 2, 4*1024*1024) // 1024 * 1024)
+
+            self.log.debug("Install profile: %d vCPUs, %d kB of memory", cpus,
+                           memory)
+            self.install_resources = (cpus, memory)
+
+        return self.install_resources
+
+    def _install_devices(self):
+        """
+        Method to choose the devices of the domain that runs the installer for
+        the fast install profile: the virtio devices that the installer of
+        this distribution can use according to _install_capabilities, and the
+        devices of the guest otherwise.  Returns a tuple of the NIC model, the
+        disk bus, and the disk device.
+        """
+        capabilities = _install_capabilities.get(self.__class__.__module__.split('.')[-1], {})
+
+        def _capable(device):
+            """Return whether the installer of this update can use device."""
+            return device in capabilities and not self.tdl.update in capabilities[device]
+
+        nicmodel = self.nicmodel
+        if _capable('virtio-net'):
+            nicmodel = "virtio"
+        disk_bus = self.disk_bus
+        disk_dev = self.disk_dev
+        if _capable('virtio-blk'):
+            disk_bus = "virtio"
+            disk_dev = "vda"
+
+        return (nicmodel, disk_bus, disk_dev)
+
+    def _hugepages_available(self, memory):
+        """
+        Method to check whether the host has memory kilobytes of free huge
+        pages to back the domain that runs the installer.
+        """
+        meminfo = oz.ozutil.get_meminfo()
+        free = meminfo.get('HugePages_Free', 0) * meminfo.get('Hugepagesize', 0)
+        if free < memory:
+            self.log.warning("Only %d kB of free huge pages for %d kB of install memory, not using huge pages",
+                             free, memory)
+            return False
+        return True
+
     def _generate_xml(self, bootdev, installdev, kernel=None, initrd=None,
-                      cmdline=None):
+                      cmdline=None, install=False):
         """
-        Method to generate libvirt XML useful for installation.
+        Method to generate libvirt XML useful for installation.  If install is
+        True, the XML is for the domain that runs the installer and may use
+        settings that are only appropriate during installation; the XML that
+        is returned to the user should always be generated with install=False.
         """
         self.log.info("Generate XML for guest %s with bootdev %s", self.tdl.name, bootdev)
 
+        cpus = self.install_cpus
+        memory = self.install_memory
+        nicmodel = self.nicmodel
+        disk_bus = self.disk_bus
+        disk_dev = self.disk_dev
+        fast = install and self.install_profile == "fast"
+        if fast:
+            (cpus, memory) = self._install_resources()
+            (nicmodel, disk_bus, disk_dev) = self._install_devices()
+        hugepages = install and self.install_hugepages and self._hugepages_available(memory)
+        headless = install and self.install_headless
+
         # top-level domain element
         domain = lxml.etree.Element("domain", type=self.libvirt_type)
         # name element
         self.lxml_subelement(domain, "name", self.tdl.name)
         # memory elements
-        self.lxml_subelement(domain, "memory", str(self.install_memory))
-        self.lxml_subelement(domain, "currentMemory", str(self.install_memory))
+        self.lxml_subelement(domain, "memory", str(memory))
+        self.lxml_subelement(domain, "currentMemory", str(memory))
+        if hugepages:
+            memoryBacking = self.lxml_subelement(domain, "memoryBacking")
+            self.lxml_subelement(memoryBacking, "hugepages")
         # uuid
         self.lxml_subelement(domain, "uuid", str(self.uuid))
         # clock offset
         self.lxml_subelement(domain, "clock", None, {'offset':self.clockoffset})
         # vcpu
-        self.lxml_subelement(domain, "vcpu", str(self.install_cpus))
+        self.lxml_subelement(domain, "vcpu", str(cpus))
         # features
         features = self.lxml_subelement(domain, "features")
         self.lxml_subelement(features, "acpi")
@@ -443,6 +1021,8 @@ class Guest(object):
             # Possibly related to BZ 1171501 - need host passthrough for aarch64 and arm with kvm
             cpu = self.lxml_subelement(domain, "cpu", None, { 'mode': 'custom', 'match': 'exact' })
             model = self.lxml_subelement(cpu, "model", "host", { 'fallback': 'allow' })
+        elif fast and self.libvirt_type == "kvm":
+            self.lxml_subelement(domain, "cpu", None, {'mode':'host-passthrough'})
         # os
         osNode = self.lxml_subelement(domain, "os")
         mods = None
@@ -466,31 +1046,55 @@ class Guest(object):
         # devices
         devices = self.lxml_subelement(domain, "devices")
         # graphics
-        if not self.tdl.arch in ["aarch64", "armv7l"]:
+        if not self.tdl.arch in ["aarch64", "armv7l"] and not headless:
             # qemu for arm/aarch64 does not support a graphical console - amazingly
             self.lxml_subelement(devices, "graphics", None, {'port':'-1', 'type':'vnc'})
         # network
         interface = self.lxml_subelement(devices, "interface", None, {'type':'bridge'})
         self.lxml_subelement(interface, "source", None, {'bridge':self.bridge_name})
         self.lxml_subelement(interface, "mac", None, {'address':self.macaddr})
-        self.lxml_subelement(interface, "model", None, {'type':self.nicmodel})
+        self.lxml_subelement(interface, "model", None, {'type':nicmodel})
         # input
-        mousedict = {'bus':self.mousetype}
-        if self.mousetype == "ps2":
-            mousedict['type'] = 'mouse'
-        elif self.mousetype == "usb":
-            mousedict['type'] = 'tablet'
-        self.lxml_subelement(devices, "input", None, mousedict)
-        # serial console pseudo TTY
-        console = self.lxml_subelement(devices, "serial", None, {'type':'pty'})
+        if not headless:
+            mousedict = {'bus':self.mousetype}
+            if self.mousetype == "ps2":
+                mousedict['type'] = 'mouse'
+            elif self.mousetype == "usb":
+                mousedict['type'] = 'tablet'
+            self.lxml_subelement(devices, "input", None, mousedict)
+        # serial console pseudo TTY; while installing, it is the logging
+        # channel of the installer unless that uses a virtio-serial port
+        install_log = install and self.record_install_log
+        if install_log:
+            self._reset_install_console()
+        if install_log and self.install_log_virtio_port is None:
+            console = self.lxml_subelement(devices, "serial", None, {'type':'file'})
+            self.lxml_subelement(console, "source", None, {'path':self.install_console})
+        else:
+            console = self.lxml_subelement(devices, "serial", None, {'type':'pty'})
         self.lxml_subelement(console, "target", None, {'port':'0'})
         # serial
         self._generate_serial_xml(devices)
+        # installer logging channel
+        if install_log and self.install_log_virtio_port is not None:
+            channel = self.lxml_subelement(devices, "channel", None, {'type':'file'})
+            self.lxml_subelement(channel, "source", None, {'path':self.install_console})
+            self.lxml_subelement(channel, "target", None,
+                                 {'type':'virtio',
+                                  'name':self.install_log_virtio_port})
         # boot disk
         bootDisk = self.lxml_subelement(devices, "disk", None, {'device':'disk', 'type':'file'})
-        self.lxml_subelement(bootDisk, "target", None, {'dev':self.disk_dev, 'bus':self.disk_bus})
+        self.lxml_subelement(bootDisk, "target", None, {'dev':disk_dev, 'bus':disk_bus})
         self.lxml_subelement(bootDisk, "source", None, {'file':self.diskimage})
-        self.lxml_subelement(bootDisk, "driver", None, {'name':'qemu', 'type':self.image_type})
+        driverdict = {'name':'qemu', 'type':self.image_type}
+        if install:
+            if self.install_disk_cache is not None:
+                driverdict['cache'] = self.install_disk_cache
+            if self.install_disk_io is not None:
+                driverdict['io'] = self.install_disk_io
+            if self.install_disk_discard is not None:
+                driverdict['discard'] = self.install_disk_discard
+        self.lxml_subelement(bootDisk, "driver", None, driverdict)
         # install disk (if any)
         if not installdev:
             installdev_list = []
@@ -519,7 +1123,7 @@ class Guest(object):
         backed by "backing_filename" which can be either a raw image or a
         qcow2 image.
         """
-        if not force and os.access(self.jeos_filename, os.F_OK):
+        if not force and self._jeos_cached():
             # if we found a cached JEOS, we don't need to do anything here;
             # we'll copy the JEOS itself later on
             return
@@ -543,13 +1147,23 @@ class Guest(object):
         # create the volume XML
         vol = lxml.etree.Element("volume", type="file")
         self.lxml_subelement(vol, "name", filename)
-        self.lxml_subelement(vol, "allocation", "0")
+        allocation = self.lxml_subelement(vol, "allocation", "0")
         target = self.lxml_subelement(vol, "target")
         imgtype = self.image_type
         if backing_filename:
             # Only qcow2 supports image creation using a backing file
             imgtype = "qcow2"
         self.lxml_subelement(target, "format", None, {"type":imgtype})
+        if imgtype == "qcow2":
+            if self.image_cluster_size is not None:
+                self.lxml_subelement(target, "clusterSize",
+                                     str(int(self.image_cluster_size)),
+                                     {'unit':'KiB'})
+            if self.image_lazy_refcounts:
+                # lazy refcounts are only available in the qcow2 v3 format
+                self.lxml_subelement(target, "compat", "1.1")
+                features = self.lxml_subelement(target, "features")
+                self.lxml_subelement(features, "lazy_refcounts")
 
         # FIXME: this makes the permissions insecure, but is needed since
         # libvirt launches guests as qemu:qemu
@@ -576,6 +1190,23 @@ class Guest(object):
                                  {"type":backing_format})
 
         self.lxml_subelement(vol, "capacity", str(capacity), {'unit':'G'})
+
+        # libvirt preallocates raw files up to the allocation, and for qcow2
+        # files the PREALLOC_METADATA flag asks for metadata preallocation if
+        # the allocation is smaller than the capacity, and falloc otherwise.
+        # Overlays are meant to stay small, so they are never preallocated.
+        create_flags = 0
+        if not backing_filename and self.image_preallocation != "off":
+            if self.image_preallocation in ["falloc", "full"]:
+                allocation.text = str(capacity)
+                allocation.set('unit', 'G')
+            if imgtype == "qcow2":
+                if self.image_preallocation == "full":
+                    self.log.warning("libvirt cannot do full preallocation of qcow2 images; using falloc instead")
+                create_flags |= libvirt.VIR_STORAGE_VOL_CREATE_PREALLOC_METADATA
+            elif self.image_preallocation == "metadata":
+                self.log.debug("Metadata preallocation is a no-op for %s images", imgtype)
+
         vol_xml = lxml.etree.tostring(vol, pretty_print=True)
 
         # sigh.  Yes, this is racy; if a pool is defined during this loop, we
@@ -628,7 +1259,7 @@ class Guest(object):
                     raise
 
             try:
-                pool.createXML(vol_xml, 0)
+                pool.createXML(vol_xml, create_flags)
             except libvirt.libvirtError as e:
                 raise
         finally:
@@ -642,14 +1273,14 @@ class Guest(object):
             if backing_filename:
                 self.log.warning("Asked to create partition against a copy-on-write snapshot - ignoring")
             else:
-                g_handle = guestfs.GuestFS()
-                g_handle.add_drive_opts(self.diskimage, format=self.image_type,
-                                        readonly=0)
-                g_handle.launch()
-                devices = g_handle.list_devices()
-                g_handle.part_init(devices[0], "msdos")
-                g_handle.part_add(devices[0], 'p', 1, 2)
-                g_handle.close()
+                g_handle, device = self.guestfs_pool.lease(self.diskimage,
+                                                           self.image_type)
+                try:
+                    g_handle.part_init(device, "msdos")
+                    g_handle.part_add(device, 'p', 1, 2)
+                    g_handle.sync()
+                finally:
+                    self.guestfs_pool.release(g_handle)
 
     def generate_diskimage(self, size=10, force=False):
         """
@@ -663,6 +1294,184 @@ class Guest(object):
         """
         return self._internal_generate_diskimage(size, force, False)
 
+    def _sparsify_diskimage(self, diskimage, image_type):
+        """
+        Method to discard the free space of every filesystem in a disk
+        image, so that sparse copies and conversions of the image only carry
+        the blocks that are actually in use.  If the free space cannot be
+        discarded, it is zeroed instead.
+        """
+        self.log.info("Sparsifying disk image %s", diskimage)
+        g_handle = self.guestfs_pool.lease(diskimage, image_type,
+                                           discard=True)[0]
+        try:
+            # with older libguestfs, or a disk format that cannot pass
+            # discard requests through, the free space is zeroed instead
+            discard = self.guestfs_pool.discard_enabled(g_handle)
+            if not discard:
+                self.log.debug("Discard not available for %s, zeroing free space instead", diskimage)
+
+            filesystems = g_handle.list_filesystems()
+            if isinstance(filesystems, dict):
+                filesystems = filesystems.items()
+            for device, fstype in filesystems:
+                if fstype in ["swap", "unknown"]:
+                    continue
+                try:
+                    g_handle.mount_options('', device, '/')
+                except RuntimeError:
+                    self.log.debug("Unable to mount %s (%s), skipping", device,
+                                   fstype)
+                    continue
+                try:
+                    trimmed = False
+                    if discard:
+                        try:
+                            g_handle.fstrim('/')
+                            trimmed = True
+                        except RuntimeError:
+                            self.log.debug("Unable to trim %s, zeroing free space instead", device)
+                    if not trimmed:
+                        g_handle.zero_free_space('/')
+                finally:
+                    g_handle.umount_all()
+
+            g_handle.sync()
+        finally:
+            self.guestfs_pool.release(g_handle)
+
+    def _cache_jeos_image(self):
+        """
+        Internal method to store the freshly installed disk image as the
+        cached JEOS for this operating system.
+        """
+        self.log.info("Caching JEOS")
+        if self.cache_jeos_sparsify:
+            self._sparsify_diskimage(self.diskimage, self.image_type)
+        if self.chunk_store is not None:
+            self.chunk_store.check_in(self.diskimage, self._jeos_store_name())
+        else:
+            oz.ozutil.mkdir_p(self.jeos_cache_dir)
+            oz.ozutil.copyfile_sparse(self.diskimage, self.jeos_filename)
+        self.diskimage_is_jeos = True
+
+    def _jeos_store_name(self):
+        """
+        Internal method to get the name of the cached JEOS in the chunk store.
+        """
+        return "jeos/" + os.path.basename(self.jeos_filename)
+
+    def _jeos_cached(self):
+        """
+        Internal method to check whether there is a cached JEOS for this
+        operating system, either in the chunk store or as a plain file.
+        """
+        if self.chunk_store is not None and self.chunk_store.contains(self._jeos_store_name()):
+            return True
+        return os.access(self.jeos_filename, os.F_OK)
+
+    def _restore_jeos(self):
+        """
+        Internal method to copy the cached JEOS to the diskimage.
+        """
+        if self.chunk_store is not None and self.chunk_store.contains(self._jeos_store_name()):
+            self.log.info("Found cached JEOS (%s) in the chunk store, using it",
+                          self._jeos_store_name())
+            self.chunk_store.materialize(self._jeos_store_name(),
+                                         self.diskimage)
+        else:
+            self.log.info("Found cached JEOS (%s), using it",
+                          self.jeos_filename)
+            oz.ozutil.copyfile_sparse(self.jeos_filename, self.diskimage)
+        self.diskimage_is_jeos = True
+
+    def check_in_image(self):
+        """
+        Method to store the finished diskimage in the chunk store, if the chunk
+        store is enabled for output images.  Returns the name of the image in
+        the chunk store, or None if it was not stored.
+        """
+        if self.chunk_store is None or not self.chunk_store_images:
+            return None
+
+        name = "images/" + os.path.basename(self.diskimage)
+        self.chunk_store.check_in(self.diskimage, name)
+        return name
+
+    def _export_filename(self, export_format):
+        """
+        Internal method to get the name of the file that an export of the
+        disk image to export_format will be written to.
+        """
+        base = os.path.splitext(self.diskimage)[0]
+        if export_format == "qcow2":
+            return base + "-compressed.qcow2"
+        elif export_format == "tar":
+            return base + ".tar"
+        elif export_format == "zst":
+            return base + ".raw.zst"
+        raise oz.OzException.OzException("Unknown export format %s" % (export_format))
+
+    def export_image(self, formats):
+        """
+        Method to export the disk image to one or more distributable
+        formats.  The supported formats are "qcow2" (a compressed qcow2
+        image), "tar" (a sparse tarball of the raw image), and "zst" (a
+        zstd-compressed raw image).  Unless disabled in the configuration,
+        the free space of the guest filesystems is discarded first.  If the
+        disk image is not raw, it is converted to a temporary raw file first
+        for "tar" and "zst".  The requested formats are then generated
+        concurrently, each by its own process that reads the source image
+        by itself.  Returns a list of the files that were written, in the same order as
+        formats.
+        """
+        outputs = []
+        for export_format in formats:
+            outputs.append(self._export_filename(export_format))
+
+        if self.export_sparsify:
+            self._sparsify_diskimage(self.diskimage, self.image_type)
+
+        rawdir = None
+        try:
+            rawimage = self.diskimage
+            if self.image_type != "raw" and ("tar" in formats or "zst" in formats):
+                # tar and zstd work on the raw contents of the disk, so
+                # unpack any other format to a sparse raw file first
+                rawdir = tempfile.mkdtemp(dir=self.output_dir)
+                rawimage = os.path.join(rawdir, self.tdl.name + ".raw")
+                self.log.info("Converting %s to raw for export", self.diskimage)
+                oz.ozutil.subprocess_run(["qemu-img", "convert",
+                                          "-f", self.image_type,
+                                          "-O", "raw", self.diskimage,
+                                          rawimage])
+
+            cmds = []
+            for export_format, output in zip(formats, outputs):
+                if export_format == "qcow2":
+                    # qemu-img allows at most 16 parallel coroutines
+                    cmds.append(["qemu-img", "convert", "-c", "-W",
+                                 "-m", str(min(self.export_workers, 16)),
+                                 "-f", self.image_type, "-O", "qcow2",
+                                 self.diskimage, output])
+                elif export_format == "tar":
+                    cmds.append(["tar", "--sparse", "-c", "-f", output,
+                                 "-C", os.path.dirname(rawimage),
+                                 os.path.basename(rawimage)])
+                elif export_format == "zst":
+                    cmds.append(["zstd", "-q", "-f",
+                                 "-T%d" % (self.export_workers), "-o",
+                                 output, rawimage])
+
+            self.log.info("Exporting %s to %s", self.diskimage,
+                          ', '.join(outputs))
+            oz.ozutil.subprocess_check_output_many(cmds)
+        finally:
+            if rawdir is not None:
+                shutil.rmtree(rawdir)
+
+        return outputs
+
     def _get_disks_and_interfaces(self, libvirt_dom):
         """
         Method to figure out the disks and interfaces attached to a domain.
@@ -690,24 +1499,65 @@ class Guest(object):
 
         return disks, interfaces
 
-    def _get_disk_and_net_activity(self, libvirt_dom, disks, interfaces):
+    def _get_domain_activity(self, libvirt_dom, disks, interfaces):
         """
-        Method to collect the disk and network activity by the domain.  The
-        method returns two numbers: the first is the sum of all disk activity
-        from all disks, and the second is the sum of all network traffic from
-        all network devices.
+        Method to collect the counters of the activity by the domain.  The
+        method returns a dictionary with the sums of the read and write
+        requests and bytes over all disks, the sums of the received and
+        transmitted bytes over all network devices, and the CPU time used by
+        the domain in nanoseconds.
         """
-        total_disk_req = 0
+        stats = {}
+        for counter in oz.Telemetry.COUNTERS:
+            stats[counter] = 0
+
         for dev in disks:
             rd_req, rd_bytes, wr_req, wr_bytes, errs = libvirt_dom.blockStats(dev)
-            total_disk_req += rd_req + wr_req
+            stats['rd_req'] += rd_req
+            stats['rd_bytes'] += rd_bytes
+            stats['wr_req'] += wr_req
+            stats['wr_bytes'] += wr_bytes
 
-        total_net_bytes = 0
         for dev in interfaces:
             rx_bytes, rx_packets, rx_errs, rx_drop, tx_bytes, tx_packets, tx_errs, tx_drop = libvirt_dom.interfaceStats(dev)
-            total_net_bytes += rx_bytes + tx_bytes
+            stats['rx_bytes'] += rx_bytes
+            stats['tx_bytes'] += tx_bytes
+
+        stats['cpu_time'] = libvirt_dom.info()[4]
 
-        return total_disk_req, total_net_bytes
+        return stats
+
+    def _wait_for_domain_stop(self, libvirt_dom, timeout):
+        """
+        Method to wait up to timeout seconds for a domain to stop.  Returns
+        True if libvirt reported that the domain stopped, and False otherwise.
+        Without lifecycle events this just sleeps for timeout seconds and
+        returns False; the caller has to find out about the domain going away
+        from the libvirt calls it makes itself.
+        """
+        if not self.lifecycle_events:
+            time.sleep(timeout)
+            return False
+
+        uuidstr = libvirt_dom.UUIDString()
+        stop_event = _get_domain_stop_event(uuidstr)
+        stopped = False
+        try:
+            if stop_event.wait(timeout):
+                stopped = True
+                # Oz reuses the same UUID for all of the domains of one build
+                # (for instance, across the reboots of an install), so make
+                # sure the stop wasn't left over from an earlier domain
+                try:
+                    if libvirt_dom.isActive():
+                        stop_event.clear()
+                        stopped = False
+                except libvirt.libvirtError:
+                    pass
+        finally:
+            _forget_domain_stop_event(uuidstr, stopped)
+
+        return stopped
 
     def _wait_for_clean_shutdown(self, libvirt_dom, saved_exception):
         """
@@ -728,7 +1578,7 @@ class Guest(object):
                 if e.get_error_code() == libvirt.VIR_ERR_NO_DOMAIN:
                     break
             count -= 1
-            time.sleep(1)
+            self._wait_for_domain_stop(libvirt_dom, 1)
 
         if count == 0:
             # Got something other than the expected exception even after 10
@@ -749,8 +1599,158 @@ class Guest(object):
                 # the passed in exception was None, just raise a generic error
                 raise oz.OzException.OzException("Unknown libvirt error")
 
+    def _install_history_key(self):
+        """
+        Internal method to get the key of the builds like this one in the
+        install history.
+        """
+        return "%s-%s-%s-%s" % (self.tdl.distro, self.tdl.update,
+                                self.tdl.arch, self.tdl.installtype)
+
+    def _read_install_history(self):
+        """
+        Internal method to read the install history.  Returns a dictionary
+        mapping the keys from _install_history_key() to lists of records of
+        successful installs.
+        """
+        try:
+            with open(self.install_history_file, 'r') as f:
+                return json.load(f)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        except ValueError:
+            self.log.warning("Ignoring corrupt install history %s",
+                             self.install_history_file)
+
+        return {}
+
+    def _learned_timeout(self, field, default):
+        """
+        Internal method to get a timeout from the install history.  The
+        timeout is the 99th percentile of the field over the previous
+        successful installs like this one, multiplied by the timeout factor.
+        Until there are enough installs in the history, default is returned.
+        """
+        if not self.learn_timeouts:
+            return default
+
+        history = self._read_install_history().get(self._install_history_key(), [])
+        samples = [record[field] for record in history]
+        if len(samples) < self.timeout_min_samples:
+            return default
+
+        return int(math.ceil(oz.ozutil.percentile(samples, 99) * self.timeout_factor))
+
+    def _install_timeout(self, timeout, default):
+        """
+        Method to get the timeout for each boot of the install.  A timeout
+        that was passed in by the user always wins; otherwise the timeout is
+        learned from the install history, with default as the timeout to use
+        until there is enough history.
+        """
+        if timeout is not None:
+            return timeout
+
+        timeout = self._learned_timeout('duration', default)
+        self.log.debug("Using an install timeout of %d seconds", timeout)
+        return timeout
+
+    def _record_install_history(self):
+        """
+        Internal method to add the durations of a successful install to the
+        install history.
+        """
+        if not self.learn_timeouts:
+            return
+
+        lockfile = self.install_history_file + ".lock"
+        (fd, outdir) = self._open_locked_file(lockfile)
+        try:
+            history = self._read_install_history()
+            records = history.setdefault(self._install_history_key(), [])
+            records.append({'duration':int(self.longest_install_phase),
+                            'idle':int(self.longest_install_idle)})
+            # only keep the recent installs, since those reflect the current
+            # state of the host and the install trees
+            del records[:-50]
+
+            tmpfile = self.install_history_file + ".tmp"
+            with open(tmpfile, 'w') as f:
+                json.dump(history, f)
+            os.rename(tmpfile, self.install_history_file)
+        finally:
+            os.close(fd)
+
+    def _reset_install_console(self):
+        """
+        Internal method to prepare the file that the logging channel of the
+        next install domain writes to.  The file is created here (rather than
+        by qemu) so that libvirt can give qemu access to it.
+        """
+        open(self.install_console, 'w').close()
+        self.install_console_offset = 0
+        self.install_log_partial = ''
+
+    def _remove_install_console(self):
+        """
+        Internal method to remove the file that the logging channel of the
+        install domain wrote to.
+        """
+        try:
+            os.unlink(self.install_console)
+        except OSError as err:
+            if err.errno != errno.ENOENT:
+                raise
+
+    def _stream_install_log(self):
+        """
+        Internal method to copy the output of the installer since the last
+        call to the install log, and to check it for signs of a failed
+        install.  Returns None if no failure was found, and an excerpt of the
+        log around the failure otherwise.
+        """
+        if not self.record_install_log:
+            return None
+
+        if not self.install_log_started:
+            # the first install phase of this build starts a new log
+            open(self.install_log, 'w').close()
+            self.install_log_started = True
+
+        try:
+            with open(self.install_console, 'rb') as f:
+                f.seek(self.install_console_offset)
+                data = f.read()
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+
+        if not data:
+            return None
+
+        self.install_console_offset += len(data)
+        with open(self.install_log, 'ab') as f:
+            f.write(data)
+
+        lines = (self.install_log_partial + data).replace('\r', '').split('\n')
+        self.install_log_partial = lines.pop()
+        for index, line in enumerate(lines):
+            for regex in self.install_failure_regexes:
+                if regex.search(line):
+                    # the interesting part of a traceback comes after the
+                    # line that matches, so show the rest of this output too
+                    excerpt = self.install_log_tail[-10:] + lines[index:index + 30]
+                    return '\n'.join(excerpt)
+
+            self.install_log_tail.append(line)
+        del self.install_log_tail[:-10]
+
+        return None
+
     def _wait_for_install_finish(self, libvirt_dom, count,
-                                 inactivity_timeout=300):
+                                 inactivity_timeout=None):
         """
         Method to wait for an installation to finish.  This will wait around
         until either the VM has gone away (at which point it is assumed the
@@ -758,24 +1758,65 @@ class Guest(object):
         point it is assumed the install failed and raise an exception).
         """
 
+        if inactivity_timeout is None:
+            # the idle periods are only measured as precisely as the samples
+            # are taken, so never go below a minute
+            inactivity_timeout = max(self._learned_timeout('idle', 300), 60)
+            self.log.debug("Using an inactivity timeout of %d seconds", inactivity_timeout)
+
         disks, interfaces = self._get_disks_and_interfaces(libvirt_dom)
 
+        # with lifecycle events, we find out about the end of the install as
+        # soon as it happens, so the disk and network activity only needs to
+        # be sampled every now and then to catch hung installs
+        sample_interval = 1
+        if self.lifecycle_events:
+            sample_interval = 10
+
+        if self.record_telemetry:
+            if self.telemetry is None:
+                # the first install phase of this build starts a new file
+                self.telemetry = oz.Telemetry.Recorder(self.telemetry_file)
+            self.telemetry.start_phase("install")
+
         last_disk_activity = 0
         last_network_activity = 0
         inactivity_countdown = inactivity_timeout
+        longest_idle = 0
+        phase_start = time.time()
         origcount = count
         saved_exception = None
+        stopped = False
+        iterations = 0
         while count > 0 and inactivity_countdown > 0:
-            if count % 10 == 0:
+            if iterations % (10 // sample_interval) == 0:
                 self.log.debug("Waiting for %s to finish installing, %d/%d", self.tdl.name, count, origcount)
+            iterations += 1
             try:
-                total_disk_req, total_net_bytes = self._get_disk_and_net_activity(libvirt_dom, disks, interfaces)
+                stats = self._get_domain_activity(libvirt_dom, disks, interfaces)
             except libvirt.libvirtError as e:
                 # we save the exception here because we want to raise it later
                 # if this was a "real" exception
                 saved_exception = e
                 break
 
+            if self.telemetry is not None:
+                self.telemetry.sample(stats)
+
+            failure = self._stream_install_log()
+            if failure is not None:
+                if self.telemetry is not None:
+                    self.telemetry.end_phase("failed")
+                self._remove_install_console()
+                raise oz.OzException.OzException("The installer failed, see %s for the full log:\n%s" % (self.install_log, failure))
+
+            total_disk_req = stats['rd_req'] + stats['wr_req']
+            total_net_bytes = stats['rx_bytes'] + stats['tx_bytes']
+
+            start = time.time()
+            stopped = self._wait_for_domain_stop(libvirt_dom, sample_interval)
+            elapsed = time.time() - start
+
             # rd_req and wr_req are the *total* number of disk read requests and
             # write requests ever made for this domain.  Similarly rd_bytes and
             # wr_bytes are the total number of network bytes read or written
@@ -791,34 +1832,58 @@ class Guest(object):
             # made, however, to try to reduce false positives from things like
             # ARP requests
 
-            if (total_disk_req == last_disk_activity) and (total_net_bytes < (last_network_activity + 4096)):
-                # if we saw no read or write requests since the last iteration,
+            if (total_disk_req == last_disk_activity) and (total_net_bytes < (last_network_activity + 4096 * sample_interval)):
+                # if we saw no read or write requests since the last sample,
                 # decrement our activity timer
-                inactivity_countdown -= 1
+                inactivity_countdown -= elapsed
+                longest_idle = max(longest_idle,
+                                   inactivity_timeout - inactivity_countdown)
             else:
                 # if we did see some activity, then we can reset the timer
                 inactivity_countdown = inactivity_timeout
 
             last_disk_activity = total_disk_req
             last_network_activity = total_net_bytes
-            count -= 1
-            time.sleep(1)
+            count -= elapsed
 
-        # We get here because of a libvirt exception, an absolute timeout, or
-        # an I/O timeout; we sort this out below
-        if count == 0:
+            if stopped:
+                break
+
+        # copy the last of the output of the installer to the install log;
+        # from here on, the way the domain went away says how the install
+        # went
+        self._stream_install_log()
+        self._remove_install_console()
+
+        # We get here because the domain stopped, a libvirt exception, an
+        # absolute timeout, or an I/O timeout; we sort this out below
+        if stopped:
+            pass
+        elif count <= 0:
+            if self.telemetry is not None:
+                self.telemetry.end_phase("timeout")
             # if we timed out, then let's make sure to take a screenshot.
             screenshot_text = self._capture_screenshot(libvirt_dom)
             raise oz.OzException.OzException("Timed out waiting for install to finish.  %s" % (screenshot_text))
-        elif inactivity_countdown == 0:
+        elif inactivity_countdown <= 0:
             # if we saw no disk or network activity in the countdown window,
             # we presume the install has hung.  Fail here
+            if self.telemetry is not None:
+                self.telemetry.end_phase("inactivity")
             screenshot_text = self._capture_screenshot(libvirt_dom)
             raise oz.OzException.OzException("No disk activity in %d seconds, failing.  %s" % (inactivity_timeout, screenshot_text))
 
-        # We get here only if we got a libvirt exception
+        # We get here only if the domain stopped or we got a libvirt exception
         self._wait_for_clean_shutdown(libvirt_dom, saved_exception)
 
+        if self.telemetry is not None:
+            self.telemetry.end_phase("finished")
+
+        self.longest_install_phase = max(self.longest_install_phase,
+                                         time.time() - phase_start)
+        self.longest_install_idle = max(self.longest_install_idle,
+                                        longest_idle)
+
         self.log.info("Install of %s succeeded", self.tdl.name)
 
     def _wait_for_guest_shutdown(self, libvirt_dom, count=90):
@@ -828,32 +1893,51 @@ class Guest(object):
         """
         origcount = count
         saved_exception = None
+        stopped = False
         while count > 0:
             if count % 10 == 0:
                 self.log.debug("Waiting for %s to shutdown, %d/%d", self.tdl.name, count, origcount)
-            try:
-                libvirt_dom.info()
-            except libvirt.libvirtError as e:
-                saved_exception = e
-                break
+            if not self.lifecycle_events:
+                try:
+                    libvirt_dom.info()
+                except libvirt.libvirtError as e:
+                    saved_exception = e
+                    break
             count -= 1
-            time.sleep(1)
+            if self._wait_for_domain_stop(libvirt_dom, 1):
+                stopped = True
+                break
 
         # Timed Out
-        if count == 0:
+        if not stopped and count == 0:
             return False
 
-        # We get here only if we got a libvirt exception
+        # We get here only if the domain stopped or we got a libvirt exception
         self._wait_for_clean_shutdown(libvirt_dom, saved_exception)
 
         return True
 
-    def _get_csums(self, original_url, outdir, outputfd):
+    def _get_csums(self, original_url, outdir, outputfd, metalink=None):
         """
         Internal method to fetch the checksum file and compute the checksum
-        on the downloaded data.
-        """
-        if self.tdl.iso_md5_url:
+        on the downloaded data.  If the media came with a (parsed) metalink,
+        the checksum in the metalink is used instead, or failing that the
+        piece checksums.
+        """
+        if metalink is not None and metalink['hash'] is None:
+            if metalink['pieces'] is None:
+                return True
+            (hashname, piece_length, piece_hashes) = metalink['pieces']
+            self.log.debug("Checking the pieces of the downloaded file")
+            return not oz.ozutil.find_bad_pieces(outputfd,
+                                                 os.fstat(outputfd)[stat.ST_SIZE],
+                                                 piece_length, piece_hashes,
+                                                 hashname)
+
+        upstream_sum = None
+        if metalink is not None:
+            (hashname, upstream_sum) = metalink['hash']
+        elif self.tdl.iso_md5_url:
             url = self.tdl.iso_md5_url
             hashname = 'md5'
         elif self.tdl.iso_sha1_url:
@@ -865,28 +1949,29 @@ class Guest(object):
         else:
             return True
 
-        originalname = os.path.basename(urlparse.urlparse(original_url)[2])
+        if upstream_sum is None:
+            originalname = os.path.basename(urlparse.urlparse(original_url)[2])
 
-        csumname = os.path.join(outdir,
-                                self.tdl.distro + self.tdl.update + self.tdl.arch + "-CHECKSUM")
+            csumname = os.path.join(outdir,
+                                    self.tdl.distro + self.tdl.update + self.tdl.arch + "-CHECKSUM")
 
-        (csumfd,outdir) = self._open_locked_file(csumname)
+            (csumfd,outdir) = self._open_locked_file(csumname)
 
-        os.ftruncate(csumfd, 0)
+            os.ftruncate(csumfd, 0)
 
-        try:
-            self.log.debug("Checksum requested, fetching %s file", hashname)
-            oz.ozutil.http_download_file(url, csumfd, False, self.log)
-        finally:
-            os.close(csumfd)
+            try:
+                self.log.debug("Checksum requested, fetching %s file", hashname)
+                oz.ozutil.http_download_file(url, csumfd, False, self.log)
+            finally:
+                os.close(csumfd)
 
-        upstream_sum = getattr(oz.ozutil,
-                               'get_' + hashname + 'sum_from_file')(csumname, originalname)
+            upstream_sum = getattr(oz.ozutil,
+                                   'get_' + hashname + 'sum_from_file')(csumname, originalname)
 
-        os.unlink(csumname)
+            os.unlink(csumname)
 
-        if not upstream_sum:
-            raise oz.OzException.OzException("Could not find checksum for original file " + originalname)
+            if not upstream_sum:
+                raise oz.OzException.OzException("Could not find checksum for original file " + originalname)
 
         self.log.debug("Calculating checksum of downloaded file")
         os.lseek(outputfd, 0, os.SEEK_SET)
@@ -900,43 +1985,125 @@ class Guest(object):
 
         return local_sum.hexdigest() == upstream_sum
 
-    def _get_original_media(self, url, fd, outdir, force_download):
+    def _get_metalink(self, url, metalink_url):
+        """
+        Internal method to fetch and parse the metalink at metalink_url for
+        the media at url.
+        """
+        self.log.debug("Fetching metalink %s", metalink_url)
+        try:
+            data = oz.ozutil.http_get_string(metalink_url)
+        except pycurl.error as err:
+            raise oz.OzException.OzException("Could not fetch metalink %s: %s" % (metalink_url, err))
+
+        try:
+            return oz.ozutil.parse_metalink(data,
+                                            os.path.basename(urlparse.urlparse(url)[2]))
+        except Exception as err:
+            raise oz.OzException.OzException("Could not parse metalink %s: %s" % (metalink_url, err))
+
+    def _download_metalink(self, url, metalink, fd, content_length, cached):
+        """
+        Internal method to download the media at url from all of the mirrors
+        in its metalink at once.  If cached is True, fd already holds a copy
+        of the media with the right size, and only the pieces of it that do
+        not match the piece checksums of the metalink are downloaded again.
+        """
+        if metalink['pieces'] is not None:
+            (hashname, piece_length, piece_hashes) = metalink['pieces']
+            num_pieces = (content_length + piece_length - 1) // piece_length
+            if len(piece_hashes) != num_pieces:
+                raise oz.OzException.OzException("Expected %d piece checksums in the metalink, saw %d" % (num_pieces, len(piece_hashes)))
+        else:
+            # without piece checksums the pieces are just a way to spread the
+            # download over the mirrors
+            hashname = None
+            piece_length = 4*1024*1024
+            piece_hashes = None
+            num_pieces = (content_length + piece_length - 1) // piece_length
+
+        if cached and piece_hashes is not None:
+            pieces = oz.ozutil.find_bad_pieces(fd, content_length, piece_length,
+                                               piece_hashes, hashname)
+            self.log.info("%d of %d pieces of the cached media do not match, fetching them again",
+                          len(pieces), num_pieces)
+        else:
+            # make sure no stale data is left, and that the pieces can be
+            # written out of order
+            os.ftruncate(fd, 0)
+            os.ftruncate(fd, content_length)
+            pieces = list(range(num_pieces))
+
+        candidates = []
+        for candidate in [url] + metalink['urls']:
+            if candidate not in candidates:
+                candidates.append(candidate)
+        mirrors = self._rank_mirrors(candidates, '')
+        if not mirrors:
+            raise oz.OzException.OzException("None of the mirrors of %s accepted byte ranges in time" % (url))
+
+        self.log.info("Fetching %d pieces of the original install media from %d mirrors",
+                      len(pieces), len(mirrors))
+        try:
+            oz.ozutil.http_download_pieces(mirrors, fd, content_length,
+                                           piece_length, pieces,
+                                           self.mirror_max_connections,
+                                           self.log, piece_hashes, hashname)
+        except Exception as err:
+            raise oz.OzException.OzException("Failed to fetch the original install media: %s" % (err))
+
+    def _get_original_media(self, url, fd, outdir, force_download,
+                            metalink_url=None):
         """
         Method to fetch the original media from url.  If the media is already
-        cached locally, the cached copy will be used instead.
+        cached locally, the cached copy will be used instead.  If metalink_url
+        is given, the media is downloaded from all of the mirrors in that
+        metalink at the same time, and checked against its checksums.
         """
         self.log.info("Fetching the original media")
 
-        info = oz.ozutil.http_get_header(url)
+        metalink = None
+        if metalink_url is not None:
+            metalink = self._get_metalink(url, metalink_url)
 
-        if not 'HTTP-Code' in info or info['HTTP-Code'] >= 400 or not 'Content-Length' in info or info['Content-Length'] < 0:
-            raise oz.OzException.OzException("Could not reach destination to fetch boot media")
+        if metalink is not None and metalink['size'] is not None:
+            content_length = metalink['size']
+        else:
+            info = oz.ozutil.http_get_header(url)
 
-        content_length = int(info['Content-Length'])
+            if not 'HTTP-Code' in info or info['HTTP-Code'] >= 400 or not 'Content-Length' in info or info['Content-Length'] < 0:
+                raise oz.OzException.OzException("Could not reach destination to fetch boot media")
+
+            content_length = int(info['Content-Length'])
 
         if content_length == 0:
             raise oz.OzException.OzException("Install media of 0 size detected, something is wrong")
 
+        cached = False
         if not force_download:
             if content_length == os.fstat(fd)[stat.ST_SIZE]:
-                if self._get_csums(url, outdir, fd):
+                if self._get_csums(url, outdir, fd, metalink):
                     self.log.info("Original install media available, using cached version")
                     return
 
                 self.log.info("Original available, but checksum mis-match; re-downloading")
+                cached = True
 
         # before fetching everything, make sure that we have enough
         # space on the filesystem to store the data we are about to download
         devdata = os.statvfs(outdir)
-        if (devdata.f_bsize*devdata.f_bavail) < content_length:
+        if not cached and (devdata.f_bsize*devdata.f_bavail) < content_length:
             raise oz.OzException.OzException("Not enough room on %s for install media" % (outdir))
 
-        # at this point we know we are going to download something.  Make
-        # sure to truncate the file so no stale data is left on the end
-        os.ftruncate(fd, 0)
+        if metalink is not None:
+            self._download_metalink(url, metalink, fd, content_length, cached)
+        else:
+            # at this point we know we are going to download something.  Make
+            # sure to truncate the file so no stale data is left on the end
+            os.ftruncate(fd, 0)
 
-        self.log.info("Fetching the original install media from %s", url)
-        oz.ozutil.http_download_file(url, fd, True, self.log)
+            self.log.info("Fetching the original install media from %s", url)
+            oz.ozutil.http_download_file(url, fd, True, self.log)
 
         filesize = os.fstat(fd)[stat.ST_SIZE]
 
@@ -945,13 +2112,16 @@ class Guest(object):
             # originally saw from the headers, something went wrong
             raise oz.OzException.OzException("Expected to download %d bytes, downloaded %d" % (content_length, filesize))
 
-        if not self._get_csums(url, outdir, fd):
+        if not self._get_csums(url, outdir, fd, metalink):
             raise oz.OzException.OzException("Checksum for downloaded file does not match!")
 
     def _capture_screenshot(self, libvirt_dom):
         """
         Method to capture a screenshot of the VM.
         """
+        if self.install_headless:
+            return "The install was headless, so there is no screenshot"
+
         oz.ozutil.mkdir_p(self.screenshot_dir)
         # create a new stream
         st = libvirt_dom.connect().newStream(0)
@@ -990,15 +2160,12 @@ class Guest(object):
 
         return text
 
-    def _guestfs_handle_setup(self, libvirt_xml):
+    def _get_libvirt_xml_disk(self, libvirt_xml):
         """
-        Method to setup a guestfs handle to the guest disks.
+        Method to get the disk of a guest from its libvirt XML.  Returns a
+        tuple of the filename and the format of the disk.
         """
         input_doc = lxml.etree.fromstring(libvirt_xml)
-        namenode = input_doc.xpath('/domain/name')
-        if len(namenode) != 1:
-            raise oz.OzException.OzException("invalid libvirt XML with no name")
-        input_name = namenode[0].text
         disks = input_doc.xpath('/domain/devices/disk')
         if len(disks) != 1:
             self.log.warning("Oz given a libvirt domain with more than 1 disk; using the first one parsed")
@@ -1014,53 +2181,259 @@ class Guest(object):
         else:
             raise oz.OzException.OzException("invalid <disk> entry without a driver")
 
-        for domid in self.libvirt_conn.listDomainsID():
-            try:
-                doc = lxml.etree.fromstring(self.libvirt_conn.lookupByID(domid).XMLDesc(0))
-            except:
-                self.log.debug("Could not get XML for domain ID (%s) - it may have disappeared (continuing)", domid)
-                continue
+        return (input_disk, input_disk_type)
 
-            namenode = doc.xpath('/domain/name')
-            if len(namenode) != 1:
-                # hm, odd, a domain without a name?
-                raise oz.OzException.OzException("Saw a domain without a name, something weird is going on")
-            if input_name == namenode[0].text:
-                raise oz.OzException.OzException("Cannot setup ICICLE generation on a running guest")
-            disks = doc.xpath('/domain/devices/disk')
-            if len(disks) < 1:
-                # odd, a domain without a disk, but don't worry about it
-                continue
-            for guestdisk in disks:
-                for source in guestdisk.xpath("source"):
-                    # FIXME: this will only work for files; we can make it work
-                    # for other things by following something like:
-                    # http://git.annexia.org/?p=libguestfs.git;a=blob;f=src/virt.c;h=2c6be3c6a2392ab8242d1f4cee9c0d1445844385;hb=HEAD#l169
-                    filename = str(source.get('file'))
-                    if filename == input_disk:
-                        raise oz.OzException.OzException("Cannot setup ICICLE generation on a running disk")
+    def _disk_identity(self, filename, sample=False):
+        """
+        Method to get a cheap identity of a disk image, which changes
+        whenever the disk image is written to.  The identity is made up of
+        the device, inode, size and modification time of the file; if sample
+        is True, it also includes a hash of a sample of the contents, which
+        catches writes that don't change the modification time (for
+        instance, a disk image that is restored with its original times).
+        """
+        st = os.stat(filename)
+        identity = "%d %d %d %r" % (st.st_dev, st.st_ino, st.st_size,
+                                    st.st_mtime)
+        if sample:
+            # 64KB at the start, the end, and at 14 evenly spaced offsets in
+            # between
+            sha256 = hashlib.sha256()
+            with open(filename, 'rb') as f:
+                for i in range(16):
+                    f.seek(max(st.st_size - 65536, 0) * i // 15)
+                    sha256.update(f.read(65536))
+            identity += " " + sha256.hexdigest()
 
+        return identity
 
-        self.log.info("Setting up guestfs handle for %s", self.tdl.name)
-        g = guestfs.GuestFS()
+    def _icicle_cache_file(self, filename):
+        """
+        Method to get the name of the file that caches the ICICLE of a disk
+        image.
+        """
+        name = hashlib.sha256(os.path.realpath(filename)).hexdigest()
+        return os.path.join(self.icicle_cache_dir, name + ".json")
+
+    def _read_icicle_cache(self, libvirt_xml):
+        """
+        Method to get the cached ICICLE of the disk image of a guest.  Returns
+        None if the ICICLE is not cached, or the disk image, the TDL, or the
+        guest class changed since it was cached.
+        """
+        if not self.cache_icicle:
+            return None
 
+        diskimage = self._get_libvirt_xml_disk(libvirt_xml)[0]
+        try:
+            with open(self._icicle_cache_file(diskimage), 'r') as f:
+                entry = json.load(f)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+        except ValueError:
+            self.log.warning("Ignoring corrupt ICICLE cache entry for %s",
+                             diskimage)
+            return None
+
+        if entry.get('key') != self._icicle_cache_key(diskimage):
+            self.log.debug("Cached ICICLE for %s is out of date", diskimage)
+            return None
+
+        return entry['icicle']
+
+    def _icicle_cache_key(self, diskimage):
+        """
+        Method to get the key of the cached ICICLE of a disk image; it covers
+        the identity of the disk image and everything in the TDL that goes
+        into the ICICLE.
+        """
+        return [self._disk_identity(diskimage, self.cache_icicle_sample),
+                self.__class__.__name__, self.tdl.description,
+                self.tdl.icicle_extra_cmd]
+
+    def _write_icicle_cache(self, libvirt_xml, icicle):
+        """
+        Method to cache the ICICLE of the disk image of a guest.
+        """
+        if not self.cache_icicle or icicle is None:
+            return
+
+        diskimage = self._get_libvirt_xml_disk(libvirt_xml)[0]
+        cachefile = self._icicle_cache_file(diskimage)
+        oz.ozutil.mkdir_p(self.icicle_cache_dir)
+        tmpfile = "%s.%d.tmp" % (cachefile, os.getpid())
+        with open(tmpfile, 'w') as f:
+            json.dump({'diskimage':diskimage,
+                       'key':self._icicle_cache_key(diskimage),
+                       'icicle':icicle}, f)
+        os.rename(tmpfile, cachefile)
+
+    def _invalidate_icicle_cache(self, libvirt_xml):
+        """
+        Method to remove the cached ICICLE of the disk image of a guest,
+        before the disk image is modified.
+        """
+        diskimage = self._get_libvirt_xml_disk(libvirt_xml)[0]
+        cachefile = self._icicle_cache_file(diskimage)
+        if os.access(cachefile, os.F_OK):
+            os.unlink(cachefile)
+
+    def _guestfs_handle_setup(self, libvirt_xml, readonly=False):
+        """
+        Method to setup a guestfs handle to the guest disks.  If readonly is
+        True, the disks can still be written through the handle, but the
+        writes go to a temporary overlay that is thrown away at the end.
+        """
+        input_doc = lxml.etree.fromstring(libvirt_xml)
+        namenode = input_doc.xpath('/domain/name')
+        if len(namenode) != 1:
+            raise oz.OzException.OzException("invalid libvirt XML with no name")
+        input_name = namenode[0].text
+        input_disk, input_disk_type = self._get_libvirt_xml_disk(libvirt_xml)
+
+        names, disks = self._running_domain_index()
+        if input_name in names:
+            raise oz.OzException.OzException("Cannot setup ICICLE generation on a running guest")
+        if os.path.realpath(input_disk) in disks:
+            raise oz.OzException.OzException("Cannot setup ICICLE generation on a running disk")
+
+        # running domains are not the only ones that could be using the disk
+        # image; another Oz process might be setting it up as well
+        lock = self._lock_disk(input_disk, readonly)
+
+        self.log.info("Setting up guestfs handle for %s", self.tdl.name)
         self.log.debug("Adding disk image %s", input_disk)
-        # NOTE: we use "add_drive_opts" here so we can specify the type
-        # of the diskimage.  Otherwise it might be possible for an attacker
-        # to fool libguestfs with a specially-crafted diskimage that looks
-        # like a qcow2 disk (thanks to rjones for the tip)
-        g.add_drive_opts(input_disk, format=input_disk_type)
+        try:
+            g, device = self.guestfs_pool.lease(input_disk, input_disk_type,
+                                                readonly)
+        except:
+            os.close(lock)
+            raise
+
+        try:
+            inspection = self._read_inspection_cache(input_disk)
+            if inspection is not None and not self._guestfs_mount_inspection(g, device, inspection):
+                self.log.debug("Cached inspection of %s does not match, inspecting again",
+                               input_disk)
+                inspection = None
+
+            if inspection is None:
+                inspection = self._guestfs_inspect(g, device)
+                self._guestfs_mount_inspection(g, device, inspection)
+                self._write_inspection_cache(input_disk, inspection)
+        except:
+            self.guestfs_pool.release(g)
+            os.close(lock)
+            raise
+
+        self.guestfs_disk_locks[id(g)] = lock
+
+        return g
+
+    def _running_domain_index(self):
+        """
+        Method to find the names of the running libvirt domains, and the disk
+        image files that they use.  Returns a tuple of the set of names and a
+        dictionary from the real path of each disk image file to the name of
+        the domain using it.  The disks of a domain are only looked up the
+        first time the domain is seen running, since getting and parsing the
+        XML of every domain on a busy host takes a long time.
+        """
+        try:
+            domains = self.libvirt_conn.listAllDomains(libvirt.VIR_CONNECT_LIST_DOMAINS_ACTIVE)
+        except AttributeError:
+            # libvirt before 0.9.13
+            domains = []
+            for domid in self.libvirt_conn.listDomainsID():
+                try:
+                    domains.append(self.libvirt_conn.lookupByID(domid))
+                except libvirt.libvirtError:
+                    self.log.debug("Could not look up domain ID (%s) - it may have disappeared (continuing)", domid)
+
+        names = set()
+        disks = {}
+        index = {}
+        for dom in domains:
+            # the ID changes every time a domain is started, so together with
+            # the UUID it identifies this run of the domain
+            key = (dom.ID(), dom.UUIDString())
+            if key in self.domain_disk_index:
+                name, paths = self.domain_disk_index[key]
+            else:
+                try:
+                    doc = lxml.etree.fromstring(dom.XMLDesc(0))
+                except:
+                    self.log.debug("Could not get XML for domain ID (%s) - it may have disappeared (continuing)", key[0])
+                    continue
 
-        self.log.debug("Launching guestfs")
-        g.launch()
+                namenode = doc.xpath('/domain/name')
+                if len(namenode) != 1:
+                    # hm, odd, a domain without a name?
+                    raise oz.OzException.OzException("Saw a domain without a name, something weird is going on")
+                name = namenode[0].text
+                # FIXME: this will only work for files; we can make it work
+                # for other things by following something like:
+                # http://git.annexia.org/?p=libguestfs.git;a=blob;f=src/virt.c;h=2c6be3c6a2392ab8242d1f4cee9c0d1445844385;hb=HEAD#l169
+                paths = [os.path.realpath(source.get('file'))
+                         for source in doc.xpath('/domain/devices/disk/source')
+                         if source.get('file') is not None]
+
+            index[key] = (name, paths)
+            names.add(name)
+            for path in paths:
+                disks[path] = name
+
+        # forget about the domains that are not running anymore
+        self.domain_disk_index = index
+
+        return (names, disks)
+
+    def _lock_disk(self, filename, shared):
+        """
+        Method to take the Oz lock of a disk image, so that two Oz processes
+        do not open the same disk image at the same time.  If shared is True,
+        other Oz processes may take a shared lock of the disk image as well.
+        Returns the file descriptor holding the lock; closing it releases the
+        lock.  Raises an OzException if the disk image is already locked.
+        """
+        lockfile = os.path.join(self.data_dir, "disklocks",
+                                hashlib.sha256(os.path.realpath(filename)).hexdigest() + ".lock")
+        oz.ozutil.mkdir_p(os.path.dirname(lockfile))
+
+        fd = os.open(lockfile, os.O_RDWR|os.O_CREAT)
+        if shared:
+            flags = fcntl.LOCK_SH
+        else:
+            flags = fcntl.LOCK_EX
+        try:
+            fcntl.lockf(fd, flags|fcntl.LOCK_NB)
+        except IOError as err:
+            os.close(fd)
+            if err.errno in [errno.EACCES, errno.EAGAIN]:
+                raise oz.OzException.OzException("Disk image %s is in use by another Oz process" % (filename))
+            raise
+
+        return fd
 
+    def _guestfs_inspect(self, g_handle, device):
+        """
+        Method to inspect the operating system on the disks of a guestfs
+        handle, where device is the device of the disk image.  Returns a
+        dictionary with the disk image device ('device'), the root devices
+        ('roots'), the (mountpoint, device) pairs to mount in order
+        ('mountpoints'), and the UUIDs of the filesystems on those devices
+        ('uuids').
+        """
         self.log.debug("Inspecting guest OS")
-        roots = g.inspect_os()
+        roots = g_handle.inspect_os()
 
         if len(roots) == 0:
             raise oz.OzException.OzException("No operating systems found on the disk")
 
         self.log.debug("Getting mountpoints")
+        mountpoints = []
         for root in roots:
             self.log.debug("Root device: %s", root)
 
@@ -1073,34 +2446,130 @@ class Guest(object):
             # are mounted in the right order.  Thanks to rjones for the hint,
             # and the example code that comes from the libguestfs.org python
             # example page.
-            mps = g.inspect_get_mountpoints(root)
-            def _compare(a, b):
-                """
-                Method to sort disks by length.
-                """
-                if len(a[0]) > len(b[0]):
-                    return 1
-                elif len(a[0]) == len(b[0]):
-                    return 0
+            mps = g_handle.inspect_get_mountpoints(root)
+            mps.sort(key=lambda mp_dev: len(mp_dev[0]))
+            mountpoints.extend([list(mp_dev) for mp_dev in mps])
+
+        uuids = {}
+        for mp_dev in mountpoints:
+            try:
+                uuids[mp_dev[1]] = g_handle.vfs_uuid(mp_dev[1])
+            except RuntimeError:
+                uuids[mp_dev[1]] = None
+
+        return {'device':device, 'roots':list(roots),
+                'mountpoints':mountpoints, 'uuids':uuids}
+
+    def _guestfs_mount_inspection(self, g_handle, device, inspection):
+        """
+        Method to mount the filesystems of the operating system of a guestfs
+        handle, as found by _guestfs_inspect().  device is the device of the
+        disk image in this handle, which may differ from the one at the time
+        of the inspection.  If the UUIDs of the filesystems are not what the
+        inspection found (because the inspection came from the cache, and the
+        disk image changed since then), nothing is mounted and False is
+        returned.  Otherwise, True is returned.
+        """
+        def _dev(dev):
+            """Return the name of the inspected device dev in this handle."""
+            # partitions of the disk image are named after its device, but
+            # logical volumes are not
+            olddevice = inspection.get('device', device)
+            if dev.startswith(olddevice):
+                return device + dev[len(olddevice):]
+            return dev
+
+        for dev, fsuuid in inspection['uuids'].items():
+            try:
+                if g_handle.vfs_uuid(_dev(dev)) != fsuuid:
+                    return False
+            except RuntimeError:
+                return False
+
+        for mp_dev in inspection['mountpoints']:
+            try:
+                g_handle.mount_options('', _dev(mp_dev[1]), mp_dev[0])
+            except:
+                if mp_dev[0] == '/':
+                    # If we cannot mount root, we may as well give up
+                    raise
                 else:
-                    return -1
-            mps.sort(_compare)
-            for mp_dev in mps:
-                try:
-                    g.mount_options('', mp_dev[1], mp_dev[0])
-                except:
-                    if mp_dev[0] == '/':
-                        # If we cannot mount root, we may as well give up
-                        raise
-                    else:
-                        # some custom guests may have fstab content with
-                        # "nofail" as a mount option.  For example, images
-                        # built for EC2 with ephemeral mappings.  These
-                        # fail at this point.  Allow things to continue.
-                        # Profound failures will trigger later on during
-                        # the process.
-                        self.log.warning("Unable to mount (%s) on (%s) - trying to continue", mp_dev[1], mp_dev[0])
-        return g
+                    # some custom guests may have fstab content with
+                    # "nofail" as a mount option.  For example, images
+                    # built for EC2 with ephemeral mappings.  These
+                    # fail at this point.  Allow things to continue.
+                    # Profound failures will trigger later on during
+                    # the process.
+                    self.log.warning("Unable to mount (%s) on (%s) - trying to continue", _dev(mp_dev[1]), mp_dev[0])
+
+        return True
+
+    def _inspection_cache_file(self, filename):
+        """
+        Method to get the name of the file that caches the inspection of a
+        disk image.
+        """
+        name = hashlib.sha256(os.path.realpath(filename)).hexdigest()
+        return os.path.join(self.inspection_cache_dir, name + ".json")
+
+    def _inspection_cache_identity(self, filename):
+        """
+        Method to get the identity of a disk image for the inspection cache.
+        Unlike _disk_identity(), this does not change when the disk image is
+        written to, since the layout of the disk rarely changes with it; the
+        UUIDs of the filesystems are checked when the inspection is used.
+        """
+        st = os.stat(filename)
+        return "%s %d %d" % (os.path.realpath(filename), st.st_dev,
+                             st.st_ino)
+
+    def _read_inspection_cache(self, filename):
+        """
+        Method to get the cached inspection of a disk image.  Returns None if
+        there is none.
+        """
+        if not self.cache_inspection:
+            return None
+
+        identity = self._inspection_cache_identity(filename)
+        inspection = self.inspection_cache.get(identity)
+        if inspection is not None:
+            return inspection
+
+        try:
+            with open(self._inspection_cache_file(filename), 'r') as f:
+                entry = json.load(f)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+        except ValueError:
+            self.log.warning("Ignoring corrupt inspection cache entry for %s",
+                             filename)
+            return None
+
+        if entry.get('identity') != identity:
+            return None
+
+        self.inspection_cache[identity] = entry['inspection']
+        return entry['inspection']
+
+    def _write_inspection_cache(self, filename, inspection):
+        """
+        Method to cache the inspection of a disk image.
+        """
+        if not self.cache_inspection:
+            return
+
+        identity = self._inspection_cache_identity(filename)
+        self.inspection_cache[identity] = inspection
+
+        cachefile = self._inspection_cache_file(filename)
+        oz.ozutil.mkdir_p(self.inspection_cache_dir)
+        tmpfile = "%s.%d.tmp" % (cachefile, os.getpid())
+        with open(tmpfile, 'w') as f:
+            json.dump({'identity':identity, 'inspection':inspection}, f)
+        os.rename(tmpfile, cachefile)
 
     def _guestfs_remove_if_exists(self, g_handle, path):
         """
@@ -1141,6 +2610,65 @@ class Guest(object):
         self.log.debug("Unmounting all")
         g_handle.umount_all()
 
+        self.guestfs_pool.release(g_handle)
+        os.close(self.guestfs_disk_locks.pop(id(g_handle)))
+
+    def _modify_libvirt_xml_for_agent(self, libvirt_xml):
+        """
+        Internal method to take input libvirt XML (which may have been provided
+        by the user) and make sure that it has a channel for the QEMU guest
+        agent, so that Oz can talk to the agent through libvirt.
+        """
+        input_doc = lxml.etree.fromstring(libvirt_xml)
+        for target in input_doc.xpath("/domain/devices/channel/target"):
+            if target.get('name') == "org.qemu.guest_agent.0":
+                return libvirt_xml
+
+        devices = input_doc.xpath("/domain/devices")
+        if len(devices) != 1:
+            raise oz.OzException.OzException("%d devices sections specified, something is wrong with the libvirt XML" % (len(devices)))
+        # without a source path, libvirt picks a socket path by itself
+        channel = self.lxml_subelement(devices[0], "channel", None,
+                                       {'type':'unix'})
+        self.lxml_subelement(channel, "source", None, {'mode':'bind'})
+        self.lxml_subelement(channel, "target", None,
+                             {'type':'virtio', 'name':'org.qemu.guest_agent.0'})
+
+        xml = lxml.etree.tostring(input_doc, pretty_print=True)
+        self.log.debug("Generated XML:\n%s", xml)
+        return xml
+
+    def _modify_libvirt_xml_for_package_cache(self, libvirt_xml):
+        """
+        Internal method to take input libvirt XML (which may have been provided
+        by the user) and export the host package cache directory of this
+        guest's operating system to the guest, as a 9p filesystem with the tag
+        "ozpkgcache".
+        """
+        oz.ozutil.mkdir_p(self.package_cache_dir)
+
+        input_doc = lxml.etree.fromstring(libvirt_xml)
+        for target in input_doc.xpath("/domain/devices/filesystem/target"):
+            if target.get('dir') == "ozpkgcache":
+                return libvirt_xml
+
+        devices = input_doc.xpath("/domain/devices")
+        if len(devices) != 1:
+            raise oz.OzException.OzException("%d devices sections specified, something is wrong with the libvirt XML" % (len(devices)))
+        # with the mapped access mode, the files are written by the QEMU
+        # user, and the guest's view of their owners is kept in extended
+        # attributes, so QEMU does not have to run as root
+        filesystem = self.lxml_subelement(devices[0], "filesystem", None,
+                                          {'type':'mount',
+                                           'accessmode':'mapped'})
+        self.lxml_subelement(filesystem, "source", None,
+                             {'dir':self.package_cache_dir})
+        self.lxml_subelement(filesystem, "target", None, {'dir':'ozpkgcache'})
+
+        xml = lxml.etree.tostring(input_doc, pretty_print=True)
+        self.log.debug("Generated XML:\n%s", xml)
+        return xml
+
     def _modify_libvirt_xml_for_serial(self, libvirt_xml):
         """
         Internal method to take input libvirt XML (which may have been provided
@@ -1207,15 +2735,50 @@ class Guest(object):
         self.log.debug("Generated XML:\n%s", xml)
         return xml
 
-    def _wait_for_guest_boot(self, libvirt_dom):
+    def _parse_guest_announcement(self, data, expected_uuid):
+        """
+        Method to look for the announcement of a guest in the data read from
+        its serial port so far.  The announcement is some up-front garbage,
+        followed by a !<ip>,<uuid>!.  Returns the IP address of the guest if
+        the data ends with a valid announcement, and None otherwise.
+        """
+        # Exclude ! from the wildcard to avoid errors when receiving two
+        # announce messages in the same string
+        match = re.search("!([^!]*?,[^!]*?)!$", data)
+        if match is None:
+            return None
+
+        if len(match.groups()) != 1:
+            raise oz.OzException.OzException("Guest checked in with no data")
+        split = match.group(1).split(',')
+        if len(split) != 2:
+            raise oz.OzException.OzException("Guest checked in with bogus data")
+        addr = split[0]
+        uuidstr = split[1]
+        try:
+            # use socket.inet_aton() to validate the IP address
+            socket.inet_aton(addr)
+        except socket.error:
+            raise oz.OzException.OzException("Guest checked in with invalid IP address")
+
+        if uuidstr != expected_uuid:
+            raise oz.OzException.OzException("Guest checked in with unknown UUID")
+
+        return addr
+
+    def _wait_for_guest_boot(self, libvirt_dom, expected_uuid=None):
         """
         Method to wait around for a guest to boot.  Orderly guests will boot
         up and announce their presence via a TCP message; if that happens within
         the timeout, this method returns the IP address of the guest.  If that
-        doesn't happen an exception is raised.
+        doesn't happen an exception is raised.  The guest must announce itself
+        with expected_uuid, which defaults to the UUID of this guest.
         """
         self.log.info("Waiting for guest %s to boot", self.tdl.name)
 
+        if expected_uuid is None:
+            expected_uuid = str(self.uuid)
+
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
         try:
@@ -1223,53 +2786,42 @@ class Guest(object):
             sock.connect(('127.0.0.1', self.listen_port))
 
             addr = None
-            count = 300
+            timeout = 300
+            deadline = time.time() + timeout
+            last_log = None
             data = ''
-            while count > 0:
-                do_sleep = True
-                if count % 10 == 0:
-                    self.log.debug("Waiting for guest %s to boot, %d/300", self.tdl.name, count)
-                try:
+            while True:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                if last_log is None or int(remaining) // 10 != last_log:
+                    last_log = int(remaining) // 10
+                    self.log.debug("Waiting for guest %s to boot, %d/%d", self.tdl.name, remaining, timeout)
+
+                # wake up as soon as the guest writes to the serial port, but
+                # at least once a second to make sure the domain is still there
+                readable, writable, exceptional = select.select([sock], [], [],
+                                                                min(remaining, 1))
+                if readable:
                     # note that we have to build the data up here, since there
                     # is no guarantee that we will get the whole write in one go
-                    data += sock.recv(100)
-                except socket.timeout:
-                    # the socket times out after 1 second.  We can just fall
-                    # through to the below code because it is a noop, *except* that
-                    # we don't want to sleep.  Set the flag
-                    do_sleep = False
-
-                # OK, we got data back from the socket.  Check to see if it is
-                # is what we expect; essentially, some up-front garbage,
-                # followed by a !<ip>,<uuid>!
-                # Exclude ! from the wildcard to avoid errors when receiving two
-                # announce messages in the same string
-                match = re.search("!([^!]*?,[^!]*?)!$", data)
-                if match is not None:
-                    if len(match.groups()) != 1:
-                        raise oz.OzException.OzException("Guest checked in with no data")
-                    split = match.group(1).split(',')
-                    if len(split) != 2:
-                        raise oz.OzException.OzException("Guest checked in with bogus data")
-                    addr = split[0]
-                    uuidstr = split[1]
-                    try:
-                        # use socket.inet_aton() to validate the IP address
-                        socket.inet_aton(addr)
-                    except socket.error:
-                        raise oz.OzException.OzException("Guest checked in with invalid IP address")
-
-                    if uuidstr != str(self.uuid):
-                        raise oz.OzException.OzException("Guest checked in with unknown UUID")
-                    break
+                    buf = sock.recv(4096)
+                    data += buf
+                    addr = self._parse_guest_announcement(data, expected_uuid)
+                    if addr is not None:
+                        break
+                    if buf:
+                        continue
 
                 # if the data we got didn't match, we need to continue waiting.
-                # before going to sleep, make sure that the domain is still
-                # around
-                libvirt_dom.info()
-                if do_sleep:
+                # make sure that the domain is still around; the info() call
+                # raises an exception if it is gone
+                if self._wait_for_domain_stop(libvirt_dom, 0) or not self.lifecycle_events:
+                    libvirt_dom.info()
+                if readable:
+                    # the other end of the serial port went away without the
+                    # domain going away; don't spin on the socket
                     time.sleep(1)
-                count -= 1
         finally:
             sock.close()
 
@@ -1303,6 +2855,129 @@ class Guest(object):
 
         return lxml.etree.tostring(icicle, pretty_print=True)
 
+    def _mirror_candidates(self, url):
+        """
+        Method to get the URLs of the install tree to choose from for a URL
+        install: url itself, the mirrors in the TDL, and the mirrors in the
+        mirror list of the TDL.
+        """
+        candidates = [url] + self.tdl.mirrors
+        if self.tdl.mirrorlist is not None:
+            try:
+                candidates += oz.ozutil.parse_mirrorlist(oz.ozutil.http_get_string(self.tdl.mirrorlist))
+            except pycurl.error as err:
+                self.log.warning("Could not get the mirror list %s: %s",
+                                 self.tdl.mirrorlist, err)
+
+        unique = []
+        for candidate in candidates:
+            # the URL is embedded into the installer, so localhost is of no use
+            if urlparse.urlparse(candidate)[1] in ["localhost", "127.0.0.1",
+                                                   "localhost.localdomain"]:
+                continue
+            if not candidate.endswith('/'):
+                candidate += '/'
+            if candidate not in unique:
+                unique.append(candidate)
+
+        return unique
+
+    def _read_mirror_history(self):
+        """
+        Internal method to read the mirror history.  Returns a dictionary
+        mapping the URL of each mirror that was probed before to a record of
+        how it did.
+        """
+        try:
+            with open(self.mirror_history_file, 'r') as f:
+                return json.load(f)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        except ValueError:
+            self.log.warning("Ignoring corrupt mirror history %s",
+                             self.mirror_history_file)
+
+        return {}
+
+    def _record_mirror_history(self, probed, results):
+        """
+        Internal method to add the results of probing the mirrors in probed
+        to the mirror history.  The speed and latency are averaged with the
+        earlier results, so that one slow probe does not rule a mirror out
+        for good.
+        """
+        lockfile = self.mirror_history_file + ".lock"
+        (fd, outdir) = self._open_locked_file(lockfile)
+        try:
+            history = self._read_mirror_history()
+            for mirror in probed:
+                record = history.setdefault(mirror, {'speed':0, 'latency':0,
+                                                     'failures':0})
+                result = results.get(mirror)
+                if result is None or not result['ranges']:
+                    record['failures'] += 1
+                elif record['speed'] == 0:
+                    record['speed'] = result['speed']
+                    record['latency'] = result['latency']
+                    record['failures'] = 0
+                else:
+                    record['speed'] = (record['speed'] + result['speed']) / 2
+                    record['latency'] = (record['latency'] + result['latency']) / 2
+                    record['failures'] = 0
+                record['time'] = int(time.time())
+
+            tmpfile = self.mirror_history_file + ".tmp"
+            with open(tmpfile, 'w') as f:
+                json.dump(history, f)
+            os.rename(tmpfile, self.mirror_history_file)
+        finally:
+            os.close(fd)
+
+    def _rank_mirrors(self, candidates, path):
+        """
+        Method to probe the mirror URLs in candidates, by downloading a
+        sample of the file at path below each of them at the same time.  Only
+        the mirrors that honor byte ranges are kept, since the installers
+        (and metalink downloads) need them.  Returns the URLs of those mirrors (after any
+        redirects), fastest first.
+        """
+        history = self._read_mirror_history()
+
+        def _history_order(mirror):
+            """Sort key putting mirrors that did well before first."""
+            record = history.get(mirror)
+            if record is None:
+                # a mirror that was never tried might be the fastest
+                return (1, 0)
+            if record['failures']:
+                return (2, record['failures'])
+            return (0, -record['speed'])
+
+        probed = sorted(candidates, key=_history_order)[:self.mirror_max_probes]
+        self.log.info("Probing %d mirrors", len(probed))
+        results = oz.ozutil.http_probe_urls([mirror + path for mirror in probed],
+                                            self.mirror_probe_timeout,
+                                            self.mirror_sample_size)
+        results = dict([(mirror, results[mirror + path]) for mirror in probed
+                        if mirror + path in results])
+        self._record_mirror_history(probed, results)
+
+        ranked = []
+        for mirror in sorted(results, key=lambda mirror: -results[mirror]['speed']):
+            result = results[mirror]
+            self.log.debug("Mirror %s: %.0f kB/s, %.3f seconds to first byte, byte ranges %s",
+                           mirror, result['speed'] / 1024, result['latency'],
+                           result['ranges'])
+            if not result['ranges']:
+                continue
+            effective = result['effective_url']
+            if effective.endswith(path):
+                mirror = effective[:len(effective) - len(path)]
+            ranked.append(mirror)
+
+        return ranked
+
     def _check_url(self, iso=True, url=True):
         """
         Method to check that a TDL URL meets the requirements for a particular
@@ -1447,7 +3122,8 @@ class CDGuest(Guest):
         """
         Method to fetch the original ISO for an operating system.
         """
-        self._get_original_media(isourl, fd, outdir, force_download)
+        self._get_original_media(isourl, fd, outdir, force_download,
+                                 self.tdl.iso_metalink_url)
 
     def _copy_iso(self):
         """
@@ -1462,14 +3138,12 @@ class CDGuest(Guest):
         os.makedirs(self.iso_contents)
 
         self.log.info("Setting up guestfs handle for %s", self.tdl.name)
-        gfs = guestfs.GuestFS()
         self.log.debug("Adding ISO image %s", self.orig_iso)
-        gfs.add_drive_opts(self.orig_iso, readonly=1, format='raw')
-        self.log.debug("Launching guestfs")
-        gfs.launch()
+        gfs, device = self.guestfs_pool.lease(self.orig_iso, 'raw',
+                                              readonly=True)
         try:
             self.log.debug("Mounting ISO")
-            gfs.mount_options('ro', "/dev/sda", "/")
+            gfs.mount_options('ro', device, "/")
 
             self.log.debug("Checking if there is enough space on the filesystem")
             isostat = gfs.statvfs("/")
@@ -1525,7 +3199,7 @@ class CDGuest(Guest):
         finally:
             gfs.sync()
             gfs.umount_all()
-            gfs.kill_subprocess()
+            self.guestfs_pool.release(gfs)
 
     def _get_primary_volume_descriptor(self, cdfd):
         """
@@ -1668,15 +3342,13 @@ class CDGuest(Guest):
         """
         Internal method to actually run the installation.
         """
-        if not force and os.access(self.jeos_filename, os.F_OK):
-            self.log.info("Found cached JEOS (%s), using it", self.jeos_filename)
-            oz.ozutil.copyfile_sparse(self.jeos_filename, self.diskimage)
+        if not force and self._jeos_cached():
+            self._restore_jeos()
             return self._generate_xml("hd", None)
 
         self.log.info("Running install for %s", self.tdl.name)
 
-        if timeout is None:
-            timeout = 1200
+        timeout = self._install_timeout(timeout, 1200)
 
         cddev = self._InstallDev("cdrom", self.output_iso, "hdc")
         if extrainstalldevs != None:
@@ -1689,21 +3361,22 @@ class CDGuest(Guest):
             if reboots_to_go == reboots:
                 if kernelfname and os.access(kernelfname, os.F_OK) and ramdiskfname and os.access(ramdiskfname, os.F_OK) and cmdline:
                     xml = self._generate_xml(None, None, kernelfname,
-                                             ramdiskfname, cmdline)
+                                             ramdiskfname, cmdline,
+                                             install=True)
                 else:
-                    xml = self._generate_xml("cdrom", cddev)
+                    xml = self._generate_xml("cdrom", cddev, install=True)
             else:
-                xml = self._generate_xml("hd", cddev)
+                xml = self._generate_xml("hd", cddev, install=True)
 
             dom = self.libvirt_conn.createXML(xml, 0)
             self._wait_for_install_finish(dom, timeout)
 
             reboots_to_go -= 1
 
+        self._record_install_history()
+
         if self.cache_jeos:
-            self.log.info("Caching JEOS")
-            oz.ozutil.mkdir_p(self.jeos_cache_dir)
-            oz.ozutil.copyfile_sparse(self.diskimage, self.jeos_filename)
+            self._cache_jeos_image()
 
         return self._generate_xml("hd", None)
 
@@ -1796,7 +3469,7 @@ class CDGuest(Guest):
         self.log.info("Generating install media")
 
         if not force_download:
-            if os.access(self.jeos_filename, os.F_OK):
+            if self._jeos_cached():
                 # if we found a cached JEOS, we don't need to do anything here;
                 # we'll copy the JEOS itself later on
                 return
@@ -1907,26 +3580,25 @@ class FDGuest(Guest):
         """
         Method to run the operating system installation.
         """
-        if not force and os.access(self.jeos_filename, os.F_OK):
-            self.log.info("Found cached JEOS, using it")
-            oz.ozutil.copyfile_sparse(self.jeos_filename, self.diskimage)
+        if not force and self._jeos_cached():
+            self._restore_jeos()
             return self._generate_xml("hd", None)
 
         self.log.info("Running install for %s", self.tdl.name)
 
         fddev = self._InstallDev("floppy", self.output_floppy, "fda")
 
-        if timeout is None:
-            timeout = 1200
+        timeout = self._install_timeout(timeout, 1200)
 
-        dom = self.libvirt_conn.createXML(self._generate_xml("fd", fddev),
+        dom = self.libvirt_conn.createXML(self._generate_xml("fd", fddev,
+                                                             install=True),
                                           0)
         self._wait_for_install_finish(dom, timeout)
 
+        self._record_install_history()
+
         if self.cache_jeos:
-            self.log.info("Caching JEOS")
-            oz.ozutil.mkdir_p(self.jeos_cache_dir)
-            oz.ozutil.copyfile_sparse(self.diskimage, self.jeos_filename)
+            self._cache_jeos_image()
 
         return self._generate_xml("hd", None)
 
@@ -0,0 +1,198 @@
+# Copyright (C) 2026  agent <agent@local>
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation;
+# version 2.1 of the License.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""
+Pool of launched libguestfs appliances
+"""
+
+import atexit
+import logging
+import threading
+import guestfs
+
+class GuestfsPool(object):
+    """
+    Class for a pool of launched libguestfs appliances.  Launching an
+    appliance boots a small virtual machine, which takes seconds and a lot
+    of memory, so instead of launching a new appliance for every disk image,
+    a handle leased from the pool is an already running appliance that the
+    disk image is hot-plugged into.  When the handle is released, the disk
+    image is unplugged again and the appliance goes back to the pool.  Only
+    some libguestfs backends (such as libvirt) can hot-plug drives; with the
+    others, the pool notices the first time that hot-plugging fails, and from
+    then on launches a new appliance for every lease like it would without a
+    pool.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.idle = []
+        self.labels = {}
+        self.discards = {}
+        self.count = 0
+        self.hotplug = True
+        self.lock = threading.Lock()
+        self.log = logging.getLogger('%s.%s' % (__name__,
+                                                self.__class__.__name__))
+
+    def _add_drive(self, g_handle, filename, disk_format, readonly, label,
+                   discard):
+        """
+        Internal method to add the disk image filename to g_handle.  If
+        discard is True, discard requests are passed through to the disk
+        image when this version of libguestfs allows it.  Returns whether
+        they are; when the drive is added before launch, the launch can still
+        fail if the disk image cannot pass them through.
+        """
+        # NOTE: we use "add_drive_opts" here so we can specify the type
+        # of the diskimage.  Otherwise it might be possible for an
+        # attacker to fool libguestfs with a specially-crafted diskimage
+        # that looks like a qcow2 disk (thanks to rjones for the tip)
+        if discard:
+            try:
+                g_handle.add_drive_opts(filename, format=disk_format,
+                                        readonly=readonly, label=label,
+                                        discard='enable')
+                return True
+            except (TypeError, RuntimeError) as e:
+                self.log.debug("Could not enable discard for %s (%s)",
+                               filename, e)
+
+        g_handle.add_drive_opts(filename, format=disk_format,
+                                readonly=readonly, label=label)
+        return False
+
+    def lease(self, filename, disk_format, readonly=False, discard=False):
+        """
+        Method to get a launched guestfs handle with the disk image filename
+        added to it.  Returns a tuple of the handle and the name of the disk
+        image's device in the appliance.  If discard is True, discard
+        requests are passed through to the disk image if possible; see
+        discard_enabled().  The handle must be given back with release()
+        once it is not needed anymore; nothing may be left mounted on it.
+        """
+        with self.lock:
+            self.count += 1
+            label = "oz%d" % (self.count)
+            g_handle = None
+            if self.idle:
+                g_handle = self.idle.pop()
+
+        if g_handle is not None:
+            self.log.debug("Hot-plugging %s into a running appliance", filename)
+            try:
+                discarding = self._add_drive(g_handle, filename, disk_format,
+                                             readonly, label, discard)
+                # any volume groups on the new disk have to be activated by
+                # hand, since the appliance only does that at launch
+                g_handle.vgscan()
+                g_handle.vg_activate_all(True)
+            except RuntimeError as e:
+                self.log.debug("Could not hot-plug %s (%s), launching a new appliance",
+                               filename, e)
+                self.hotplug = False
+                g_handle.close()
+                g_handle = None
+
+        if g_handle is None:
+            self.log.debug("Launching guestfs")
+            g_handle = guestfs.GuestFS()
+            discarding = self._add_drive(g_handle, filename, disk_format,
+                                         readonly, label, discard)
+            try:
+                g_handle.launch()
+            except RuntimeError as e:
+                if not discarding:
+                    raise
+                # libguestfs only finds out at launch that discard cannot be
+                # enabled for the drive; start over without it
+                self.log.debug("Could not enable discard for %s (%s)",
+                               filename, e)
+                g_handle.close()
+                g_handle = guestfs.GuestFS()
+                discarding = self._add_drive(g_handle, filename, disk_format,
+                                             readonly, label, False)
+                g_handle.launch()
+
+        with self.lock:
+            self.labels[id(g_handle)] = label
+            self.discards[id(g_handle)] = discarding
+
+        return (g_handle, g_handle.list_disk_labels()[label])
+
+    def discard_enabled(self, g_handle):
+        """
+        Method to check whether the disk image of a handle from lease()
+        passes discard requests through.
+        """
+        with self.lock:
+            return self.discards[id(g_handle)]
+
+    def release(self, g_handle):
+        """
+        Method to give back a handle from lease().  The disk image is
+        unplugged, and the appliance either goes back to the pool or is shut
+        down.
+        """
+        with self.lock:
+            label = self.labels.pop(id(g_handle))
+            self.discards.pop(id(g_handle))
+            keep = self.hotplug and len(self.idle) < self.size
+
+        if keep:
+            try:
+                g_handle.umount_all()
+                g_handle.vg_activate_all(False)
+                g_handle.remove_drive(label)
+            except RuntimeError as e:
+                self.log.debug("Could not unplug the disk image (%s), shutting the appliance down",
+                               e)
+                self.hotplug = False
+                keep = False
+
+        if keep:
+            with self.lock:
+                self.idle.append(g_handle)
+        else:
+            g_handle.close()
+
+    def close(self):
+        """
+        Method to shut down all of the appliances in the pool.
+        """
+        with self.lock:
+            idle = self.idle
+            self.idle = []
+
+        for g_handle in idle:
+            g_handle.close()
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool(size):
+    """
+    Function to get the guestfs pool of this process, creating it with room
+    for size idle appliances if it does not exist yet.  A size of 0 means
+    that every lease launches a new appliance.
+    """
+    global _pool
+
+    with _pool_lock:
+        if _pool is None:
+            _pool = GuestfsPool(size)
+            atexit.register(_pool.close)
+
+    return _pool
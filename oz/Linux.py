@@ -20,41 +20,108 @@ Linux installation
 
 import re
 import time
+import errno
+import socket
+import subprocess
+import tempfile
 import libvirt
+import libvirt_qemu
 import os
+import hashlib
+import json
+import shutil
+import base64
+import lxml.etree
 
 import oz.Guest
+import oz.ozutil
+import oz.CustomizeBundle
 import oz.OzException
 
 class LinuxCDGuest(oz.Guest.CDGuest):
     """
     Class for Linux installation.
     """
+    # attributes that _collect_setup fills in for _collect_teardown; they are
+    # stored alongside each customization layer so that a guest resumed from
+    # a cached layer can still be torn down properly
+    collect_state_attrs = ["sshd_was_active", "crond_was_active",
+                           "ssh_startuplink", "cron_startuplink"]
+
     def __init__(self, tdl, config, auto, output_disk, nicmodel, diskbus,
                  iso_allowed, url_allowed, macaddress):
         oz.Guest.CDGuest.__init__(self, tdl, config, auto, output_disk,
                                   nicmodel, None, None, diskbus, iso_allowed,
                                   url_allowed, macaddress)
 
+        # all of the ssh and scp commands of a customization session share
+        # one connection through this control socket.  The path of a unix
+        # socket is limited to about 100 characters, so fall back to a short
+        # path if icicle_tmp is too deep
+        self.ssh_control_path = os.path.join(self.icicle_tmp, "ssh-control")
+        if len(self.ssh_control_path) > 100:
+            self.ssh_control_path = os.path.join(tempfile.gettempdir(),
+                                                 "oz-ssh-%s" % (self.uuid))
+
+        # the names of the customization stages that were already applied
+        # to the disk image by _customize_offline()
+        self.offline_customize_stages = []
+
+        # the options that point the package manager of the guest at the host
+        # package cache, while it is mounted in the guest
+        self.package_cache_options = ''
+
+    def _wait_for_ssh_banner(self, guestaddr, timeout=30):
+        """
+        Internal method to wait for sshd in the guest to answer with its
+        banner, without trying to log in.  Returns True if sshd answered in
+        time, and False otherwise.
+        """
+        deadline = time.time() + timeout
+        while True:
+            start = time.time()
+            try:
+                sock = socket.create_connection((guestaddr, 22), 1)
+                try:
+                    if sock.recv(256).startswith("SSH-"):
+                        return True
+                finally:
+                    sock.close()
+            except (socket.error, socket.timeout):
+                pass
+
+            if time.time() > deadline:
+                return False
+            # a refused connection comes back right away; don't spin
+            end = time.time()
+            if (end - start) < 0.25:
+                time.sleep(0.25 - (end - start))
+
     def _test_ssh_connection(self, guestaddr):
         """
         Internal method to test out the ssh connection before we try to use it.
         Under systemd, the IP address of a guest can come up and reportip can
         run before the ssh key is generated and sshd starts up.  This check
-        makes sure that we allow an additional 30 seconds (1 second per ssh
-        attempt) for sshd to finish initializing.
+        makes sure that we allow an additional 30 seconds for sshd to finish
+        initializing; until sshd sends its banner, only the TCP port is
+        probed.  The first successful login starts the shared ssh connection
+        for the rest of the session.
         """
-        count = 30
+        self.log.debug("Waiting for sshd in the guest")
+        if not self._wait_for_ssh_banner(guestaddr):
+            self.log.debug("Failed to connect to ssh on running guest")
+            raise oz.OzException.OzException("Failed to connect to ssh on running guest")
+
+        count = 5
         success = False
         while count > 0:
-            try:
-                self.log.debug("Testing ssh connection, try %d", count)
-                start = time.time()
-                self.guest_execute_command(guestaddr, 'ls', timeout=1)
+            self.log.debug("Testing ssh connection, try %d", count)
+            start = time.time()
+            if self._open_ssh_connection(guestaddr):
                 self.log.debug("Succeeded")
                 success = True
                 break
-            except oz.ozutil.SubprocessException:
+            else:
                 # ensure that we spent at least one second before trying again
                 end = time.time()
                 if (end - start) < 1:
@@ -79,9 +146,228 @@ class LinuxCDGuest(oz.Guest.CDGuest):
 
         return runlevel
 
-    def guest_execute_command(self, guestaddr, command, timeout=10):
+    def _guest_uses_systemd(self, g_handle):
         """
-        Method to execute a command on the guest and return the output.
+        Method to determine whether the guest boots with systemd.
+        """
+        if not g_handle.is_symlink('/sbin/init'):
+            return False
+        return 'systemd' in g_handle.readlink('/sbin/init')
+
+    def _image_ssh_setup_boot_announce(self, g_handle):
+        """
+        Method to make the guest run /root/reportip as soon as the network is
+        up at boot, retrying every second until the guest has an address,
+        instead of waiting for the next run of the announce cron job (which
+        stays around as a fallback).  Under systemd this is done by a unit,
+        otherwise by a line in rc.local.
+        """
+        self.log.debug("Announcing the guest at boot")
+        loop = "until /root/reportip; do sleep 1; done"
+
+        if self._guest_uses_systemd(g_handle):
+            unitfile = os.path.join(self.icicle_tmp, "oz-announce.service")
+            with open(unitfile, 'w') as f:
+                f.write("""\
+[Unit]
+Description=Announce the guest to Oz
+After=network.target
+
+[Service]
+Type=simple
+ExecStart=/bin/bash -c "%s"
+
+[Install]
+WantedBy=multi-user.target
+""" % (loop))
+
+            try:
+                g_handle.upload(unitfile,
+                                '/etc/systemd/system/oz-announce.service')
+            finally:
+                os.unlink(unitfile)
+            g_handle.mkdir_p('/etc/systemd/system/multi-user.target.wants')
+            g_handle.ln_sf('/etc/systemd/system/oz-announce.service',
+                           '/etc/systemd/system/multi-user.target.wants/oz-announce.service')
+        elif g_handle.exists('/etc/rc.local'):
+            # on some distributions /etc/rc.local is a symlink; change the
+            # file that actually gets run
+            rclocal = g_handle.realpath('/etc/rc.local')
+            lines = g_handle.cat(rclocal).split("\n")
+            # rc.local often ends with "exit 0", so the line has to go before
+            # that
+            index = len(lines)
+            for i, line in enumerate(lines):
+                if line.strip() == "exit 0":
+                    index = i
+            lines.insert(index, "(%s) &" % (loop))
+
+            rclocalfile = os.path.join(self.icicle_tmp, "rc.local")
+            with open(rclocalfile, 'w') as f:
+                f.write("\n".join(lines))
+
+            try:
+                self._guestfs_path_backup(g_handle, rclocal)
+                g_handle.upload(rclocalfile, rclocal)
+                g_handle.chmod(0o755, rclocal)
+            finally:
+                os.unlink(rclocalfile)
+
+    def _image_ssh_teardown_boot_announce(self, g_handle):
+        """
+        Method to undo _image_ssh_setup_boot_announce.
+        """
+        self._guestfs_remove_if_exists(g_handle,
+                                       '/etc/systemd/system/multi-user.target.wants/oz-announce.service')
+        self._guestfs_remove_if_exists(g_handle,
+                                       '/etc/systemd/system/oz-announce.service')
+
+        if g_handle.exists('/etc/rc.local'):
+            rclocal = g_handle.realpath('/etc/rc.local')
+            if g_handle.exists(rclocal + ".ozbackup"):
+                self._guestfs_path_restore(g_handle, rclocal)
+
+    def _agent_command(self, libvirt_dom, command, arguments=None,
+                       timeout=10):
+        """
+        Internal method to run a command of the QEMU guest agent in the guest
+        and return what it returned.
+        """
+        request = {'execute':command}
+        if arguments is not None:
+            request['arguments'] = arguments
+
+        try:
+            reply = libvirt_qemu.qemuAgentCommand(libvirt_dom,
+                                                  json.dumps(request),
+                                                  timeout, 0)
+        except libvirt.libvirtError as e:
+            raise oz.OzException.OzException("Guest agent command %s failed: %s" % (command, e.get_error_message()))
+
+        return json.loads(reply)['return']
+
+    def _wait_for_guest_agent(self, libvirt_dom, timeout=300):
+        """
+        Method to wait for the QEMU guest agent in the guest to come up.
+        """
+        self.log.info("Waiting for the guest agent in %s to come up",
+                      self.tdl.name)
+
+        deadline = time.time() + timeout
+        while True:
+            try:
+                self._agent_command(libvirt_dom, 'guest-ping', timeout=1)
+                return
+            except oz.OzException.OzException:
+                if time.time() > deadline:
+                    raise oz.OzException.OzException("Timed out waiting for the guest agent to come up")
+
+            # make sure that the domain is still around; the info() call
+            # raises an exception if it is gone
+            if self._wait_for_domain_stop(libvirt_dom, 1) or not self.lifecycle_events:
+                libvirt_dom.info()
+
+    def _agent_execute_command(self, libvirt_dom, command, timeout=3600):
+        """
+        Internal method to execute a command in the guest through the QEMU
+        guest agent.  Returns the same (stdout, stderr, retcode) tuple as
+        guest_execute_command(), and raises the same exception if
+        the command fails.  Raises an OzException if the command does not
+        finish within timeout seconds.
+        """
+        self.log.debug("Running %s through the guest agent", command)
+        pid = self._agent_command(libvirt_dom, 'guest-exec',
+                                  {'path':'/bin/sh', 'arg':['-c', command],
+                                   'capture-output':True})['pid']
+
+        # most commands are quick, so poll fast at first and then back off
+        interval = 0.05
+        deadline = time.time() + timeout
+        while True:
+            status = self._agent_command(libvirt_dom, 'guest-exec-status',
+                                         {'pid':pid})
+            if status['exited']:
+                break
+            if time.time() > deadline:
+                raise oz.OzException.OzException("'%s' did not finish in the guest within %d seconds" % (command, timeout))
+            time.sleep(interval)
+            interval = min(interval * 2, 1)
+
+        stdout = base64.b64decode(status.get('out-data', ''))
+        stderr = base64.b64decode(status.get('err-data', ''))
+        retcode = status.get('exitcode', -1)
+        if stdout:
+            self.log.debug(stdout)
+        if stderr:
+            self.log.debug(stderr)
+
+        if retcode:
+            raise oz.ozutil.SubprocessException("'%s' failed(%d): %s" % (command, retcode, stderr), retcode)
+
+        return (stdout, stderr, retcode)
+
+    def _agent_upload(self, libvirt_dom, file_to_upload, destination):
+        """
+        Internal method to copy a file to the guest through the QEMU guest
+        agent.
+        """
+        self._agent_execute_command(libvirt_dom,
+                                    "mkdir -p " + os.path.dirname(destination))
+
+        handle = self._agent_command(libvirt_dom, 'guest-file-open',
+                                     {'path':destination, 'mode':'w'})
+        try:
+            with open(file_to_upload, 'rb') as f:
+                while True:
+                    buf = f.read(256*1024)
+                    if not buf:
+                        break
+                    self._agent_command(libvirt_dom, 'guest-file-write',
+                                        {'handle':handle,
+                                         'buf-b64':base64.b64encode(buf)})
+        finally:
+            self._agent_command(libvirt_dom, 'guest-file-close',
+                                {'handle':handle})
+
+    def _wait_for_guest(self, libvirt_dom, expected_uuid=None):
+        """
+        Method to wait for a booted guest to be ready for customization.
+        Returns the value to pass as guestaddr to guest_execute_command() and
+        guest_live_upload(); with the ssh transport this is the IP address of
+        the guest, with the agent transport it is the libvirt domain itself.
+        """
+        if self.customize_transport == "agent":
+            self._wait_for_guest_agent(libvirt_dom)
+            return libvirt_dom
+
+        guestaddr = self._wait_for_guest_boot(libvirt_dom, expected_uuid)
+        self._test_ssh_connection(guestaddr)
+        return guestaddr
+
+    def _agent_cleanup_files(self):
+        """
+        Method to get the list of files (shell globs allowed) that
+        _agent_cleanup() removes from the guest.  Subclasses whose DHCP
+        client keeps its leases elsewhere should override this, matching
+        what their ssh teardown steps remove.
+        """
+        return ["/etc/ssh/ssh_host_*key", "/etc/ssh/ssh_host_*key.pub",
+                "/var/lib/dhcp/*.leases"]
+
+    def _agent_cleanup(self, guestaddr):
+        """
+        Method to undo changes made by the operating system while it ran for
+        customization with the agent transport, where there is no teardown
+        step afterwards.  For instance, during first boot openssh generates
+        ssh host keys; since this image might be cached later on, remove them.
+        """
+        self.guest_execute_command(guestaddr,
+                                   "rm -f " + " ".join(self._agent_cleanup_files()))
+
+    def _ssh_options(self, timeout):
+        """
+        Internal method to get the options that all ssh and scp commands to
+        the guest use.
         """
         # ServerAliveInterval protects against NAT firewall timeouts
         # on long-running commands with no output
@@ -91,44 +377,87 @@ class LinuxCDGuest(oz.Guest.CDGuest):
         #
         # -F /dev/null makes sure that we don't use the global or per-user
         # configuration files
+        #
+        # ControlPath makes the commands go over the shared connection
+        # started by _open_ssh_connection() (if it is there) instead of doing
+        # their own key exchange and authentication
+        return ["-i", self.sshprivkey,
+                "-F", "/dev/null",
+                "-o", "ServerAliveInterval=30",
+                "-o", "StrictHostKeyChecking=no",
+                "-o", "ConnectTimeout=" + str(timeout),
+                "-o", "UserKnownHostsFile=/dev/null",
+                "-o", "PasswordAuthentication=no",
+                "-o", "ControlPath=" + self.ssh_control_path]
+
+    def _open_ssh_connection(self, guestaddr, timeout=1):
+        """
+        Internal method to start the shared ssh connection to the guest.  The
+        master ssh process goes into the background once it has logged in,
+        and keeps running until _close_ssh_connection().  Returns True if the
+        login succeeded, and False otherwise.
+        """
+        if os.path.exists(self.ssh_control_path):
+            # left behind by an earlier run that did not clean up
+            os.unlink(self.ssh_control_path)
+
+        # the master is started with its output going to /dev/null, since a
+        # background process holding on to our pipes would make the reads in
+        # oz.ozutil.subprocess_run() wait for it
+        with open(os.devnull, 'r+') as devnull:
+            retcode = subprocess.call(["ssh"] + self._ssh_options(timeout) + ["-o", "ControlMaster=yes",
+                                                                              "-o", "ControlPersist=yes",
+                                                                              "-f", "-N", "root@" + guestaddr],
+                                      stdin=devnull, stdout=devnull,
+                                      stderr=devnull)
 
-        return oz.ozutil.subprocess_check_output(["ssh", "-i", self.sshprivkey,
-                                                  "-F", "/dev/null",
-                                                  "-o", "ServerAliveInterval=30",
-                                                  "-o", "StrictHostKeyChecking=no",
-                                                  "-o", "ConnectTimeout=" + str(timeout),
-                                                  "-o", "UserKnownHostsFile=/dev/null",
-                                                  "-o", "PasswordAuthentication=no",
-                                                  "root@" + guestaddr, command],
-                                                 printfn=self.log.debug)
+        return retcode == 0
+
+    def _close_ssh_connection(self, guestaddr):
+        """
+        Internal method to stop the shared ssh connection to the guest, if
+        there is one.
+        """
+        if not os.path.exists(self.ssh_control_path):
+            return
+
+        try:
+            oz.ozutil.subprocess_run(["ssh"] + self._ssh_options(1) + ["-O", "exit", "root@" + guestaddr],
+                                     timeout=30, printfn=self.log.debug)
+        except oz.ozutil.SubprocessException:
+            # the connection is already gone along with the guest
+            pass
+
+        if os.path.exists(self.ssh_control_path):
+            os.unlink(self.ssh_control_path)
+
+    def guest_execute_command(self, guestaddr, command, timeout=10):
+        """
+        Method to execute a command on the guest and return the output.
+        """
+        if self.customize_transport == "agent":
+            return self._agent_execute_command(guestaddr, command)
+
+        result = oz.ozutil.subprocess_run(["ssh"] + self._ssh_options(timeout) + ["root@" + guestaddr, command],
+                                          printfn=self.log.debug)
+        self.log.debug("Command took %.2f seconds", result.elapsed)
+        return (result.stdout, result.stderr, result.retcode)
 
     def guest_live_upload(self, guestaddr, file_to_upload, destination,
                           timeout=10):
         """
         Method to copy a file to the live guest.
         """
+        if self.customize_transport == "agent":
+            return self._agent_upload(guestaddr, file_to_upload, destination)
+
         self.guest_execute_command(guestaddr,
                                    "mkdir -p " + os.path.dirname(destination),
                                    timeout)
 
-        # ServerAliveInterval protects against NAT firewall timeouts
-        # on long-running commands with no output
-        #
-        # PasswordAuthentication=no prevents us from falling back to
-        # keyboard-interactive password prompting
-        #
-        # -F /dev/null makes sure that we don't use the global or per-user
-        # configuration files
-        return oz.ozutil.subprocess_check_output(["scp", "-i", self.sshprivkey,
-                                                  "-F", "/dev/null",
-                                                  "-o", "ServerAliveInterval=30",
-                                                  "-o", "StrictHostKeyChecking=no",
-                                                  "-o", "ConnectTimeout=" + str(timeout),
-                                                  "-o", "UserKnownHostsFile=/dev/null",
-                                                  "-o", "PasswordAuthentication=no",
-                                                  file_to_upload,
-                                                  "root@" + guestaddr + ":" + destination],
-                                                 printfn=self.log.debug)
+        result = oz.ozutil.subprocess_run(["scp"] + self._ssh_options(timeout) + [file_to_upload, "root@" + guestaddr + ":" + destination],
+                                          printfn=self.log.debug)
+        return (result.stdout, result.stderr, result.retcode)
 
     def _customize_files(self, guestaddr):
         """
@@ -156,10 +485,16 @@ class LinuxCDGuest(oz.Guest.CDGuest):
             # 90 seconds for wait_for_guest_shutdown to timeout and forcibly
             # kill the guest.
             try:
-                self.guest_execute_command(guestaddr, 'shutdown -h now')
+                if self.customize_transport == "agent":
+                    libvirt_dom.shutdownFlags(libvirt.VIR_DOMAIN_SHUTDOWN_GUEST_AGENT)
+                else:
+                    self.guest_execute_command(guestaddr, 'shutdown -h now')
             except:
                 pass
 
+            if self.customize_transport == "ssh":
+                self._close_ssh_connection(guestaddr)
+
             try:
                 if not self._wait_for_guest_shutdown(libvirt_dom):
                     self.log.warn("Guest did not shutdown in time, going to kill")
@@ -200,6 +535,59 @@ class LinuxCDGuest(oz.Guest.CDGuest):
         """
         raise oz.OzException.OzException("Customization is not implemented for guest %s" % (self.tdl.distro))
 
+    def _package_cache_manager_options(self, directory):
+        """
+        Internal method to get the options that make the package manager of
+        the guest keep the packages that it downloads in directory.  Returns
+        None if the package manager of this guest type cannot use the host
+        package cache; expected to be overriden by child classes that can.
+        """
+        return None
+
+    def _mount_package_cache(self, guestaddr):
+        """
+        Method to mount the host package cache exported by
+        _modify_libvirt_xml_for_package_cache() in the guest, and to point the
+        package manager at it.  If the guest cannot mount it (for instance,
+        because its kernel has no 9p support), or cannot write to it once it
+        is mounted (for instance, because the host directory is not writable
+        by the user that libvirt runs qemu as), the packages are downloaded as
+        usual.
+        """
+        directory = "/var/cache/oz-packages"
+        try:
+            self.guest_execute_command(guestaddr,
+                                       "mkdir -p %s && mount -t 9p -o trans=virtio,version=9p2000.L ozpkgcache %s || { rmdir %s; exit 1; }" % (directory, directory, directory),
+                                       timeout=30)
+        except oz.ozutil.SubprocessException as err:
+            self.log.warning("Could not mount the package cache in the guest, not using it: %s", err)
+            return
+
+        # the package manager fails outright if it cannot write the packages
+        # it downloads, so make sure that works before pointing it here
+        probe = os.path.join(directory, ".oz-write-test")
+        try:
+            self.guest_execute_command(guestaddr,
+                                       "touch %s && rm -f %s || { umount %s; rmdir %s; exit 1; }" % (probe, probe, directory, directory),
+                                       timeout=30)
+        except oz.ozutil.SubprocessException as err:
+            self.log.warning("The package cache is not writable in the guest, not using it: %s", err)
+            return
+
+        self.package_cache_options = self._package_cache_manager_options(directory) + ' '
+
+    def _umount_package_cache(self, guestaddr):
+        """
+        Method to reverse the changes done in _mount_package_cache.
+        """
+        if not self.package_cache_options:
+            return
+
+        self.package_cache_options = ''
+        self.guest_execute_command(guestaddr,
+                                   "umount /var/cache/oz-packages && rmdir /var/cache/oz-packages",
+                                   timeout=30)
+
     def _customize_repos(self, guestaddr):
         """
         Internal method to customize repositories; expected to be overriden by
@@ -214,19 +602,111 @@ class LinuxCDGuest(oz.Guest.CDGuest):
         """
         raise oz.OzException.OzException("Repository removal not implemented for guest %s" % (self.tdl.distro))
 
-    def do_customize(self, guestaddr):
+    def _customize_bundle_repos(self, bundle):
         """
-        Method to customize by installing additional packages and files.
+        Internal method to add the steps that set up the repositories to a
+        customization bundle; expected to be overriden by child classes.
         """
-        if not self.tdl.packages and not self.tdl.files and not self.tdl.commands:
-            # no work to do, just return
-            return
+        raise oz.OzException.OzException("Bundled customization is not implemented for guest %s" % (self.tdl.distro))
 
+    def _customize_bundle_packages(self, bundle, packstr):
+        """
+        Internal method to add the steps that install packages to a
+        customization bundle; expected to be overriden by child classes.
+        """
+        raise oz.OzException.OzException("Bundled customization is not implemented for guest %s" % (self.tdl.distro))
+
+    def _customize_bundle_remove_repos(self, bundle):
+        """
+        Internal method to add the steps that remove the non-persisted
+        repositories to a customization bundle; expected to be overriden by
+        child classes.
+        """
+        raise oz.OzException.OzException("Bundled customization is not implemented for guest %s" % (self.tdl.distro))
+
+    def _build_customize_bundle(self):
+        """
+        Method to collect all of the customization in the TDL into a
+        CustomizeBundle, in the same order that do_customize() would apply
+        it.
+        """
+        bundle = oz.CustomizeBundle.CustomizeBundle()
+
+        if "repos" not in self.offline_customize_stages:
+            self._customize_bundle_repos(bundle)
+            for cmd in self.tdl.precommands:
+                bundle.add_step(cmd.read())
+
+        packstr = ''
+        for package in self.tdl.packages:
+            packstr += '"' + package.name + '" '
+        if packstr != '':
+            self._customize_bundle_packages(bundle, packstr)
+
+        if "files" not in self.offline_customize_stages:
+            for name, fp in list(self.tdl.files.items()):
+                bundle.add_file(fp.name, name)
+
+        for cmd in self.tdl.commands:
+            bundle.add_step(cmd.read())
+
+        self._customize_bundle_remove_repos(bundle)
+
+        return bundle
+
+    def _run_customize_bundle(self, guestaddr, bundle):
+        """
+        Method to send a CustomizeBundle to the guest and run it, in one
+        invocation.  Raises the same exception as guest_execute_command()
+        would have for the first step that fails.
+        """
+        self.log.info("Running %d customization steps in the guest",
+                      len(bundle.steps))
+
+        with tempfile.NamedTemporaryFile(dir=self.icicle_tmp) as tarfile:
+            bundle.write(tarfile)
+            tarfile.flush()
+            tarfile.seek(0)
+
+            # the driver exits successfully even when a step fails, so a
+            # failure here is a failure to get the bundle into the guest
+            run = 'd=$(mktemp -d /tmp/oz-customize.XXXXXX) && tar -x -C "$d" -f %s && "$d/run.sh"; rc=$?; rm -rf "$d" %s; exit $rc'
+            if self.customize_transport == "agent":
+                remote = "/tmp/oz-customize-%s.tar" % (self.uuid)
+                self._agent_upload(guestaddr, tarfile.name, remote)
+                stdout = self._agent_execute_command(guestaddr,
+                                                     run % (remote, remote))[0]
+            else:
+                result = oz.ozutil.subprocess_run(["ssh"] + self._ssh_options(10) + ["root@" + guestaddr, run % ("-", "")],
+                                                  stdin=tarfile)
+                stdout = result.stdout
+
+        results = bundle.parse_report(stdout)
+        for index, step in enumerate(results):
+            self.log.debug("Step %d took %.2f seconds: %s", index + 1,
+                           step.elapsed, step.command)
+            if step.stdout:
+                self.log.debug(step.stdout)
+            if step.stderr:
+                self.log.debug(step.stderr)
+            step.check()
+
+        if len(results) != len(bundle.steps):
+            raise oz.OzException.OzException("Only %d of the %d customization steps ran in the guest" % (len(results), len(bundle.steps)))
+
+    def _customize_stage_repos(self, guestaddr):
+        """
+        Method to setup the repositories and run the precommands.
+        """
         self._customize_repos(guestaddr)
 
         for cmd in self.tdl.precommands:
             self.guest_execute_command(guestaddr, cmd.read())
 
+    def _customize_stage_packages(self, guestaddr):
+        """
+        Method to install the custom packages.
+        """
         self.log.debug("Installing custom packages")
         packstr = ''
         for package in self.tdl.packages:
@@ -235,25 +715,485 @@ class LinuxCDGuest(oz.Guest.CDGuest):
         if packstr != '':
             self._install_packages(guestaddr, packstr)
 
-        self._customize_files(guestaddr)
-
+    def _customize_stage_commands(self, guestaddr):
+        """
+        Method to run the custom commands.
+        """
         self.log.debug("Running custom commands")
         for cmd in self.tdl.commands:
             self.guest_execute_command(guestaddr, cmd.read())
 
+    def _customize_stages(self):
+        """
+        Method to get the stages of customization, in the order that they are
+        applied.  Returns a list of (name, method, content) tuples, where
+        content is a string describing everything that the stage will do to
+        the guest (or None if the stage has nothing to do).
+        """
+        repos = ''
+        for name in sorted(self.tdl.repositories.keys()):
+            repo = self.tdl.repositories[name]
+            repos += "%s %s %s %s %s\n" % (repo.name, repo.url, repo.signed,
+                                           repo.persisted, repo.sslverify)
+        for cmd in self.tdl.precommands:
+            repos += oz.ozutil.sha256_file(cmd.name) + "\n"
+
+        packages = ''
+        for package in self.tdl.packages:
+            packages += package.name + "\n"
+
+        files = ''
+        for name in sorted(self.tdl.files.keys()):
+            files += "%s %s\n" % (name, oz.ozutil.sha256_file(self.tdl.files[name].name))
+
+        commands = ''
+        for cmd in self.tdl.commands:
+            commands += oz.ozutil.sha256_file(cmd.name) + "\n"
+
+        stages = []
+        for name, method, content in [("repos", self._customize_stage_repos, repos),
+                                      ("packages", self._customize_stage_packages, packages),
+                                      ("files", self._customize_files, files),
+                                      ("commands", self._customize_stage_commands, commands)]:
+            if not content:
+                content = None
+            stages.append((name, method, content))
+
+        return stages
+
+    def _offline_repo_files(self):
+        """
+        Internal method to get the repository files to write into the disk
+        image when the repositories are set up offline, as a list of
+        (repository, path, contents) tuples.  Returns None if the
+        repositories of this guest type can only be set up in the running
+        guest; expected to be overriden by child classes that can do better.
+        """
+        return None
+
+    def _offline_customize_stage_names(self):
+        """
+        Method to get the names of the stages of customization that can be
+        applied straight to the disk image, without booting the guest.  Those
+        are the stages at the start of _customize_stages() that only write
+        files or have nothing to do; everything after the first stage that
+        has to run code in the guest stays online, so that the order of the
+        stages does not change.
+        """
+        names = []
+        for name, method, content in self._customize_stages():
+            if content is None or name == "files":
+                names.append(name)
+            elif name == "repos" and not self.tdl.precommands and self._offline_repo_files() is not None:
+                names.append(name)
+            else:
+                break
+
+        return names
+
+    def _guestfs_relabel(self, g_handle, paths):
+        """
+        Method to give files written through guestfs the SELinux labels that
+        they would have gotten if they had been written in the running guest.
+        """
+        if not g_handle.is_file('/etc/selinux/config'):
+            return
+
+        selinuxtype = None
+        for line in g_handle.read_lines('/etc/selinux/config'):
+            if line.startswith('SELINUXTYPE='):
+                selinuxtype = line[len('SELINUXTYPE='):].strip()
+        if selinuxtype is None:
+            return
+
+        specfile = '/etc/selinux/%s/contexts/files/file_contexts' % (selinuxtype)
+        if hasattr(g_handle, 'selinux_relabel') and g_handle.is_file(specfile):
+            for path in paths:
+                g_handle.selinux_relabel(specfile, path)
+        else:
+            # this version of libguestfs can't do it, so have the guest
+            # relabel itself on the next boot
+            self.log.warning("Unable to relabel the customized files, the guest will relabel itself on the next boot")
+            g_handle.touch('/.autorelabel')
+
+    def _customize_offline(self, libvirt_xml, names):
+        """
+        Method to apply the customization stages in names (as returned by
+        _offline_customize_stage_names()) by writing straight into the disk
+        image through guestfs.
+        """
+        self.log.info("Customizing image offline")
+
+        # if everything is done offline, there is nothing left that needs
+        # the non-persisted repositories, so leave them out altogether
+        online = len(names) != len(self._customize_stages())
+
+        g_handle = self._guestfs_handle_setup(libvirt_xml)
+        try:
+            written = []
+            if "repos" in names and self.tdl.repositories:
+                self.log.debug("Writing additional repository files")
+                for repo, path, contents in self._offline_repo_files():
+                    if repo.persisted or online:
+                        g_handle.mkdir_p(os.path.dirname(path))
+                        g_handle.write(path, contents)
+                        written.append(path)
+
+            if "files" in names and self.tdl.files:
+                self.log.debug("Writing custom files")
+                for name, fp in list(self.tdl.files.items()):
+                    # keep the permissions that the upload with scp keeps
+                    g_handle.mkdir_p(os.path.dirname(name))
+                    g_handle.upload(fp.name, name)
+                    g_handle.chmod(os.stat(fp.name).st_mode & 0o7777, name)
+                    written.append(name)
+
+            if written:
+                self._guestfs_relabel(g_handle, written)
+        finally:
+            self._guestfs_handle_cleanup(g_handle)
+
+        self.offline_customize_stages = names
+
+    def _use_package_cache(self):
+        """
+        Method to check whether the customization of this guest uses the host
+        package cache.
+        """
+        if not self.customize_package_cache or not self.tdl.packages:
+            return False
+        return self._package_cache_manager_options("") is not None
+
+    def do_customize(self, guestaddr):
+        """
+        Method to customize by installing additional packages and files.
+        """
+        if not self.tdl.packages and not self.tdl.files and not self.tdl.commands:
+            # no work to do, just return
+            return
+
+        if self._use_package_cache():
+            self._mount_package_cache(guestaddr)
+
+        try:
+            if self.customize_bundle:
+                self._run_customize_bundle(guestaddr,
+                                           self._build_customize_bundle())
+                return
+
+            for name, method, content in self._customize_stages():
+                if name not in self.offline_customize_stages:
+                    method(guestaddr)
+        finally:
+            self._umount_package_cache(guestaddr)
+
         self.log.debug("Removing non-persisted repos")
         self._remove_repos(guestaddr)
 
         self.log.debug("Syncing")
         self.guest_execute_command(guestaddr, 'sync')
 
-    def do_icicle(self, guestaddr):
+    def _icicle_from_commands(self, run):
         """
         Default method to collect the package information and generate the
-        ICICLE XML.
+        ICICLE XML.  The run argument is a function that takes a shell
+        command, runs it in the guest, and returns its output.
         """
         raise oz.OzException.OzException("ICICLE generation is not implemented for this guest type")
 
+    def do_icicle(self, guestaddr):
+        """
+        Method to collect the package information from the running guest and
+        generate the ICICLE XML.
+        """
+        self.log.debug("Generating ICICLE")
+
+        def _run(command):
+            """
+            Function to run a command in the running guest.
+            """
+            return self.guest_execute_command(guestaddr, command,
+                                              timeout=30)[0]
+
+        return self._icicle_from_commands(_run)
+
+    def _offline_icicle_command(self, g_handle, command):
+        """
+        Method to run a command of the ICICLE generation in the disk image
+        through guestfs.  The command runs with the binaries of the disk
+        image, so the output is the same as in the running guest.  If they
+        can't run in the guestfs appliance, the package listings are read
+        some other way.
+        """
+        self.log.debug("Running '%s' in the disk image", command)
+        try:
+            return g_handle.sh(command)
+        except RuntimeError as e:
+            if command == "rpm -qa":
+                self.log.debug("Could not run rpm in the disk image (%s), using the rpm of the host", e)
+                return self._offline_rpm_qa(g_handle)
+            elif command == "dpkg --get-selections":
+                self.log.debug("Could not run dpkg in the disk image (%s), reading the dpkg status file", e)
+                return oz.ozutil.dpkg_get_selections(g_handle.cat('/var/lib/dpkg/status'))
+            raise
+
+    def _offline_rpm_qa(self, g_handle):
+        """
+        Method to list the packages of the disk image with the rpm of the
+        host, from a copy of the rpm database of the disk image.
+        """
+        dbdir = tempfile.mkdtemp(dir=self.icicle_tmp)
+        try:
+            g_handle.copy_out(g_handle.realpath('/var/lib/rpm'), dbdir)
+            dbpath = os.path.join(dbdir, os.listdir(dbdir)[0])
+            return oz.ozutil.subprocess_run(["rpm", "-qa", "--dbpath",
+                                             dbpath]).stdout
+        finally:
+            shutil.rmtree(dbdir)
+
+    def do_icicle_offline(self, libvirt_xml):
+        """
+        Method to collect the package information straight from the disk
+        image through guestfs, without booting the guest, and generate the
+        ICICLE XML.  The disk image is not modified.
+        """
+        self.log.info("Generating ICICLE offline")
+        g_handle = self._guestfs_handle_setup(libvirt_xml, readonly=True)
+        try:
+            return self._icicle_from_commands(lambda command: self._offline_icicle_command(g_handle, command))
+        finally:
+            self._guestfs_handle_cleanup(g_handle)
+
+    def _customize_layer_keys(self):
+        """
+        Internal method to compute the cache keys of the customization layers.
+        Returns a list of (name, method, key) tuples for the stages that have
+        something to do.  Each key covers the cached JEOS and every stage up to
+        and including its own, so a change to one stage invalidates the layer
+        for that stage and all of the layers above it.
+        """
+        # the collection setup is part of the first layer, so anything that
+        # influences it (the guest class, the transport, and the ssh key) is
+        # part of the key
+        st = os.stat(self.jeos_filename)
+        sha256 = hashlib.sha256()
+        sha256.update("%s %d %d\n" % (os.path.realpath(self.jeos_filename),
+                                       st.st_size, int(st.st_mtime)))
+        sha256.update(self.__class__.__name__ + "\n")
+        sha256.update(self.customize_transport + "\n")
+        if self.customize_transport == "ssh":
+            self._generate_openssh_key(self.sshprivkey)
+            sha256.update(oz.ozutil.sha256_file(self.sshprivkey + ".pub") + "\n")
+
+        keys = []
+        for name, method, content in self._customize_stages():
+            if content is None:
+                continue
+            sha256.update("%s\n%s" % (name, content))
+            keys.append((name, method, sha256.copy().hexdigest()))
+
+        return keys
+
+    def _snapshot_customize_layer(self, libvirt_dom, overlay):
+        """
+        Internal method to freeze the current disk of a running guest as a
+        customization layer.  All further writes go to the new overlay file,
+        which is backed by the frozen layer.
+        """
+        self.log.debug("Taking disk snapshot to %s", overlay)
+        doc = lxml.etree.fromstring(libvirt_dom.XMLDesc(0))
+        snapshot = lxml.etree.Element("domainsnapshot")
+        disks = self.lxml_subelement(snapshot, "disks")
+        for target in doc.xpath("/domain/devices/disk/target"):
+            if target.getparent().get('device') == "disk":
+                disk = self.lxml_subelement(disks, "disk", None,
+                                            {'name':target.get('dev'),
+                                             'snapshot':'external'})
+                self.lxml_subelement(disk, "driver", None, {'type':'qcow2'})
+                self.lxml_subelement(disk, "source", None, {'file':overlay})
+            else:
+                self.lxml_subelement(disks, "disk", None,
+                                     {'name':target.get('dev'),
+                                      'snapshot':'no'})
+
+        libvirt_dom.snapshotCreateXML(lxml.etree.tostring(snapshot),
+                                      libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_DISK_ONLY|libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_NO_METADATA)
+
+    def _publish_customize_layers(self, built):
+        """
+        Internal method to put the customization layers built by this run
+        into the cache.  built is a list of (key, layer, metadata) tuples from
+        the bottom up, where layer and metadata are the files of this run; the
+        guest must not be running anymore.  Each layer is hard linked to its
+        name in the cache, so that a layer cached by another build in the
+        meantime is never replaced; that one is used from then on, and the
+        layers of this run from there up (which are backed by the files of
+        this run) are thrown away.
+        """
+        try:
+            for index, (key, layer, metadata) in enumerate(built):
+                cached = os.path.join(self.customize_layer_dir, key + ".qcow2")
+                try:
+                    os.link(layer, cached)
+                except OSError as err:
+                    if err.errno != errno.EEXIST:
+                        raise
+                    self.log.debug("Customization layer %s was cached by another build",
+                                   key)
+                    break
+
+                try:
+                    os.rename(metadata, os.path.join(self.customize_layer_dir,
+                                                     key + ".json"))
+                except OSError:
+                    # without its metadata, nobody uses the layer
+                    os.unlink(cached)
+                    raise
+
+                if index + 1 < len(built):
+                    # the layer above still refers to this one by the name
+                    # of this run
+                    oz.ozutil.subprocess_run(["qemu-img", "rebase", "-u",
+                                              "-F", "qcow2", "-b", cached,
+                                              built[index + 1][1]],
+                                             printfn=self.log.debug)
+        except (OSError, oz.ozutil.SubprocessException) as err:
+            self.log.warning("Could not cache the customization layers: %s",
+                             err)
+        finally:
+            for key, layer, metadata in built:
+                for path in [layer, metadata]:
+                    if os.access(path, os.F_OK):
+                        os.unlink(path)
+
+    def _layered_customize(self, libvirt_xml, action):
+        """
+        Internal method to customize the operating system using the cache of
+        customization layers.  The longest prefix of the customization stages
+        that is already cached is reused, and only the remaining stages are
+        run in the guest.  A disk snapshot is taken after each of those, so
+        that they are cached for the next time.  Finally, the layers are
+        flattened into the diskimage.
+        """
+        oz.ozutil.mkdir_p(self.customize_layer_dir)
+
+        backing = self.jeos_filename
+        state = None
+        todo = []
+        for name, method, key in self._customize_layer_keys():
+            layer = os.path.join(self.customize_layer_dir, key + ".qcow2")
+            metadata = os.path.join(self.customize_layer_dir, key + ".json")
+            if todo or not os.access(layer, os.F_OK) or not os.access(metadata, os.F_OK):
+                todo.append((name, method, key))
+                continue
+
+            self.log.info("Using cached customization layer for %s (%s)",
+                          name, key)
+            with open(metadata, 'r') as f:
+                state = json.load(f)
+            backing = layer
+
+        top = os.path.join(self.customize_layer_dir,
+                           "%s-%s.qcow2" % (self.tdl.name, self.uuid))
+        # builds of the same TDL may run at the same time, so the layers are
+        # built under names of their own, and only go into the cache once
+        # the guest is done with them (see _publish_customize_layers())
+        overlays = [os.path.join(self.customize_layer_dir,
+                                 "%s-%s.qcow2" % (t[2], self.uuid)) for t in todo] + [top]
+
+        current = overlays[0]
+        built = []
+        icicle = None
+        try:
+            self._internal_generate_diskimage(force=True,
+                                              backing_filename=backing,
+                                              image_filename=current)
+            current_xml = self._modify_libvirt_xml_diskimage(libvirt_xml,
+                                                             current, 'qcow2')
+
+            if state is None:
+                if self.customize_transport == "ssh":
+                    self._collect_setup(current_xml)
+                state = {'uuid':str(self.uuid), 'attrs':{}}
+                for attr in self.collect_state_attrs:
+                    if hasattr(self, attr):
+                        state['attrs'][attr] = getattr(self, attr)
+            else:
+                # the guest in the cached layer was setup by an earlier run;
+                # pick up where that one left off
+                for attr, value in state['attrs'].items():
+                    setattr(self, attr, value)
+
+            libvirt_dom = self.libvirt_conn.createXML(current_xml, 0)
+
+            try:
+                guestaddr = None
+                guestaddr = self._wait_for_guest(libvirt_dom, state['uuid'])
+
+                if self._use_package_cache():
+                    self._mount_package_cache(guestaddr)
+                try:
+                    for index, (name, method, key) in enumerate(todo):
+                        self.log.info("Customizing %s", name)
+                        method(guestaddr)
+                        self.guest_execute_command(guestaddr, 'sync')
+
+                        self._snapshot_customize_layer(libvirt_dom,
+                                                       overlays[index + 1])
+                        current = overlays[index + 1]
+
+                        metadata = os.path.join(self.customize_layer_dir,
+                                                "%s-%s.json" % (key, self.uuid))
+                        with open(metadata, 'w') as f:
+                            json.dump(state, f)
+                        built.append((key, overlays[index], metadata))
+                finally:
+                    self._umount_package_cache(guestaddr)
+
+                self.log.debug("Removing non-persisted repos")
+                self._remove_repos(guestaddr)
+
+                self.log.debug("Syncing")
+                self.guest_execute_command(guestaddr, 'sync')
+
+                if action == "gen_and_mod":
+                    icicle = self.do_icicle(guestaddr)
+
+                if self.customize_transport == "agent":
+                    self._agent_cleanup(guestaddr)
+            finally:
+                self._shutdown_guest(guestaddr, libvirt_dom)
+
+            if self.customize_transport == "ssh":
+                self._collect_teardown(self._modify_libvirt_xml_diskimage(libvirt_xml,
+                                                                          top,
+                                                                          'qcow2'))
+
+            self.log.info("Flattening customization layers into %s",
+                          self.diskimage)
+            flattened = self.diskimage + ".flatten"
+            oz.ozutil.subprocess_run(["qemu-img", "convert",
+                                      "-O", self.image_type,
+                                      top, flattened],
+                                     printfn=self.log.debug)
+            os.rename(flattened, self.diskimage)
+            self.diskimage_is_jeos = False
+            self.record_checkpoint("customize")
+        finally:
+            # the diskimage itself is only touched once everything succeeded,
+            # so on failure the only thing to clean up is the unfinished layer
+            # (which has no metadata) and the top overlay.  The layers that
+            # were finished are cached either way
+            if current != top and os.access(current, os.F_OK):
+                os.unlink(current)
+            if os.access(top, os.F_OK):
+                os.unlink(top)
+            self._publish_customize_layers(built)
+            if os.path.isdir(self.icicle_tmp):
+                shutil.rmtree(self.icicle_tmp)
+
+        return icicle
+
     def _internal_customize(self, libvirt_xml, action):
         """
         Internal method to customize and optionally generate an ICICLE for the
@@ -288,6 +1228,44 @@ class LinuxCDGuest(oz.Guest.CDGuest):
         # necessary when doing an oz-customize since the serial port might
         # not match what is specified in the libvirt XML
         modified_xml = self._modify_libvirt_xml_for_serial(libvirt_xml)
+        if self.customize_transport == "agent":
+            modified_xml = self._modify_libvirt_xml_for_agent(modified_xml)
+        # kept to drop the package cache share again if it turns out that
+        # the guest only has to be booted to generate the ICICLE
+        uncached_xml = modified_xml
+        if action != "gen_only" and self._use_package_cache():
+            modified_xml = self._modify_libvirt_xml_for_package_cache(modified_xml)
+
+        if action != "gen_only":
+            # the disk image is about to change, so any ICICLE cached for it
+            # is no longer valid
+            self._invalidate_icicle_cache(modified_xml)
+
+        if action != "gen_only" and self.customize_layers:
+            if self.diskimage_is_jeos and os.access(self.jeos_filename, os.F_OK):
+                return self._layered_customize(modified_xml, action)
+            # the layers need the cached JEOS as a plain file to use as
+            # their backing file, which is not there with the chunk store
+            self.log.debug("Disk image is not a cached JEOS file, not using customization layers")
+
+        if action != "gen_only":
+            self.diskimage_is_jeos = False
+            self._checkpoint_before_customize()
+
+            if self.customize_offline:
+                names = self._offline_customize_stage_names()
+                if ("repos" in names and self.tdl.repositories) or ("files" in names and self.tdl.files):
+                    self._customize_offline(modified_xml, names)
+                if len(names) == len(self._customize_stages()):
+                    # nothing left that needs the guest to be running
+                    self.record_checkpoint("customize")
+                    if action == "mod_only":
+                        return None
+                    action = "gen_only"
+                    modified_xml = uncached_xml
+
+        if action == "gen_only" and self.offline_icicle_gen:
+            return self.do_icicle_offline(modified_xml)
 
         if action == "gen_only" and self.safe_icicle_gen:
             # We are only generating ICICLE and the user has asked us to do
@@ -300,7 +1278,9 @@ class LinuxCDGuest(oz.Guest.CDGuest):
                                               image_filename=cow_diskimage)
             modified_xml = self._modify_libvirt_xml_diskimage(modified_xml, cow_diskimage, 'qcow2')
 
-        self._collect_setup(modified_xml)
+        # with the agent transport, the guest needs no changes to be reached
+        if self.customize_transport == "ssh":
+            self._collect_setup(modified_xml)
 
         icicle = None
         try:
@@ -308,8 +1288,7 @@ class LinuxCDGuest(oz.Guest.CDGuest):
 
             try:
                 guestaddr = None
-                guestaddr = self._wait_for_guest_boot(libvirt_dom)
-                self._test_ssh_connection(guestaddr)
+                guestaddr = self._wait_for_guest(libvirt_dom)
 
                 if action == "gen_and_mod":
                     self.do_customize(guestaddr)
@@ -320,11 +1299,16 @@ class LinuxCDGuest(oz.Guest.CDGuest):
                     self.do_customize(guestaddr)
                 else:
                     raise oz.OzException.OzException("Invalid customize action %s; this is a programming error" % (action))
+
+                if self.customize_transport == "agent" and not (action == "gen_only" and self.safe_icicle_gen):
+                    self._agent_cleanup(guestaddr)
             finally:
                 if action == "gen_only" and self.safe_icicle_gen:
                     # if this is a gen_only and safe_icicle_gen, there is no
                     # reason to wait around for the guest to shutdown; we'll
                     # be removing the overlay file anyway.  Just destroy it
+                    if guestaddr is not None and self.customize_transport == "ssh":
+                        self._close_ssh_connection(guestaddr)
                     libvirt_dom.destroy()
                 else:
                     self._shutdown_guest(guestaddr, libvirt_dom)
@@ -333,9 +1317,12 @@ class LinuxCDGuest(oz.Guest.CDGuest):
                 # no need to teardown because we simply discard the file
                 # containing those changes
                 os.unlink(cow_diskimage)
-            else:
+            elif self.customize_transport == "ssh":
                 self._collect_teardown(modified_xml)
 
+        if action != "gen_only":
+            self.record_checkpoint("customize")
+
         return icicle
 
     def customize(self, libvirt_xml):
@@ -350,7 +1337,9 @@ class LinuxCDGuest(oz.Guest.CDGuest):
         after installation.  This is equivalent to calling customize() and
         generate_icicle() back-to-back, but is faster.
         """
-        return self._internal_customize(libvirt_xml, "gen_and_mod")
+        icicle = self._internal_customize(libvirt_xml, "gen_and_mod")
+        self._write_icicle_cache(libvirt_xml, icicle)
+        return icicle
 
     def generate_icicle(self, libvirt_xml):
         """
@@ -358,4 +1347,13 @@ class LinuxCDGuest(oz.Guest.CDGuest):
         installation.  The ICICLE contains information about packages and
         other configuration on the diskimage.
         """
-        return self._internal_customize(libvirt_xml, "gen_only")
+        icicle = self._read_icicle_cache(libvirt_xml)
+        if icicle is not None:
+            self.log.info("Using the cached ICICLE")
+            return icicle
+
+        icicle = self._internal_customize(libvirt_xml, "gen_only")
+        # booting the guest to generate the ICICLE writes to the disk image,
+        # so the identity in the cache is the one from after that
+        self._write_icicle_cache(libvirt_xml, icicle)
+        return icicle
@@ -68,11 +68,11 @@ class MageiaGuest(oz.Guest.CDGuest):
         else:
             shutil.copy(self.auto, outname)
 
-        oz.ozutil.subprocess_check_output(["/sbin/mkfs.msdos", "-C",
-                                           self.output_floppy, "1440"])
-        oz.ozutil.subprocess_check_output(["mcopy", "-n", "-o", "-i",
-                                           self.output_floppy, outname,
-                                           "::AUTO_INST.CFG"])
+        oz.ozutil.subprocess_run(["/sbin/mkfs.msdos", "-C",
+                                  self.output_floppy, "1440"])
+        oz.ozutil.subprocess_run(["mcopy", "-n", "-o", "-i",
+                                  self.output_floppy, outname,
+                                  "::AUTO_INST.CFG"])
 
         self.log.debug("Modifying isolinux.cfg")
         isolinuxcfg = os.path.join(self.iso_contents, "isolinux", "isolinux.cfg")
@@ -99,15 +99,15 @@ label customiso
         isolinuxbin = os.path.join(isolinuxdir, "isolinux/isolinux.bin")
         isolinuxboot = os.path.join(isolinuxdir, "isolinux/boot.cat")
 
-        oz.ozutil.subprocess_check_output(["genisoimage", "-r", "-V", "Custom",
-                                           "-J", "-l", "-no-emul-boot",
-                                           "-b", isolinuxbin,
-                                           "-c", isolinuxboot,
-                                           "-boot-load-size", "4",
-                                           "-cache-inodes", "-boot-info-table",
-                                           "-v", "-o", self.output_iso,
-                                           self.iso_contents],
-                                          printfn=self.log.debug)
+        oz.ozutil.subprocess_run(["genisoimage", "-r", "-V", "Custom",
+                                  "-J", "-l", "-no-emul-boot",
+                                  "-b", isolinuxbin,
+                                  "-c", isolinuxboot,
+                                  "-boot-load-size", "4",
+                                  "-cache-inodes", "-boot-info-table",
+                                  "-v", "-o", self.output_iso,
+                                  self.iso_contents],
+                                 printfn=self.log.debug)
     def install(self, timeout=None, force=False):
         fddev = self._InstallDev("floppy", self.output_floppy, "fda")
         return self._do_install(timeout, force, 0, None, None, None,
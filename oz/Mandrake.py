@@ -83,15 +83,15 @@ label customiso
         Method to create a new ISO based on the modified CD/DVD.
         """
         self.log.info("Generating new ISO")
-        oz.ozutil.subprocess_check_output(["genisoimage", "-r", "-V", "Custom",
-                                           "-J", "-l", "-no-emul-boot",
-                                           "-b", "isolinux/isolinux.bin",
-                                           "-c", "isolinux/boot.cat",
-                                           "-boot-load-size", "4",
-                                           "-cache-inodes", "-boot-info-table",
-                                           "-v", "-o", self.output_iso,
-                                           self.iso_contents],
-                                          printfn=self.log.debug)
+        oz.ozutil.subprocess_run(["genisoimage", "-r", "-V", "Custom",
+                                  "-J", "-l", "-no-emul-boot",
+                                  "-b", "isolinux/isolinux.bin",
+                                  "-c", "isolinux/boot.cat",
+                                  "-boot-load-size", "4",
+                                  "-cache-inodes", "-boot-info-table",
+                                  "-v", "-o", self.output_iso,
+                                  self.iso_contents],
+                                 printfn=self.log.debug)
 
 class Mandrake82Guest(oz.Guest.CDGuest):
     """
@@ -139,28 +139,26 @@ label customiso
   append initrd=cdrom.rdz ramdisk_size=32000 root=/dev/ram3 automatic=method:cdrom vga=788 auto_install=auto_inst.cfg
 """)
         cdromimg = os.path.join(self.iso_contents, "Boot", "cdrom.img")
-        oz.ozutil.subprocess_check_output(["mcopy", "-n", "-o", "-i",
-                                           cdromimg, syslinux,
-                                           "::SYSLINUX.CFG"],
-                                          printfn=self.log.debug)
+        oz.ozutil.subprocess_run(["mcopy", "-n", "-o", "-i",
+                                  cdromimg, syslinux,
+                                  "::SYSLINUX.CFG"],
+                                 printfn=self.log.debug)
 
     def _generate_new_iso(self):
         """
         Method to create a new ISO based on the modified CD/DVD.
         """
         self.log.info("Generating new ISO")
-        oz.ozutil.subprocess_check_output(["genisoimage", "-r", "-V", "Custom",
-                                           "-J", "-cache-inodes",
-                                           "-b", "Boot/cdrom.img",
-                                           "-c", "Boot/boot.cat",
-                                           "-v", "-o", self.output_iso,
-                                           self.iso_contents],
-                                          printfn=self.log.debug)
+        oz.ozutil.subprocess_run(["genisoimage", "-r", "-V", "Custom",
+                                  "-J", "-cache-inodes",
+                                  "-b", "Boot/cdrom.img",
+                                  "-c", "Boot/boot.cat",
+                                  "-v", "-o", self.output_iso,
+                                  self.iso_contents],
+                                 printfn=self.log.debug)
 
     def install(self, timeout=None, force=False):
-        internal_timeout = timeout
-        if internal_timeout is None:
-            internal_timeout = 2500
+        internal_timeout = self._install_timeout(timeout, 2500)
         return self._do_install(internal_timeout, force, 0)
 
 def get_class(tdl, config, auto, output_disk=None, netdev=None, diskbus=None,
@@ -95,15 +95,15 @@ label customiso
         isolinuxbin = os.path.join(isolinuxdir, "isolinux/isolinux.bin")
         isolinuxboot = os.path.join(isolinuxdir, "isolinux/boot.cat")
 
-        oz.ozutil.subprocess_check_output(["genisoimage", "-r", "-V", "Custom",
-                                           "-J", "-l", "-no-emul-boot",
-                                           "-b", isolinuxbin,
-                                           "-c", isolinuxboot,
-                                           "-boot-load-size", "4",
-                                           "-cache-inodes", "-boot-info-table",
-                                           "-v", "-o", self.output_iso,
-                                           self.iso_contents],
-                                          printfn=self.log.debug)
+        oz.ozutil.subprocess_run(["genisoimage", "-r", "-V", "Custom",
+                                  "-J", "-l", "-no-emul-boot",
+                                  "-b", isolinuxbin,
+                                  "-c", isolinuxboot,
+                                  "-boot-load-size", "4",
+                                  "-cache-inodes", "-boot-info-table",
+                                  "-v", "-o", self.output_iso,
+                                  self.iso_contents],
+                                 printfn=self.log.debug)
 
 def get_class(tdl, config, auto, output_disk=None, netdev=None, diskbus=None,
               macaddress=None):
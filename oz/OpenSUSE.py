@@ -91,17 +91,17 @@ class OpenSUSEGuest(oz.Linux.LinuxCDGuest):
         Method to create a new ISO based on the modified CD/DVD.
         """
         self.log.info("Generating new ISO")
-        oz.ozutil.subprocess_check_output(["genisoimage", "-r", "-V", "Custom",
-                                           "-J", "-no-emul-boot",
-                                           "-b", "boot/" + self.tdl.arch + "/loader/isolinux.bin",
-                                           "-c", "boot/" + self.tdl.arch + "/loader/boot.cat",
-                                           "-boot-load-size", "4",
-                                           "-boot-info-table", "-graft-points",
-                                           "-iso-level", "4", "-pad",
-                                           "-allow-leading-dots", "-l", "-v",
-                                           "-o", self.output_iso,
-                                           self.iso_contents],
-                                          printfn=self.log.debug)
+        oz.ozutil.subprocess_run(["genisoimage", "-r", "-V", "Custom",
+                                  "-J", "-no-emul-boot",
+                                  "-b", "boot/" + self.tdl.arch + "/loader/isolinux.bin",
+                                  "-c", "boot/" + self.tdl.arch + "/loader/boot.cat",
+                                  "-boot-load-size", "4",
+                                  "-boot-info-table", "-graft-points",
+                                  "-iso-level", "4", "-pad",
+                                  "-allow-leading-dots", "-l", "-v",
+                                  "-o", self.output_iso,
+                                  self.iso_contents],
+                                 printfn=self.log.debug)
 
     def install(self, timeout=None, force=False):
         """
@@ -150,6 +150,9 @@ class OpenSUSEGuest(oz.Linux.LinuxCDGuest):
         self.log.debug("Removing reportip")
         self._guestfs_remove_if_exists(g_handle, '/root/reportip')
 
+        # remove the boot announcement
+        self._image_ssh_teardown_boot_announce(g_handle)
+
         # reset the service link
         self.log.debug("Resetting cron service")
         if g_handle.exists('/usr/lib/systemd/system/cron.service'):
@@ -184,6 +187,15 @@ class OpenSUSEGuest(oz.Linux.LinuxCDGuest):
         for lease in g_handle.glob_expand("/var/lib/dhcp6/*.lease"):
             g_handle.rm_f(lease)
 
+    def _agent_cleanup_files(self):
+        """
+        Method to get the list of files that _agent_cleanup() removes from
+        the guest; the same ones that _image_ssh_teardown_step_4() removes.
+        """
+        return ["/etc/ssh/ssh_host_*key", "/etc/ssh/ssh_host_*key.pub",
+                "/var/lib/dhcp/*.leases", "/var/lib/dhcp6/*.leases",
+                "/var/lib/dhcp6/*.lease"]
+
     def _collect_teardown(self, libvirt_xml):
         """
         Method to reverse the changes done in _collect_setup.
@@ -204,15 +216,12 @@ class OpenSUSEGuest(oz.Linux.LinuxCDGuest):
             self._guestfs_handle_cleanup(g_handle)
             shutil.rmtree(self.icicle_tmp)
 
-    def do_icicle(self, guestaddr):
+    def _icicle_from_commands(self, run):
         """
         Method to collect the package information and generate the ICICLE
         XML.
         """
-        self.log.debug("Generating ICICLE")
-        stdout, stderr, retcode = self.guest_execute_command(guestaddr,
-                                                             'rpm -qa',
-                                                             timeout=30)
+        stdout = run('rpm -qa')
 
         return self._output_icicle_xml(stdout.split("\n"),
                                        self.tdl.description)
@@ -312,9 +321,9 @@ fi
             f.write("""\
 #!/bin/bash
 DEV=$(/bin/awk '{if ($2 == 0) print $1}' /proc/net/route) &&
-[ -z "$DEV" ] && exit 0
+[ -z "$DEV" ] && exit 1
 ADDR=$(/sbin/ip -4 -o addr show dev $DEV | /bin/awk '{print $4}' | /usr/bin/cut -d/ -f1) &&
-[ -z "$ADDR" ] && exit 0
+[ -z "$ADDR" ] && exit 1
 echo -n "!$ADDR,%s!" > /dev/ttyS1
 """ % (self.uuid))
 
@@ -345,6 +354,8 @@ echo -n "!$ADDR,%s!" > /dev/ttyS1
             self._guestfs_path_backup(g_handle, startuplink)
             g_handle.ln_sf('/etc/init.d/cron', startuplink)
 
+        self._image_ssh_setup_boot_announce(g_handle)
+
     def _collect_setup(self, libvirt_xml):
         """
         Setup the guest for remote access.
@@ -415,6 +426,21 @@ echo -n "!$ADDR,%s!" > /dev/ttyS1
                 self.guest_execute_command(guestaddr,
                                            "zypper removerepo %s" % (repo.name))
 
+    def _customize_bundle_repos(self, bundle):
+        for repo in list(self.tdl.repositories.values()):
+            bundle.add_step("zypper addrepo %s %s" % (repo.url, repo.name))
+
+    def _customize_bundle_packages(self, bundle, packstr):
+        # the same removal of the CD repos as _install_packages, done in the
+        # guest
+        bundle.add_step("for repo in $(zypper repos -d | awk -F'|' '/^[0-9]+/ && $8 ~ /^ *cd:\\/\\// { print $1 }'); do zypper removerepo $repo; done")
+        bundle.add_step('zypper -n install %s' % (packstr))
+
+    def _customize_bundle_remove_repos(self, bundle):
+        for repo in list(self.tdl.repositories.values()):
+            if not repo.persisted:
+                bundle.add_step("zypper removerepo %s" % (repo.name))
+
 def get_class(tdl, config, auto, output_disk=None, netdev=None, diskbus=None,
               macaddress=None):
     """
@@ -94,6 +94,13 @@ class RHEL5Guest(oz.RedHat.RedHatLinuxCDYumGuest):
                 if not re.match(r"CentOS *", pvd.volume_identifier):
                     raise oz.OzException.OzException("Invalid boot.iso for SLC-5 URL install")
 
+    def _yum_supports_setopt(self):
+        """
+        Method to check whether yum in the guest has the --setopt option,
+        which it only has since RHEL-5.4.
+        """
+        return self.tdl.update not in ["GOLD", "U1", "U2", "U3"]
+
     def get_auto_path(self):
         """
         Method to create the correct path to the RHEL 5 kickstart file.
@@ -21,13 +21,13 @@ Common methods for installing and configuring RedHat-based guests
 
 import re
 import os
+import pipes
 import shutil
 try:
     import configparser
 except ImportError:
     import ConfigParser as configparser
 import gzip
-import guestfs
 
 import oz.Guest
 import oz.Linux
@@ -38,6 +38,16 @@ class RedHatLinuxCDGuest(oz.Linux.LinuxCDGuest):
     """
     Class for RedHat-based CD guests.
     """
+    # anaconda (since Fedora 14 and RHEL 6) forwards its log to this port
+    # when it exists; see http://fedoraproject.org/wiki/Anaconda/Logging
+    install_log_virtio_port = "org.fedoraproject.anaconda.log.0"
+    # a bare traceback is not enough, since anaconda survives some of them;
+    # these are printed by its handler for fatal exceptions
+    install_failure_patterns = [r"An unhandled exception has occurred",
+                                r"anaconda .* exception report",
+                                r"The following (problem occurred|error was found) .*kickstart",
+                                r"Kickstart(Parse)?Error"]
+
     def __init__(self, tdl, config, auto, output_disk, nicmodel, diskbus,
                  iso_allowed, url_allowed, initrdtype, macaddress):
         oz.Linux.LinuxCDGuest.__init__(self, tdl, config, auto, output_disk,
@@ -86,15 +96,15 @@ Subsystem	sftp	/usr/libexec/openssh/sftp-server
         Method to create a new ISO based on the modified CD/DVD.
         """
         self.log.debug("Generating new ISO")
-        oz.ozutil.subprocess_check_output(["genisoimage", "-r", "-T", "-J",
-                                           "-V", "Custom", "-no-emul-boot",
-                                           "-b", "isolinux/isolinux.bin",
-                                           "-c", "isolinux/boot.cat",
-                                           "-boot-load-size", "4",
-                                           "-boot-info-table", "-v",
-                                           "-o", self.output_iso,
-                                           self.iso_contents],
-                                          printfn=self.log.debug)
+        oz.ozutil.subprocess_run(["genisoimage", "-r", "-T", "-J",
+                                  "-V", "Custom", "-no-emul-boot",
+                                  "-b", "isolinux/isolinux.bin",
+                                  "-c", "isolinux/boot.cat",
+                                  "-boot-load-size", "4",
+                                  "-boot-info-table", "-v",
+                                  "-o", self.output_iso,
+                                  self.iso_contents],
+                                 printfn=self.log.debug)
 
     def _check_iso_tree(self, customize_or_icicle):
         kernel = os.path.join(self.iso_contents, "isolinux", "vmlinuz")
@@ -212,6 +222,9 @@ label customiso
         self.log.debug("Removing reportip")
         self._guestfs_remove_if_exists(g_handle, '/root/reportip')
 
+        # remove the boot announcement
+        self._image_ssh_teardown_boot_announce(g_handle)
+
         # reset the service link
         self.log.debug("Resetting crond service")
         if g_handle.exists('/lib/systemd/system/crond.service'):
@@ -249,6 +262,15 @@ label customiso
         for lease in g_handle.glob_expand("/var/lib/NetworkManager/*.lease"):
             g_handle.rm_f(lease)
 
+    def _agent_cleanup_files(self):
+        """
+        Method to get the list of files that _agent_cleanup() removes from
+        the guest; the same ones that _image_ssh_teardown_step_6() removes.
+        """
+        return ["/etc/ssh/ssh_host_*key", "/etc/ssh/ssh_host_*key.pub",
+                "/var/lib/dhclient/*.leases",
+                "/var/lib/NetworkManager/*.lease"]
+
     def _collect_teardown(self, libvirt_xml):
         """
         Method to reverse the changes done in _collect_setup.
@@ -361,9 +383,9 @@ fi
             f.write("""\
 #!/bin/bash
 DEV=$(/bin/awk '{if ($2 == 0) print $1}' /proc/net/route) &&
-[ -z "$DEV" ] && exit 0
+[ -z "$DEV" ] && exit 1
 ADDR=$(/sbin/ip -4 -o addr show dev $DEV | /bin/awk '{print $4}' | /bin/cut -d/ -f1) &&
-[ -z "$ADDR" ] && exit 0
+[ -z "$ADDR" ] && exit 1
 echo -n "!$ADDR,%s!" > /dev/ttyS1
 """ % (self.uuid))
 
@@ -393,6 +415,8 @@ echo -n "!$ADDR,%s!" > /dev/ttyS1
             self._guestfs_path_backup(g_handle, startuplink)
             g_handle.ln_sf('/etc/init.d/crond', startuplink)
 
+        self._image_ssh_setup_boot_announce(g_handle)
+
     def _image_ssh_setup_step_5(self, g_handle):
         """
         Fifth step for allowing remote access (set SELinux to permissive).
@@ -461,23 +485,18 @@ echo -n "!$ADDR,%s!" > /dev/ttyS1
         finally:
             self._guestfs_handle_cleanup(g_handle)
 
-    def do_icicle(self, guestaddr):
+    def _icicle_from_commands(self, run):
         """
         Method to collect the package information and generate the ICICLE
         XML.
         """
-        self.log.debug("Generating ICICLE")
-        stdout, stderr, retcode = self.guest_execute_command(guestaddr,
-                                                             'rpm -qa',
-                                                             timeout=30)
+        stdout = run('rpm -qa')
 
         package_split = stdout.split("\n")
 
         extrasplit = None
         if self.tdl.icicle_extra_cmd:
-            extrastdout, stderr, retcode = self.guest_execute_command(guestaddr,
-                                                                      self.tdl.icicle_extra_cmd,
-                                                                      timeout=30)
+            extrastdout = run(self.tdl.icicle_extra_cmd)
             extrasplit = extrastdout.split("\n")
 
             if len(package_split) != len(extrasplit):
@@ -564,18 +583,16 @@ echo -n "!$ADDR,%s!" > /dev/ttyS1
             outf.writelines(inf)
             inf.close()
 
-            g = guestfs.GuestFS()
-            g.add_drive_opts(ext2file, format='raw')
-            self.log.debug("Launching guestfs")
-            g.launch()
-
-            g.mount_options('', g.list_devices()[0], "/")
+            g, device = self.guestfs_pool.lease(ext2file, 'raw')
+            try:
+                g.mount_options('', device, "/")
 
-            g.upload(kspath, "/ks.cfg")
+                g.upload(kspath, "/ks.cfg")
 
-            g.sync()
-            g.umount_all()
-            g.kill_subprocess()
+                g.sync()
+                g.umount_all()
+            finally:
+                self.guestfs_pool.release(g)
 
             # kickstart is added, lets recompress it
             oz.ozutil.gzip_create(ext2file, self.initrdfname)
@@ -715,6 +732,16 @@ class RedHatLinuxCDYumGuest(RedHatLinuxCDGuest):
         """
         url = RedHatLinuxCDGuest._check_url(self, iso, url)
 
+        if self.tdl.installtype == 'url' and (self.tdl.mirrors or self.tdl.mirrorlist):
+            # with more than one place to install from, pick the fastest one
+            # that accepts byte ranges (see below for why that matters)
+            mirrors = self._rank_mirrors(self._mirror_candidates(url),
+                                         "images/pxeboot/vmlinuz")
+            if not mirrors:
+                raise oz.OzException.OzException("None of the mirrors of the %s install tree accepted byte ranges in time.  Please try other mirrors" % (self.tdl.distro))
+            self.log.info("Installing from mirror %s", mirrors[0])
+            return mirrors[0]
+
         if self.tdl.installtype == 'url':
             # The HTTP/1.1 specification allows for servers that don't support
             # byte ranges; if the client requests it and the server doesn't
@@ -771,40 +798,75 @@ class RedHatLinuxCDYumGuest(RedHatLinuxCDGuest):
 
         return url
 
+    def _repo_file(self, repo):
+        """
+        Method to generate the name and the contents of the repository file
+        for a repository in the TDL.
+        """
+        filename = repo.name.replace(" ", "_") + ".repo"
+        contents = "[%s]\n" % repo.name.replace(" ", "_")
+        contents += "name=%s\n" % repo.name
+        contents += "baseurl=%s\n" % repo.url
+        contents += "skip_if_unavailable=1\n"
+        contents += "enabled=1\n"
+
+        if repo.sslverify:
+            contents += "sslverify=1\n"
+        else:
+            contents += "sslverify=0\n"
+
+        if repo.signed:
+            contents += "gpgcheck=1\n"
+        else:
+            contents += "gpgcheck=0\n"
+
+        return filename, contents
+
     def _customize_repos(self, guestaddr):
         """
         Method to generate and upload custom repository files based on the TDL.
         """
         self.log.debug("Installing additional repository files")
 
+        # write all of the repository files with a single command, instead
+        # of a round trip to the guest for each of them
+        writes = []
         for repo in list(self.tdl.repositories.values()):
-            filename = repo.name.replace(" ", "_") + ".repo"
-            localname = os.path.join(self.icicle_tmp, filename)
-            with open(localname, 'w') as f:
-                f.write("[%s]\n" % repo.name.replace(" ", "_"))
-                f.write("name=%s\n" % repo.name)
-                f.write("baseurl=%s\n" % repo.url)
-                f.write("skip_if_unavailable=1\n")
-                f.write("enabled=1\n")
-
-                if repo.sslverify:
-                    f.write("sslverify=1\n")
-                else:
-                    f.write("sslverify=0\n")
+            filename, contents = self._repo_file(repo)
+            writes.append("printf '%%s' %s > %s" % (pipes.quote(contents),
+                                                   os.path.join("/etc/yum.repos.d",
+                                                                filename)))
+        if writes:
+            self.guest_execute_command(guestaddr, " && ".join(writes))
 
-                if repo.signed:
-                    f.write("gpgcheck=1\n")
-                else:
-                    f.write("gpgcheck=0\n")
+    def _yum_supports_setopt(self):
+        """
+        Method to check whether yum in the guest has the --setopt option;
+        expected to be overriden by child classes whose yum may be too old.
+        """
+        return True
 
-            try:
-                remotename = os.path.join("/etc/yum.repos.d/", filename)
-                self.guest_live_upload(guestaddr, localname, remotename)
-            finally:
-                os.unlink(localname)
+    def _yum_install(self, packstr):
+        """
+        Method to get the command that installs packages.  The options only
+        apply to this command, so they do not end up in the image: yum 3.4
+        and dnf download several packages at once (older versions of yum
+        warn about the option and go on), and the host package cache is used
+        if it is mounted.  Versions of yum without --setopt get no options.
+        """
+        options = ''
+        if self._yum_supports_setopt():
+            options = '--setopt=max_parallel_downloads=10 '
+        return 'yum -y %s%sinstall %s' % (options, self.package_cache_options,
+                                          packstr)
 
     def _install_packages(self, guestaddr, packstr):
-        self.guest_execute_command(guestaddr, 'yum -y install %s' % (packstr))
+        self.guest_execute_command(guestaddr, self._yum_install(packstr))
+
+    def _package_cache_manager_options(self, directory):
+        if not self._yum_supports_setopt():
+            return None
+        return "--setopt=cachedir=%s --setopt=keepcache=1" % (directory)
 
     def _remove_repos(self, guestaddr):
         for repo in list(self.tdl.repositories.values()):
@@ -814,6 +876,30 @@ class RedHatLinuxCDYumGuest(RedHatLinuxCDGuest):
                 self.guest_execute_command(guestaddr, "rm -f " + filename,
                                            timeout=30)
 
+    def _offline_repo_files(self):
+        files = []
+        for repo in list(self.tdl.repositories.values()):
+            filename, contents = self._repo_file(repo)
+            files.append((repo, os.path.join("/etc/yum.repos.d", filename),
+                          contents))
+        return files
+
+    def _customize_bundle_repos(self, bundle):
+        for repo in list(self.tdl.repositories.values()):
+            filename, contents = self._repo_file(repo)
+            bundle.add_data(contents, os.path.join("/etc/yum.repos.d",
+                                                   filename))
+
+    def _customize_bundle_packages(self, bundle, packstr):
+        bundle.add_step(self._yum_install(packstr))
+
+    def _customize_bundle_remove_repos(self, bundle):
+        for repo in list(self.tdl.repositories.values()):
+            if not repo.persisted:
+                filename = os.path.join("/etc/yum.repos.d",
+                                        repo.name.replace(" ", "_") + ".repo")
+                bundle.add_step("rm -f " + filename)
+
 class RedHatFDGuest(oz.Guest.FDGuest):
     """
     Class for RedHat-based floppy guests.
@@ -853,9 +939,9 @@ class RedHatFDGuest(oz.Guest.FDGuest):
         else:
             shutil.copy(self.auto, output_ks)
 
-        oz.ozutil.subprocess_check_output(["mcopy", "-i", self.output_floppy,
-                                           output_ks, "::KS.CFG"],
-                                          printfn=self.log.debug)
+        oz.ozutil.subprocess_run(["mcopy", "-i", self.output_floppy,
+                                  output_ks, "::KS.CFG"],
+                                 printfn=self.log.debug)
 
         self.log.debug("Modifying the syslinux.cfg")
 
@@ -872,15 +958,15 @@ label customboot
 
         # sometimes, syslinux.cfg on the floppy gets marked read-only.  Avoid
         # problems with the subsequent mcopy by marking it read/write.
-        oz.ozutil.subprocess_check_output(["mattrib", "-r", "-i",
-                                           self.output_floppy,
-                                           "::SYSLINUX.CFG"],
-                                          printfn=self.log.debug)
+        oz.ozutil.subprocess_run(["mattrib", "-r", "-i",
+                                  self.output_floppy,
+                                  "::SYSLINUX.CFG"],
+                                 printfn=self.log.debug)
 
-        oz.ozutil.subprocess_check_output(["mcopy", "-n", "-o", "-i",
-                                           self.output_floppy, syslinux,
-                                           "::SYSLINUX.CFG"],
-                                          printfn=self.log.debug)
+        oz.ozutil.subprocess_run(["mcopy", "-n", "-o", "-i",
+                                  self.output_floppy, syslinux,
+                                  "::SYSLINUX.CFG"],
+                                 printfn=self.log.debug)
 
     def generate_install_media(self, force_download=False,
                                customize_or_icicle=False):
@@ -894,7 +980,7 @@ label customboot
         self.log.info("Generating install media")
 
         if not force_download:
-            if os.access(self.jeos_filename, os.F_OK):
+            if self._jeos_cached():
                 # if we found a cached JEOS, we don't need to do anything here;
                 # we'll copy the JEOS itself later on
                 return
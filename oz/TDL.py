@@ -159,6 +159,10 @@ class TDL(object):
     description  - A free-form description of this TDL (optional).
     installtype  - The method to be used to install this operating system.
                    Currently this must be one of "url" or "iso".
+    mirrors      - A list of URLs of mirrors of the install URL (for "url"
+                   installs only).  This list may be empty.
+    mirrorlist   - The URL of a mirror list or metalink with more mirrors of
+                   the install URL (optional, for "url" installs only).
     packages     - A list of Package objects describing the packages to be
                    installed on the operating system.  This list may be
                    empty.
@@ -231,10 +235,18 @@ class TDL(object):
         self.iso_md5_url = None
         self.iso_sha1_url = None
         self.iso_sha256_url = None
+        self.iso_metalink_url = None
+        self.mirrors = []
+        self.mirrorlist = None
 
         if self.installtype == "url":
             self.url = _xml_get_value(self.doc, '/template/os/install/url',
                                       'OS install URL')
+            self.mirrors = [mirror.text for mirror in self.doc.xpath('/template/os/install/mirror')]
+            self.mirrorlist = _xml_get_value(self.doc,
+                                             '/template/os/install/mirrorlist',
+                                             'OS install mirror list',
+                                             optional=True)
         elif self.installtype == "iso":
             self.iso = _xml_get_value(self.doc, '/template/os/install/iso',
                                       'OS install ISO')
@@ -250,10 +262,16 @@ class TDL(object):
                                                  '/template/os/install/sha256sum',
                                                  'OS install ISO SHA256SUM',
                                                  optional=True)
-            # only one of md5, sha1, or sha256 can be specified; raise an error
-            # if multiple are
-            if (self.iso_md5_url and self.iso_sha1_url) or (self.iso_md5_url and self.iso_sha256_url) or (self.iso_sha1_url and self.iso_sha256_url):
-                raise oz.OzException.OzException("Only one of <md5sum>, <sha1sum>, and <sha256sum> can be specified")
+            self.iso_metalink_url = _xml_get_value(self.doc,
+                                                   '/template/os/install/metalink',
+                                                   'OS install ISO metalink',
+                                                   optional=True)
+            # only one of md5, sha1, sha256, or metalink can be specified;
+            # raise an error if multiple are
+            if len([csum for csum in [self.iso_md5_url, self.iso_sha1_url,
+                                      self.iso_sha256_url,
+                                      self.iso_metalink_url] if csum]) > 1:
+                raise oz.OzException.OzException("Only one of <md5sum>, <sha1sum>, <sha256sum>, and <metalink> can be specified")
         else:
             raise oz.OzException.OzException("Unknown install type " + self.installtype + " in TDL")
 
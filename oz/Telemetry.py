@@ -0,0 +1,156 @@
+# Copyright (C) 2026  agent <agent@local>
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation;
+# version 2.1 of the License.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""
+Recording and summarizing of install activity telemetry
+"""
+
+import json
+import time
+
+import oz.OzException
+
+# the counters in every sample; all of them only ever go up while a domain
+# is running
+COUNTERS = ["rd_req", "rd_bytes", "wr_req", "wr_bytes", "rx_bytes",
+            "tx_bytes", "cpu_time"]
+
+class Recorder(object):
+    """
+    Class to record the activity of the domains of a build as a time series.
+    The file has one JSON object per line; "phase" records start a new
+    domain (for instance, each boot of a multi-stage install), "sample"
+    records hold the counters of the domain at a point in time, and "end"
+    records say how the phase ended.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.phase = 0
+        # start the time series of a new build
+        open(self.filename, 'w').close()
+
+    def _write(self, record):
+        """
+        Internal method to append a record to the file.
+        """
+        record['time'] = time.time()
+        with open(self.filename, 'a') as f:
+            f.write(json.dumps(record) + "\n")
+
+    def start_phase(self, name):
+        """
+        Method to record the start of a new phase of the build.
+        """
+        self.phase += 1
+        self._write({'type':'phase', 'phase':self.phase, 'name':name})
+
+    def sample(self, stats):
+        """
+        Method to record the counters of the current phase.
+        """
+        record = {'type':'sample', 'phase':self.phase}
+        for counter in COUNTERS:
+            record[counter] = stats[counter]
+        self._write(record)
+
+    def end_phase(self, result):
+        """
+        Method to record how the current phase ended.
+        """
+        self._write({'type':'end', 'phase':self.phase, 'result':result})
+
+def read_phases(filename):
+    """
+    Function to read a telemetry file.  Returns a list of dictionaries, one
+    per phase, with the keys 'phase', 'name', 'start', 'end', 'result', and
+    'samples' (the list of sample records, in order).
+    """
+    phases = []
+    with open(filename, 'r') as f:
+        for lineno, line in enumerate(f):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                raise oz.OzException.OzException("Invalid telemetry record on line %d of %s" % (lineno + 1, filename))
+
+            if record['type'] == 'phase':
+                phases.append({'phase':record['phase'], 'name':record['name'],
+                               'start':record['time'], 'end':None,
+                               'result':None, 'samples':[]})
+            elif not phases:
+                raise oz.OzException.OzException("Telemetry record on line %d of %s is outside of a phase" % (lineno + 1, filename))
+            elif record['type'] == 'sample':
+                phases[-1]['samples'].append(record)
+            elif record['type'] == 'end':
+                phases[-1]['end'] = record['time']
+                phases[-1]['result'] = record['result']
+
+    return phases
+
+def summarize_phase(phase, min_gap=30):
+    """
+    Function to summarize a phase read by read_phases().  Returns a
+    dictionary with the duration of the phase, the totals of the counters,
+    the peak rates of the byte counters (per second, between two samples),
+    and the idle gaps of at least min_gap seconds, as (offset from the
+    start of the phase, length) tuples.  A gap is idle if there were no disk
+    requests and less than 4KB per second of network traffic.
+    """
+    samples = phase['samples']
+    end = phase['end']
+    if end is None:
+        # the build was interrupted
+        end = phase['start']
+        if samples:
+            end = samples[-1]['time']
+
+    summary = {'duration':end - phase['start'], 'totals':{}, 'peaks':{},
+               'idle_gaps':[]}
+    for counter in COUNTERS:
+        summary['totals'][counter] = 0
+        if samples:
+            summary['totals'][counter] = samples[-1][counter] - samples[0][counter]
+        summary['peaks'][counter] = 0
+
+    idle_start = None
+    for prev, cur in zip(samples, samples[1:]):
+        interval = float(cur['time'] - prev['time'])
+        if interval <= 0:
+            continue
+
+        for counter in COUNTERS:
+            rate = (cur[counter] - prev[counter]) / interval
+            summary['peaks'][counter] = max(summary['peaks'][counter], rate)
+
+        disk_req = (cur['rd_req'] + cur['wr_req']) - (prev['rd_req'] + prev['wr_req'])
+        net_bytes = (cur['rx_bytes'] + cur['tx_bytes']) - (prev['rx_bytes'] + prev['tx_bytes'])
+        if disk_req == 0 and net_bytes < 4096 * interval:
+            if idle_start is None:
+                idle_start = prev['time']
+        elif idle_start is not None:
+            if prev['time'] - idle_start >= min_gap:
+                summary['idle_gaps'].append((idle_start - phase['start'],
+                                             prev['time'] - idle_start))
+            idle_start = None
+
+    if idle_start is not None and samples and samples[-1]['time'] - idle_start >= min_gap:
+        summary['idle_gaps'].append((idle_start - phase['start'],
+                                     samples[-1]['time'] - idle_start))
+
+    return summary
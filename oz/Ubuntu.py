@@ -25,6 +25,7 @@ import os
 import gzip
 
 import oz.Linux
+import oz.Debian
 import oz.ozutil
 import oz.OzException
 
@@ -32,6 +33,11 @@ class UbuntuGuest(oz.Linux.LinuxCDGuest):
     """
     Class for Ubuntu 5.04, 5.10, 6.06, 6.10, 7.04, 7.10, 8.04, 8.10, 9.04, 9.10, 10.04, 10.10, 11.04, 11.10, 12.04, 12.10, 13.04, 13.10, 14.04, 14.10, and 15.04 installation.
     """
+    # debian-installer failures, as seen on the serial console when the
+    # installer runs there (for instance with console=ttyS0 in the kernel
+    # parameters)
+    install_failure_patterns = oz.Debian.debian_installer_failure_patterns
+
     def __init__(self, tdl, config, auto, output_disk, initrd, nicmodel,
                  diskbus, macaddress):
         oz.Linux.LinuxCDGuest.__init__(self, tdl, config, auto, output_disk,
@@ -199,23 +205,22 @@ PROMPT 0
         Method to create a new ISO based on the modified CD/DVD.
         """
         self.log.info("Generating new ISO")
-        oz.ozutil.subprocess_check_output(["genisoimage", "-r", "-V", "Custom",
-                                           "-J", "-l", "-no-emul-boot",
-                                           "-b", "isolinux/isolinux.bin",
-                                           "-c", "isolinux/boot.cat",
-                                           "-boot-load-size", "4",
-                                           "-cache-inodes", "-boot-info-table",
-                                           "-v", "-o", self.output_iso,
-                                           self.iso_contents],
-                                          printfn=self.log.debug)
+        oz.ozutil.subprocess_run(["genisoimage", "-r", "-V", "Custom",
+                                  "-J", "-l", "-no-emul-boot",
+                                  "-b", "isolinux/isolinux.bin",
+                                  "-c", "isolinux/boot.cat",
+                                  "-boot-load-size", "4",
+                                  "-cache-inodes", "-boot-info-table",
+                                  "-v", "-o", self.output_iso,
+                                  self.iso_contents],
+                                 printfn=self.log.debug)
 
     def install(self, timeout=None, force=False):
         """
         Method to run the operating system installation.
         """
         if self.tdl.update in ["5.04", "5.10", "6.06", "6.10", "7.04"]:
-            if not timeout:
-                timeout = 3000
+            timeout = self._install_timeout(timeout, 3000)
         return self._do_install(timeout, force, self.reboots, self.kernelfname,
                                 self.initrdfname, self.cmdline)
 
@@ -277,6 +282,9 @@ PROMPT 0
         self.log.debug("Removing reportip")
         self._guestfs_remove_if_exists(g_handle, '/root/reportip')
 
+        # remove the boot announcement
+        self._image_ssh_teardown_boot_announce(g_handle)
+
         # reset the service link
         self.log.debug("Resetting cron service")
         if self.cron_startuplink:
@@ -373,11 +381,10 @@ fi
         with open(scriptfile, 'w') as f:
             f.write("""\
 #!/bin/bash
-/bin/sleep 20
 DEV=$(/usr/bin/awk '{if ($2 == 0) print $1}' /proc/net/route) &&
-[ -z "$DEV" ] && exit 0
+[ -z "$DEV" ] && exit 1
 ADDR=$(/sbin/ip -4 -o addr show dev $DEV | /usr/bin/awk '{print $4}' | /usr/bin/cut -d/ -f1) &&
-[ -z "$ADDR" ] && exit 0
+[ -z "$ADDR" ] && exit 1
 echo -n "!$ADDR,%s!" > /dev/ttyS1
 """ % (self.uuid))
 
@@ -401,6 +408,8 @@ echo -n "!$ADDR,%s!" > /dev/ttyS1
         self._guestfs_path_backup(g_handle, self.cron_startuplink)
         g_handle.ln_sf('/etc/init.d/cron', self.cron_startuplink)
 
+        self._image_ssh_setup_boot_announce(g_handle)
+
     def _collect_setup(self, libvirt_xml):
         """
         Setup the guest for remote access.
@@ -464,23 +473,66 @@ echo -n "!$ADDR,%s!" > /dev/ttyS1
 
         self.log.debug("Installing additional repository files")
 
+        if self.tdl.repositories:
+            self.guest_execute_command(guestaddr, self._add_repositories())
+
+    def _add_repositories(self):
+        """
+        Method to get the command that adds all of the repositories in the
+        TDL, and then refreshes the package indexes once.  Newer versions of
+        apt-add-repository refresh the indexes every time they are run,
+        unless told not to with --no-update, which the older versions do not
+        know about.
+        """
+        command = "n=; apt-add-repository --help 2>&1 | grep -q -- --no-update && n=--no-update"
         for repo in list(self.tdl.repositories.values()):
-            self.guest_execute_command(guestaddr, "apt-add-repository --yes '%s'" % (repo.url.strip('\'"')))
-            self.guest_execute_command(guestaddr, "apt-get update")
+            command += "; apt-add-repository --yes $n '%s' || exit 1" % (repo.url.strip('\'"'))
+        command += "; " + self._apt_get("update")
+        return command
+
+    def _apt_get(self, arguments):
+        """
+        Method to get an apt-get command line for the customization session.
+        The options only apply to this command, so they do not end up in the
+        image: apt downloads from several hosts at once and pipelines the
+        requests to each of them (in case the image turned that off), and
+        the host package cache is used if it is mounted.
+        """
+        return 'apt-get -o Acquire::Queue-Mode=host -o Acquire::http::Pipeline-Depth=10 %s%s' % (self.package_cache_options,
+                                                                                                 arguments)
 
     def _install_packages(self, guestaddr, packstr):
         self.guest_execute_command(guestaddr,
-                                   'apt-get install -y %s' % (packstr))
+                                   self._apt_get_install(packstr))
 
-    def do_icicle(self, guestaddr):
+    def _package_cache_manager_options(self, directory):
+        return "-o Dir::Cache::Archives=%s" % (directory)
+
+    def _apt_get_install(self, packstr):
+        """
+        Method to get the command that installs packages, using the host
+        package cache if it is mounted.
+        """
+        command = self._apt_get('install -y %s' % (packstr))
+        if self.package_cache_options:
+            # apt-get refuses to download into a cache directory without
+            # the partial subdirectory
+            command = 'mkdir -p /var/cache/oz-packages/partial && ' + command
+        return command
+
+    def _customize_bundle_repos(self, bundle):
+        if self.tdl.repositories:
+            bundle.add_step(self._add_repositories())
+
+    def _customize_bundle_packages(self, bundle, packstr):
+        bundle.add_step(self._apt_get_install(packstr))
+
+    def _icicle_from_commands(self, run):
         """
         Method to collect the package information and generate the ICICLE
         XML.
         """
-        self.log.debug("Generating ICICLE")
-        stdout, stderr, retcode = self.guest_execute_command(guestaddr,
-                                                             'dpkg --get-selections',
-                                                             timeout=30)
+        stdout = run('dpkg --get-selections')
 
         # the data we get back from dpkg is in the form of:
         #
@@ -638,6 +690,10 @@ echo -n "!$ADDR,%s!" > /dev/ttyS1
         # of using add-apt-repository), we can't really reliably implement this
         pass
 
+    def _customize_bundle_remove_repos(self, bundle):
+        # see _remove_repos
+        pass
+
     def generate_install_media(self, force_download=False,
                                customize_or_icicle=False):
         """
@@ -63,17 +63,17 @@ class Windows_v5(Windows):
         Method to create a new ISO based on the modified CD/DVD.
         """
         self.log.debug("Generating new ISO")
-        oz.ozutil.subprocess_check_output(["genisoimage",
-                                           "-b", "cdboot/boot.bin",
-                                           "-no-emul-boot", "-boot-load-seg",
-                                           "1984", "-boot-load-size", "4",
-                                           "-iso-level", "2", "-J", "-l", "-D",
-                                           "-N", "-joliet-long",
-                                           "-relaxed-filenames", "-v",
-                                           "-V", "Custom",
-                                           "-o", self.output_iso,
-                                           self.iso_contents],
-                                          printfn=self.log.debug)
+        oz.ozutil.subprocess_run(["genisoimage",
+                                  "-b", "cdboot/boot.bin",
+                                  "-no-emul-boot", "-boot-load-seg",
+                                  "1984", "-boot-load-size", "4",
+                                  "-iso-level", "2", "-J", "-l", "-D",
+                                  "-N", "-joliet-long",
+                                  "-relaxed-filenames", "-v",
+                                  "-V", "Custom",
+                                  "-o", self.output_iso,
+                                  self.iso_contents],
+                                 printfn=self.log.debug)
 
     def generate_diskimage(self, size=10, force=False):
         """
@@ -141,9 +141,7 @@ class Windows_v5(Windows):
         """
         Method to run the operating system installation.
         """
-        internal_timeout = timeout
-        if internal_timeout is None:
-            internal_timeout = 3600
+        internal_timeout = self._install_timeout(timeout, 3600)
         return self._do_install(internal_timeout, force, 1)
 
 class Windows_v6(Windows):
@@ -166,16 +164,16 @@ class Windows_v6(Windows):
         self.log.debug("Generating new ISO")
         # NOTE: Windows 2008 is very picky about which arguments to genisoimage
         # will generate a bootable CD, so modify these at your own risk
-        oz.ozutil.subprocess_check_output(["genisoimage",
-                                           "-b", "cdboot/boot.bin",
-                                           "-no-emul-boot", "-c", "BOOT.CAT",
-                                           "-iso-level", "2", "-J", "-l", "-D",
-                                           "-N", "-joliet-long",
-                                           "-relaxed-filenames", "-v",
-                                           "-V", "Custom", "-udf",
-                                           "-o", self.output_iso,
-                                           self.iso_contents],
-                                          printfn=self.log.debug)
+        oz.ozutil.subprocess_run(["genisoimage",
+                                  "-b", "cdboot/boot.bin",
+                                  "-no-emul-boot", "-c", "BOOT.CAT",
+                                  "-iso-level", "2", "-J", "-l", "-D",
+                                  "-N", "-joliet-long",
+                                  "-relaxed-filenames", "-v",
+                                  "-V", "Custom", "-udf",
+                                  "-o", self.output_iso,
+                                  self.iso_contents],
+                                 printfn=self.log.debug)
 
     def _modify_iso(self):
         """
@@ -226,9 +224,7 @@ class Windows_v6(Windows):
             shutil.copy(self.auto, outname)
 
     def install(self, timeout=None, force=False):
-        internal_timeout = timeout
-        if internal_timeout is None:
-            internal_timeout = 8500
+        internal_timeout = self._install_timeout(timeout, 8500)
         return self._do_install(internal_timeout, force, 2)
 
 def get_class(tdl, config, auto, output_disk=None, netdev=None, diskbus=None,
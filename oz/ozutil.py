@@ -36,7 +36,15 @@ except ImportError:
     import ConfigParser as configparser
 import collections
 import ftplib
+import re
+try:
+    import urllib.parse as urlparse
+except ImportError:
+    import urlparse
 import struct
+import hashlib
+import math
+import lxml.etree
 
 def generate_full_auto_path(relative):
     """
@@ -324,6 +332,46 @@ def get_sha256sum_from_file(sumfile, file_to_find):
     """
     return get_sum_from_file(sumfile, file_to_find, 256, "SHA256")
 
+def sha256_file(filename):
+    """
+    Function to compute the SHA256 hex digest of the contents of a file.
+    """
+    sha256 = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        while True:
+            buf = f.read(1024*1024)
+            if not buf:
+                break
+            sha256.update(buf)
+
+    return sha256.hexdigest()
+
+def percentile(values, pct):
+    """
+    Function to compute the pct percentile of a list of numbers, using the
+    nearest-rank method.
+    """
+    if not values:
+        raise Exception("Cannot compute a percentile of no values")
+    ordered = sorted(values)
+    rank = int(math.ceil(pct / 100.0 * len(ordered)))
+    return ordered[max(rank, 1) - 1]
+
+def get_meminfo(meminfo="/proc/meminfo"):
+    """
+    Function to read the memory information of the host.  Returns a
+    dictionary mapping each field to its value, in kilobytes for the sizes
+    and as a count for the numbers of huge pages.
+    """
+    info = {}
+    with open(meminfo, 'r') as f:
+        for line in f:
+            split = line.split()
+            if len(split) < 2:
+                continue
+            info[split[0].rstrip(':')] = int(split[1])
+    return info
+
 def string_to_bool(instr):
     """
     Function to take a string and determine whether it is True, Yes, False,
@@ -341,6 +389,47 @@ def string_to_bool(instr):
         return True
     return None
 
+def dpkg_get_selections(status):
+    """
+    Function to generate the same output as "dpkg --get-selections" from the
+    contents of a dpkg status file (/var/lib/dpkg/status).
+    """
+    packages = []
+    native = None
+    for stanza in status.split("\n\n"):
+        fields = {}
+        key = None
+        for line in stanza.split("\n"):
+            if line[:1] in [" ", "\t"]:
+                # continuation of the previous field
+                continue
+            if ":" not in line:
+                continue
+            key, value = line.split(":", 1)
+            fields[key] = value.strip()
+
+        if 'Package' not in fields or 'Status' not in fields:
+            continue
+        want, eflag, state = fields['Status'].split()
+        if state == "not-installed":
+            continue
+        arch = fields.get('Architecture', '')
+        if fields['Package'] == "dpkg":
+            native = arch
+        packages.append((fields['Package'], arch, want,
+                         fields.get('Multi-Arch') == "same"))
+
+    output = ''
+    for name, arch, want, same in sorted(packages):
+        # dpkg qualifies the name with the architecture for packages that
+        # can be installed for several architectures at once, and for
+        # packages of a foreign architecture
+        if same or (native is not None and arch not in [native, "all", ""]):
+            name += ":" + arch
+        output += name + "\t" * max(6 - (len(name) >> 3), 1) + want + "\n"
+
+    return output
+
 def generate_macaddress():
     """
     Function to generate a random MAC address.
@@ -358,76 +447,234 @@ class SubprocessException(Exception):
         Exception.__init__(self, msg)
         self.retcode = retcode
 
-def subprocess_check_output(*popenargs, **kwargs):
+class _OutputCapture(object):
+    """
+    Internal class to collect one output stream of a subprocess.  Up to
+    max_memory bytes are kept in memory; once a stream grows past that, all
+    of it goes to an anonymous temporary file instead.  If printfn is not
+    None, it is called with each complete line of output as it arrives.
+    """
+    def __init__(self, max_memory, printfn):
+        self.max_memory = max_memory
+        self.printfn = printfn
+        self.chunks = []
+        self.size = 0
+        self.spill = None
+        self.partial = ''
+
+    def write(self, data):
+        """
+        Method to add data to the stream.
+        """
+        if self.printfn is not None:
+            lines = (self.partial + data).split('\n')
+            self.partial = lines.pop()
+            for line in lines:
+                self.printfn(line)
+
+        if self.spill is None and self.size + len(data) > self.max_memory:
+            self.spill = tempfile.TemporaryFile()
+            self.spill.write(''.join(self.chunks))
+            self.chunks = []
+
+        if self.spill is not None:
+            self.spill.write(data)
+        else:
+            self.chunks.append(data)
+        self.size += len(data)
+
+    def close(self):
+        """
+        Method to call once the stream has ended, to pass a last line without
+        a newline to printfn.
+        """
+        if self.printfn is not None and self.partial:
+            self.printfn(self.partial)
+        self.partial = ''
+
+    def getvalue(self):
+        """
+        Method to get all of the data in the stream as a string.
+        """
+        if self.spill is None:
+            return ''.join(self.chunks)
+        self.spill.seek(0)
+        return self.spill.read()
+
+class SubprocessResult(object):
+    """
+    Class for the result of oz.ozutil.subprocess_run.  It has the command
+    that was run, its stdout and stderr, its retcode, and the number of
+    seconds it took in elapsed.
+    """
+    def __init__(self, cmd, stdout, stderr, retcode, elapsed):
+        self.cmd = cmd
+        self._stdout = stdout
+        self._stderr = stderr
+        self.retcode = retcode
+        self.elapsed = elapsed
+
+    @property
+    def stdout(self):
+        """
+        Property to get the standard output of the command.
+        """
+        return self._stdout.getvalue()
+
+    @property
+    def stderr(self):
+        """
+        Property to get the standard error of the command.
+        """
+        return self._stderr.getvalue()
+
+def subprocess_run(cmd, timeout=None, printfn=None, max_capture=1024*1024,
+                   check=True, **kwargs):
     """
-    Function to call a subprocess and gather the output.
+    Function to run a subprocess and gather its output.  The output is read
+    as soon as it is available, and the function returns as soon as the
+    subprocess has exited.  If printfn is not None, it is called with each
+    line of output (from either stream) as it arrives.  Up to max_capture
+    bytes of each stream are kept in memory; more than that goes to a
+    temporary file.  If timeout is not None, the subprocess is killed after
+    that many seconds.  If check is True, a SubprocessException is raised if
+    the subprocess fails or times out.  Any other keyword arguments are
+    passed to subprocess.Popen.  Returns a SubprocessResult.
     """
     if 'stdout' in kwargs:
         raise ValueError('stdout argument not allowed, it will be overridden.')
     if 'stderr' in kwargs:
         raise ValueError('stderr argument not allowed, it will be overridden.')
 
-    printfn = None
-    if kwargs.has_key('printfn'):
-        printfn = kwargs['printfn']
-        del kwargs['printfn']
+    executable_exists(cmd[0])
+
+    start = time.time()
+    deadline = None
+    if timeout is not None:
+        deadline = start + timeout
 
-    executable_exists(popenargs[0][0])
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE, **kwargs)
 
-    process = subprocess.Popen(stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                               *popenargs, **kwargs)
+    streams = {process.stdout.fileno():_OutputCapture(max_capture, printfn),
+               process.stderr.fileno():_OutputCapture(max_capture, printfn)}
+    stdout = streams[process.stdout.fileno()]
+    stderr = streams[process.stderr.fileno()]
 
     poller = select.poll()
-    select_POLLIN_POLLPRI = select.POLLIN | select.POLLPRI
-    poller.register(process.stdout.fileno(), select_POLLIN_POLLPRI)
-    poller.register(process.stderr.fileno(), select_POLLIN_POLLPRI)
-
-    stdout = ''
-    stderr = ''
-    retcode = process.poll()
-    while retcode is None:
-        start = time.time()
-        try:
-            ready = poller.poll(1000)
-        except select.error, e:
-            if e.args[0] == errno.EINTR:
-                continue
-            raise
+    for fd in streams:
+        poller.register(fd, select.POLLIN | select.POLLPRI)
 
-        for fd, mode in ready:
-            if mode & select_POLLIN_POLLPRI:
-                data = os.read(fd, 4096)
-                if not data:
-                    poller.unregister(fd)
+    timed_out = False
+    open_fds = len(streams)
+    try:
+        while open_fds > 0:
+            wait = -1
+            if deadline is not None:
+                wait = int(max(deadline - time.time(), 0) * 1000)
+            try:
+                ready = poller.poll(wait)
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            if not ready:
+                timed_out = True
+                break
+
+            for fd, mode in ready:
+                data = ''
+                if mode & (select.POLLIN | select.POLLPRI | select.POLLHUP):
+                    data = os.read(fd, 65536)
+                if data:
+                    streams[fd].write(data)
                 else:
-                    if printfn is not None:
-                        printfn(data)
-                    if fd == process.stdout.fileno():
-                        stdout += data
-                    else:
-                        stderr += data
-            else:
-                # Ignore hang up or errors.
-                poller.unregister(fd)
+                    # end of file, hang up, or error
+                    poller.unregister(fd)
+                    open_fds -= 1
 
-        end = time.time()
-        if (end - start) < 1:
-            time.sleep(1 - (end - start))
+        # the subprocess usually exits right as it closes its output, so
+        # only poll for it if there is a deadline to keep
         retcode = process.poll()
+        while retcode is None and not timed_out:
+            if deadline is None:
+                retcode = process.wait()
+            elif time.time() >= deadline:
+                timed_out = True
+            else:
+                time.sleep(0.01)
+                retcode = process.poll()
+    finally:
+        if process.poll() is None:
+            process.kill()
+        retcode = process.wait()
+        process.stdout.close()
+        process.stderr.close()
+        stdout.close()
+        stderr.close()
 
-    tmpout, tmperr = process.communicate()
+    result = SubprocessResult(cmd, stdout, stderr, retcode, time.time() - start)
 
-    stdout += tmpout
-    stderr += tmperr
-    if printfn is not None:
-        printfn(tmperr)
-        printfn(tmpout)
+    if check and timed_out:
+        raise SubprocessException("'%s' timed out after %d seconds: %s" % (' '.join(cmd), timeout, result.stderr), retcode)
+    if check and retcode:
+        raise SubprocessException("'%s' failed(%d): %s" % (' '.join(cmd), retcode, result.stderr), retcode)
 
-    if retcode:
-        cmd = ' '.join(*popenargs)
-        raise SubprocessException("'%s' failed(%d): %s" % (cmd, retcode, stderr), retcode)
+    return result
+
+def subprocess_check_output(*popenargs, **kwargs):
+    """
+    Function to call a subprocess and gather the output.  This is a wrapper
+    around subprocess_run() that returns a (stdout, stderr, retcode) tuple.
+    """
+    result = subprocess_run(*popenargs, **kwargs)
+    return (result.stdout, result.stderr, result.retcode)
 
-    return (stdout, stderr, retcode)
+def subprocess_check_output_many(cmds):
+    """
+    Function to run several subprocesses concurrently and gather their
+    output.  Returns a list of (stdout, stderr, retcode) tuples in the same
+    order as cmds.  Once all of the subprocesses have finished, a
+    SubprocessException is raised for the first one that failed.
+    """
+    for cmd in cmds:
+        executable_exists(cmd[0])
+
+    running = []
+    try:
+        for cmd in cmds:
+            # the output goes to temporary files rather than pipes so that
+            # a chatty subprocess can't block while we wait on the others
+            outfile = tempfile.TemporaryFile()
+            errfile = tempfile.TemporaryFile()
+            running.append((cmd, subprocess.Popen(cmd, stdout=outfile,
+                                                  stderr=errfile),
+                            outfile, errfile))
+    except:
+        for cmd, process, outfile, errfile in running:
+            process.kill()
+            process.wait()
+        raise
+
+    results = []
+    failed = None
+    for cmd, process, outfile, errfile in running:
+        retcode = process.wait()
+        outfile.seek(0)
+        errfile.seek(0)
+        stdout = outfile.read()
+        stderr = errfile.read()
+        outfile.close()
+        errfile.close()
+        if retcode and failed is None:
+            failed = SubprocessException("'%s' failed(%d): %s" % (' '.join(cmd), retcode, stderr), retcode)
+        results.append((stdout, stderr, retcode))
+
+    if failed is not None:
+        raise failed
+
+    return results
 
 def mkdir_p(path):
     """
@@ -835,6 +1082,387 @@ def http_download_file(url, fd, show_progress, logger):
     c.perform()
     c.close()
 
+def http_get_string(url, max_size=1024*1024):
+    """
+    Function to download a (small) file from url and return its contents as
+    a string.  Raises an exception if the download fails, or if the file is
+    bigger than max_size.
+    """
+    data = []
+    size = [0]
+    def _data(buf):
+        """
+        Function that is called back from the pycurl perform() method with
+        the body data.
+        """
+        size[0] += len(buf)
+        if size[0] > max_size:
+            # returning anything but None aborts the transfer
+            return 0
+        data.append(buf)
+
+    c = pycurl.Curl()
+    c.setopt(c.URL, url)
+    c.setopt(c.CONNECTTIMEOUT, 5)
+    c.setopt(c.WRITEFUNCTION, _data)
+    c.setopt(c.FOLLOWLOCATION, 1)
+    c.setopt(c.FAILONERROR, 1)
+    try:
+        c.perform()
+    finally:
+        c.close()
+
+    return b''.join(data)
+
+def parse_mirrorlist(data):
+    """
+    Function to get the URLs out of a mirror list.  Both plain mirror lists
+    (one URL per line, with # comments) and metalinks are understood; for a
+    metalink to a repository, the URLs of the repository itself are
+    returned, not those of its repomd.xml.  Returns the list of URLs in the
+    order that they appear.
+    """
+    if data.lstrip().startswith(b'<'):
+        urls = re.findall(br'<url\b[^>]*>\s*([^<\s]+)\s*</url>', data)
+        urls = [re.sub(br'repodata/repomd\.xml$', b'', url) for url in urls]
+    else:
+        urls = []
+        for line in data.splitlines():
+            line = line.strip()
+            if line and not line.startswith(b'#'):
+                urls.append(line)
+
+    # only keep the protocols that the installers can use
+    urls = [url for url in urls
+            if url.split(b':')[0] in [b'http', b'https', b'ftp']]
+    if str is not bytes:
+        urls = [url.decode('utf-8') for url in urls]
+    return urls
+
+def http_probe_urls(urls, timeout, sample_size):
+    """
+    Function to probe several URLs at the same time.  The first sample_size
+    bytes of each URL are requested as a byte range, and the time until the
+    first byte arrived and the download speed are measured.  The probing
+    stops after timeout seconds, whether or not all of the URLs answered.
+    Returns a dictionary mapping each URL that answered in time to a
+    dictionary with the URL it redirected to ('effective_url'), whether the
+    server honored the byte range ('ranges'), the time to the first byte in
+    seconds ('latency') and the download speed in bytes per second
+    ('speed').  URLs that failed or did not answer in time are left out.
+    """
+    class Probe(object):
+        """
+        Internal class to keep track of the download of one URL.
+        """
+        def __init__(self, url):
+            self.url = url
+            self.received = 0
+
+        def data(self, buf):
+            """
+            Function that is called back from pycurl with the body data.
+            """
+            self.received += len(buf)
+            if self.received >= sample_size:
+                # servers that ignore the range would send the whole file;
+                # stop once there is enough of a sample
+                return 0
+
+    def _result(c, probe):
+        """Return the result dictionary for the finished probe, or None."""
+        code = c.getinfo(c.RESPONSE_CODE)
+        if urlparse.urlparse(probe.url)[0] in ['http', 'https']:
+            if code not in [200, 206]:
+                return None
+            ranges = code == 206
+        else:
+            ranges = True
+        return {'effective_url':c.getinfo(c.EFFECTIVE_URL),
+                'ranges':ranges,
+                'latency':c.getinfo(c.STARTTRANSFER_TIME),
+                'speed':c.getinfo(c.SPEED_DOWNLOAD)}
+
+    multi = pycurl.CurlMulti()
+    probes = {}
+    for url in urls:
+        probe = Probe(url)
+        c = pycurl.Curl()
+        c.setopt(c.URL, url)
+        c.setopt(c.RANGE, "0-%d" % (sample_size - 1))
+        c.setopt(c.WRITEFUNCTION, probe.data)
+        c.setopt(c.FOLLOWLOCATION, 1)
+        c.setopt(c.MAXREDIRS, 5)
+        c.setopt(c.NOSIGNAL, 1)
+        probes[c] = probe
+        multi.add_handle(c)
+
+    results = {}
+    deadline = time.time() + timeout
+    try:
+        remaining = len(probes)
+        while remaining > 0 and time.time() < deadline:
+            while True:
+                ret, active = multi.perform()
+                if ret != pycurl.E_CALL_MULTI_PERFORM:
+                    break
+
+            while True:
+                queued, ok_list, err_list = multi.info_read()
+                for c in ok_list:
+                    result = _result(c, probes[c])
+                    if result is not None:
+                        results[probes[c].url] = result
+                for c, errno_, errmsg in err_list:
+                    # an aborted sample is a complete one
+                    if errno_ == pycurl.E_WRITE_ERROR and probes[c].received >= sample_size:
+                        result = _result(c, probes[c])
+                        if result is not None:
+                            results[probes[c].url] = result
+                remaining -= len(ok_list) + len(err_list)
+                if queued == 0:
+                    break
+
+            if remaining > 0:
+                multi.select(max(0.01, min(1.0, deadline - time.time())))
+    finally:
+        for c in probes:
+            multi.remove_handle(c)
+            c.close()
+        multi.close()
+
+    return results
+
+# the hashes that metalinks may use, strongest first, by their IANA names
+METALINK_HASHES = [('sha-512', 'sha512'), ('sha-384', 'sha384'),
+                   ('sha-256', 'sha256'), ('sha-1', 'sha1'), ('md5', 'md5')]
+
+def _metalink_strongest(elements):
+    """
+    Internal function to pick the element with the strongest hash type that
+    we understand out of elements.  Returns a tuple of the element and the
+    hashlib name of its hash type, or (None, None) if there is no such
+    element.
+    """
+    for iananame, hashname in METALINK_HASHES:
+        for element in elements:
+            if element.get('type', '').lower() == iananame:
+                return element, hashname
+    return None, None
+
+def parse_metalink(data, filename=None):
+    """
+    Function to parse a metalink 4 (RFC 5854) document.  If the metalink
+    describes more than one file, the one called filename is used.  Returns
+    a dictionary with the 'size' of the file (None if the metalink does not
+    say), the strongest whole-file 'hash' as a tuple of the hashlib name and
+    the hex digest (or None), the strongest piece hashes as 'pieces', a tuple
+    of the hashlib name, the piece length and the list of hex digests (or
+    None), and the 'urls' of the file, most preferred first.
+    """
+    try:
+        doc = lxml.etree.fromstring(data)
+    except lxml.etree.XMLSyntaxError as err:
+        raise Exception("Invalid metalink: %s" % (err))
+
+    ns = {'ml':'urn:ietf:params:xml:ns:metalink'}
+    files = doc.xpath('/ml:metalink/ml:file', namespaces=ns)
+    named = [f for f in files if f.get('name') == filename]
+    if named:
+        metafile = named[0]
+    elif len(files) == 1:
+        metafile = files[0]
+    else:
+        raise Exception("Could not find %s in the metalink" % (filename))
+
+    size = metafile.xpath('ml:size', namespaces=ns)
+    if size:
+        size = int(size[0].text.strip())
+    else:
+        size = None
+
+    element, hashname = _metalink_strongest(metafile.xpath('ml:hash',
+                                                           namespaces=ns))
+    filehash = None
+    if element is not None:
+        filehash = (hashname, element.text.strip().lower())
+
+    element, hashname = _metalink_strongest(metafile.xpath('ml:pieces',
+                                                           namespaces=ns))
+    pieces = None
+    if element is not None:
+        pieces = (hashname, int(element.get('length')),
+                  [piece.text.strip().lower() for piece in element.xpath('ml:hash', namespaces=ns)])
+
+    # priority 1 is the most preferred; URLs without one come last.  Only
+    # keep the protocols that we can download from
+    urls = []
+    for url in metafile.xpath('ml:url', namespaces=ns):
+        urls.append((int(url.get('priority', 1000000)), url.text.strip()))
+    urls = [url for priority, url in sorted(urls, key=lambda url: url[0])
+            if url.split(':')[0] in ['http', 'https', 'ftp', 'file']]
+
+    return {'size':size, 'hash':filehash, 'pieces':pieces, 'urls':urls}
+
+def find_bad_pieces(fd, size, piece_length, piece_hashes, hashname):
+    """
+    Function to check the file open at fd, of size bytes, piece by piece
+    against the hex digests in piece_hashes.  Returns the indices of the
+    pieces that do not match.
+    """
+    bad = []
+    os.lseek(fd, 0, os.SEEK_SET)
+    for index, piece_hash in enumerate(piece_hashes):
+        remaining = min(piece_length, size - index * piece_length)
+        piece_sum = getattr(hashlib, hashname)()
+        while remaining > 0:
+            buf = read_bytes_from_fd(fd, min(remaining, 1024*1024))
+            if len(buf) == 0:
+                break
+            piece_sum.update(buf)
+            remaining -= len(buf)
+        if remaining > 0 or piece_sum.hexdigest() != piece_hash:
+            bad.append(index)
+
+    return bad
+
+def http_download_pieces(urls, fd, size, piece_length, pieces, max_connections,
+                         logger, piece_hashes=None, hashname=None):
+    """
+    Function to download a file of size bytes from several mirrors at the
+    same time to file descriptor fd.  The file is split into pieces of
+    piece_length bytes, and only the pieces whose indices are in pieces are
+    downloaded, each with a byte range request to one of the URLs in urls.
+    Up to max_connections pieces are downloaded at once, spread over the
+    mirrors; the mirrors earlier in urls are preferred.  If piece_hashes is
+    given, each piece is checked against its hex digest when it arrives, and
+    a piece that does not match is downloaded again from another mirror.  A
+    mirror that fails 3 times in a row is not used again.  Raises an
+    exception if a piece could not be downloaded from any of the mirrors
+    (after trying each of them twice).
+    """
+    class Transfer(object):
+        """
+        Internal class to collect the data of one piece.
+        """
+        def __init__(self, index, url):
+            self.index = index
+            self.url = url
+            self.offset = index * piece_length
+            self.length = min(piece_length, size - self.offset)
+            self.data = []
+            self.received = 0
+
+        def write(self, buf):
+            """
+            Function that is called back from pycurl with the body data.
+            """
+            self.received += len(buf)
+            if self.received > self.length:
+                # the server did not honor the range; abort the transfer
+                return 0
+            self.data.append(buf)
+
+    alive = list(urls)
+    active = dict([(url, 0) for url in urls])
+    failures = dict([(url, 0) for url in urls])
+    piece_failures = collections.defaultdict(dict)
+    queue = collections.deque(pieces)
+    transfers = {}
+    state = {'done':0, 'last_pct':-1}
+
+    def _start(index):
+        """Start downloading piece index from the best mirror for it."""
+        # prefer the mirrors that did not fail this piece yet, then the
+        # least busy ones
+        url = None
+        if alive:
+            url = min(alive, key=lambda url: (piece_failures[index].get(url, 0),
+                                              active[url], urls.index(url)))
+        if url is None or piece_failures[index].get(url, 0) >= 2:
+            raise Exception("Could not download piece %d from any of the mirrors" % (index))
+        transfer = Transfer(index, url)
+        c = pycurl.Curl()
+        c.setopt(c.URL, url)
+        c.setopt(c.RANGE, "%d-%d" % (transfer.offset,
+                                     transfer.offset + transfer.length - 1))
+        c.setopt(c.WRITEFUNCTION, transfer.write)
+        c.setopt(c.FOLLOWLOCATION, 1)
+        c.setopt(c.CONNECTTIMEOUT, 5)
+        # give up on a mirror that stalls, rather than waiting forever
+        c.setopt(c.LOW_SPEED_LIMIT, 1024)
+        c.setopt(c.LOW_SPEED_TIME, 30)
+        c.setopt(c.NOSIGNAL, 1)
+        transfers[c] = transfer
+        active[url] += 1
+        multi.add_handle(c)
+
+    def _finish(c, error):
+        """Check and write out the piece of finished transfer c."""
+        transfer = transfers.pop(c)
+        multi.remove_handle(c)
+        code = c.getinfo(c.RESPONSE_CODE)
+        c.close()
+        active[transfer.url] -= 1
+
+        data = b''.join(transfer.data)
+        if error is None and urlparse.urlparse(transfer.url)[0] in ['http', 'https'] and code != 206:
+            error = "HTTP code %d" % (code)
+        if error is None and len(data) != transfer.length:
+            error = "received %d of %d bytes" % (len(data), transfer.length)
+        if error is None and piece_hashes is not None:
+            if getattr(hashlib, hashname)(data).hexdigest() != piece_hashes[transfer.index]:
+                error = "checksum mismatch"
+
+        if error is not None:
+            logger.debug("Piece %d from %s failed: %s", transfer.index,
+                         transfer.url, error)
+            failures[transfer.url] += 1
+            piece_failures[transfer.index][transfer.url] = piece_failures[transfer.index].get(transfer.url, 0) + 1
+            if failures[transfer.url] >= 3 and transfer.url in alive:
+                logger.warning("Giving up on mirror %s", transfer.url)
+                alive.remove(transfer.url)
+            queue.append(transfer.index)
+            return
+
+        failures[transfer.url] = 0
+        os.lseek(fd, transfer.offset, os.SEEK_SET)
+        write_bytes_to_fd(fd, data)
+
+        state['done'] += 1
+        pct = state['done'] * 10 // len(pieces)
+        if pct > state['last_pct']:
+            state['last_pct'] = pct
+            logger.debug("%d of %d pieces", state['done'], len(pieces))
+
+    multi = pycurl.CurlMulti()
+    try:
+        while queue or transfers:
+            while queue and len(transfers) < max_connections:
+                _start(queue.popleft())
+
+            while True:
+                ret, num_handles = multi.perform()
+                if ret != pycurl.E_CALL_MULTI_PERFORM:
+                    break
+
+            while True:
+                queued, ok_list, err_list = multi.info_read()
+                for c in ok_list:
+                    _finish(c, None)
+                for c, errno_, errmsg in err_list:
+                    _finish(c, errmsg)
+                if queued == 0:
+                    break
+
+            if transfers:
+                multi.select(1.0)
+    finally:
+        for c in transfers:
+            multi.remove_handle(c)
+            c.close()
+        multi.close()
+
 def ftp_download_directory(server, username, password, basepath, destination):
     """
     Function to recursively download an entire directory structure over FTP.
@@ -8,7 +8,9 @@ RELEASE = '0'
 
 datafiles = [('share/man/man1', ['man/oz-install.1', 'man/oz-generate-icicle.1',
                                  'man/oz-customize.1', 'man/oz-examples.1',
-                                 'man/oz-cleanup-cache.1'])
+                                 'man/oz-cleanup-cache.1',
+                                 'man/oz-chunk-store.1',
+                                 'man/oz-telemetry.1'])
              ]
 
 class sdist(_sdist):
@@ -67,7 +69,7 @@ setup(name='oz',
       package_data={'oz': ['auto/*', '*.rng']},
       packages=['oz'],
       scripts=['oz-install', 'oz-generate-icicle', 'oz-customize',
-               'oz-cleanup-cache'],
+               'oz-cleanup-cache', 'oz-chunk-store', 'oz-telemetry'],
       cmdclass={'sdist': sdist,
                 'test' : pytest },
       data_files = datafiles,
@@ -0,0 +1,73 @@
+#!/usr/bin/python
+
+import sys
+import os
+
+try:
+    import py.test
+except ImportError:
+    print('Unable to import py.test.  Is py.test installed?')
+    sys.exit(1)
+
+# Find oz
+prefix = '.'
+for i in range(0,3):
+    if os.path.isdir(os.path.join(prefix, 'oz')):
+        sys.path.insert(0, prefix)
+        break
+    else:
+        prefix = '../' + prefix
+
+try:
+    import oz.ChunkStore
+    import oz.OzException
+except ImportError:
+    print('Unable to import oz.  Is oz installed?')
+    sys.exit(1)
+
+def write_image(filename, blocks):
+    f = open(filename, 'w')
+    for block in blocks:
+        f.write(block*4096)
+    f.close()
+
+def test_check_in_materialize(tmpdir):
+    store = oz.ChunkStore.ChunkStore(os.path.join(str(tmpdir), 'store'), 4096)
+
+    src = os.path.join(str(tmpdir), 'src')
+    write_image(src, ['a', '\0', 'b', 'a'])
+
+    new, total = store.check_in(src, 'jeos/src')
+    # the chunk of zeros is not stored, and the second 'a' chunk is a duplicate
+    assert (new, total) == (2, 3)
+    assert store.list_images() == ['jeos/src']
+
+    dst = os.path.join(str(tmpdir), 'dst')
+    store.materialize('jeos/src', dst)
+    assert open(dst).read() == open(src).read()
+
+def test_check_in_dedup(tmpdir):
+    store = oz.ChunkStore.ChunkStore(os.path.join(str(tmpdir), 'store'), 4096)
+
+    first = os.path.join(str(tmpdir), 'first')
+    write_image(first, ['a', 'b', 'c'])
+    second = os.path.join(str(tmpdir), 'second')
+    write_image(second, ['a', 'b', 'd'])
+
+    store.check_in(first, 'first')
+    assert store.check_in(second, 'second') == (1, 3)
+
+    store.remove('first')
+    assert store.garbage_collect() == 1
+
+def test_materialize_missing(tmpdir):
+    store = oz.ChunkStore.ChunkStore(os.path.join(str(tmpdir), 'store'), 4096)
+
+    with py.test.raises(oz.OzException.OzException):
+        store.materialize('missing', os.path.join(str(tmpdir), 'dst'))
+
+def test_invalid_name(tmpdir):
+    store = oz.ChunkStore.ChunkStore(os.path.join(str(tmpdir), 'store'), 4096)
+
+    with py.test.raises(oz.OzException.OzException):
+        store.contains('../outside')
@@ -0,0 +1,78 @@
+#!/usr/bin/python
+
+import sys
+import os
+import tarfile
+import subprocess
+
+try:
+    import py.test
+except ImportError:
+    print('Unable to import py.test.  Is py.test installed?')
+    sys.exit(1)
+
+# Find oz
+prefix = '.'
+for i in range(0,3):
+    if os.path.isdir(os.path.join(prefix, 'oz')):
+        sys.path.insert(0, prefix)
+        break
+    else:
+        prefix = '../' + prefix
+
+try:
+    import oz.CustomizeBundle
+    import oz.ozutil
+except ImportError:
+    print('Unable to import oz.  Is oz installed?')
+    sys.exit(1)
+
+def run_bundle(tmpdir, bundle):
+    # run the bundle locally the same way the guest would
+    archive = os.path.join(str(tmpdir), 'bundle.tar')
+    with open(archive, 'wb') as f:
+        bundle.write(f)
+    workdir = os.path.join(str(tmpdir), 'work')
+    os.mkdir(workdir)
+    tarfile.open(archive).extractall(workdir)
+    process = subprocess.Popen([os.path.join(workdir, 'run.sh')],
+                               stdout=subprocess.PIPE)
+    stdout = process.communicate()[0]
+    assert process.returncode == 0
+    return bundle.parse_report(stdout)
+
+def test_bundle_run(tmpdir):
+    src = os.path.join(str(tmpdir), 'src')
+    with open(src, 'w') as f:
+        f.write('file contents\n')
+    dest = os.path.join(str(tmpdir), 'dest dir', 'file')
+
+    bundle = oz.CustomizeBundle.CustomizeBundle()
+    bundle.add_file(src, dest)
+    bundle.add_data('data contents', dest + '.data')
+    bundle.add_step('echo out; echo err >&2')
+
+    results = run_bundle(tmpdir, bundle)
+    assert len(results) == 3
+    assert open(dest).read() == 'file contents\n'
+    assert open(dest + '.data').read() == 'data contents'
+    assert results[2].stdout == 'out\n'
+    assert results[2].stderr == 'err\n'
+    for result in results:
+        assert result.retcode == 0
+        assert result.elapsed >= 0
+        result.check()
+
+def test_bundle_failure(tmpdir):
+    bundle = oz.CustomizeBundle.CustomizeBundle()
+    bundle.add_step('true')
+    bundle.add_step('echo broken >&2; exit 3')
+    bundle.add_step('touch %s' % (os.path.join(str(tmpdir), 'notrun')))
+
+    results = run_bundle(tmpdir, bundle)
+    assert len(results) == 2
+    assert results[1].retcode == 3
+    assert not os.path.exists(os.path.join(str(tmpdir), 'notrun'))
+    assert results[1].stderr == 'broken\n'
+    with py.test.raises(oz.ozutil.SubprocessException):
+        results[1].check()
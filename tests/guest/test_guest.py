@@ -380,3 +380,468 @@ def test_geteltorito_bogus_bootp(tmpdir):
 
     with py.test.raises(Exception):
         guest._geteltorito(src, dst)
+
+def test_install_disk_driver_settings():
+    tdl = oz.TDL.TDL(tdlxml)
+
+    config = configparser.SafeConfigParser()
+    config.readfp(BytesIO("[libvirt]\nuri=qemu:///session\nbridge_name=%s\ninstall_disk_cache=unsafe\ninstall_disk_discard=unmap" % route))
+
+    guest = oz.GuestFactory.guest_factory(tdl, config, None)
+
+    install_xml = guest._generate_xml("hd", None, install=True)
+    assert "cache=\"unsafe\"" in install_xml
+    assert "discard=\"unmap\"" in install_xml
+
+    final_xml = guest._generate_xml("hd", None)
+    assert "cache=" not in final_xml
+    assert "discard=" not in final_xml
+
+def test_install_profile():
+    tdl = oz.TDL.TDL(tdlxml)
+
+    config = configparser.SafeConfigParser()
+    config.readfp(BytesIO("[libvirt]\nuri=qemu:///session\nbridge_name=%s\ninstall_profile=fast\ninstall_headless=yes" % route))
+
+    guest = oz.GuestFactory.guest_factory(tdl, config, None, netdev='rtl8139',
+                                          diskbus='ide')
+
+    # the Fedora installer can use virtio-net, but the disk stays on ide
+    install_xml = guest._generate_xml("hd", None, install=True)
+    assert "<model type=\"virtio\"/>" in install_xml
+    assert "bus=\"ide\"" in install_xml
+    assert "<graphics" not in install_xml
+    assert "<input" not in install_xml
+
+    final_xml = guest._generate_xml("hd", None)
+    assert "<model type=\"rtl8139\"/>" in final_xml
+    assert "host-passthrough" not in final_xml
+    assert "<graphics" in final_xml
+    assert "<vcpu>1</vcpu>" in final_xml
+
+def test_invalid_install_profile():
+    tdl = oz.TDL.TDL(tdlxml)
+
+    config = configparser.SafeConfigParser()
+    config.readfp(BytesIO("[libvirt]\nuri=qemu:///session\nbridge_name=%s\ninstall_profile=bogus" % route))
+
+    with py.test.raises(oz.OzException.OzException):
+        oz.GuestFactory.guest_factory(tdl, config, None)
+
+def test_invalid_image_preallocation():
+    tdl = oz.TDL.TDL(tdlxml)
+
+    config = configparser.SafeConfigParser()
+    config.readfp(BytesIO("[libvirt]\nuri=qemu:///session\nbridge_name=%s\nimage_preallocation=bogus" % route))
+
+    with py.test.raises(oz.OzException.OzException):
+        oz.GuestFactory.guest_factory(tdl, config, None)
+
+def test_export_filename():
+    tdl = oz.TDL.TDL(tdlxml)
+
+    config = configparser.SafeConfigParser()
+    config.readfp(BytesIO("[libvirt]\nuri=qemu:///session\nbridge_name=%s" % route))
+
+    guest = oz.GuestFactory.guest_factory(tdl, config, None)
+
+    base = os.path.splitext(guest.diskimage)[0]
+    assert guest._export_filename("qcow2") == base + "-compressed.qcow2"
+    assert guest._export_filename("tar") == base + ".tar"
+    assert guest._export_filename("zst") == base + ".raw.zst"
+    with py.test.raises(oz.OzException.OzException):
+        guest._export_filename("vmdk")
+
+def test_customize_layer_keys(tmpdir):
+    # an existing key is used as is, so no key has to be generated
+    sshprivkey = os.path.join(str(tmpdir), 'id_rsa')
+    open(sshprivkey, 'w').write('private')
+    open(sshprivkey + '.pub', 'w').write('public')
+
+    def layer_keys(command):
+        tdl = oz.TDL.TDL(tdlxml.replace("</template>", """
+  <packages>
+    <package name='httpd'/>
+  </packages>
+  <commands>
+    <command name='cmd'>%s</command>
+  </commands>
+</template>""" % (command)))
+
+        config = configparser.SafeConfigParser()
+        config.readfp(BytesIO("[paths]\ndata_dir=%s\nsshprivkey=%s\n[libvirt]\nuri=qemu:///session\nbridge_name=%s" % (str(tmpdir), sshprivkey, route)))
+
+        guest = oz.GuestFactory.guest_factory(tdl, config, None)
+        if not os.path.exists(guest.jeos_filename):
+            os.makedirs(os.path.dirname(guest.jeos_filename))
+            open(guest.jeos_filename, 'w').write('jeos')
+
+        return [(name, key) for name, method, key in guest._customize_layer_keys()]
+
+    first = layer_keys('echo first')
+    second = layer_keys('echo second')
+
+    # the empty repos and files stages do not get layers of their own
+    assert [name for name, key in first] == ["packages", "commands"]
+    assert first[0] == second[0]
+    assert first[1] != second[1]
+
+def test_checkpoints(tmpdir):
+    tdl = oz.TDL.TDL(tdlxml)
+
+    config = configparser.SafeConfigParser()
+    config.readfp(BytesIO("[libvirt]\nuri=qemu:///session\nbridge_name=%s" % route))
+
+    diskimage = os.path.join(str(tmpdir), 'tester.dsk')
+    guest = oz.GuestFactory.guest_factory(tdl, config, None, diskimage)
+    assert guest.enable_checkpoints() == []
+    guest.record_checkpoint("install", "<domain/>")
+
+    guest = oz.GuestFactory.guest_factory(tdl, config, None, diskimage)
+    assert guest.enable_checkpoints(resume=True) == ["install"]
+    assert guest.checkpoint_data("install") == "<domain/>"
+
+    # without a copy of the diskimage, a customization that started cannot
+    # be resumed
+    open(diskimage, 'w').write('installed')
+    guest._checkpoint_before_customize()
+    guest = oz.GuestFactory.guest_factory(tdl, config, None, diskimage)
+    assert guest.enable_checkpoints(resume=True) == ["install", "customizing"]
+    with py.test.raises(oz.OzException.OzException):
+        guest._checkpoint_before_customize()
+
+    # with the copy, it starts over from there
+    config.add_section('cache')
+    config.set('cache', 'checkpoint', 'yes')
+    guest = oz.GuestFactory.guest_factory(tdl, config, None, diskimage)
+    guest.enable_checkpoints()
+    guest.record_checkpoint("install", "<domain/>")
+    guest._checkpoint_before_customize()
+    open(diskimage, 'w').write('half customized')
+    guest = oz.GuestFactory.guest_factory(tdl, config, None, diskimage)
+    guest.enable_checkpoints(resume=True)
+    guest._checkpoint_before_customize()
+    assert open(diskimage).read() == 'installed'
+
+    # a state file from a different TDL is not resumed
+    tdl = oz.TDL.TDL(tdlxml.replace("tester", "other"))
+    guest = oz.GuestFactory.guest_factory(tdl, config, None, diskimage)
+    assert guest.enable_checkpoints(resume=True) == []
+
+    guest.remove_checkpoints()
+    assert not os.path.exists(diskimage + ".ozstate")
+
+def test_learned_timeouts(tmpdir):
+    tdl = oz.TDL.TDL(tdlxml)
+
+    config = configparser.SafeConfigParser()
+    config.readfp(BytesIO("[paths]\ndata_dir=%s\n[libvirt]\nuri=qemu:///session\nbridge_name=%s\n[timeouts]\nmin_samples=3" % (str(tmpdir), route)))
+
+    guest = oz.GuestFactory.guest_factory(tdl, config, None)
+    # a timeout from the user always wins
+    assert guest._install_timeout(100, 2000) == 100
+
+    # the defaults are used until there are enough installs in the history
+    for duration, idle in [(400, 30), (600, 50)]:
+        guest.longest_install_phase = duration
+        guest.longest_install_idle = idle
+        guest._record_install_history()
+        assert guest._install_timeout(None, 2000) == 2000
+        assert guest._learned_timeout('idle', 300) == 300
+
+    guest.longest_install_phase = 500
+    guest.longest_install_idle = 40
+    guest._record_install_history()
+    assert guest._install_timeout(None, 2000) == 1200
+    assert guest._learned_timeout('idle', 300) == 100
+    assert guest._install_timeout(100, 2000) == 100
+
+    # the history is per distro, update, arch, and install type
+    tdl = oz.TDL.TDL(tdlxml.replace("<arch>x86_64</arch>", "<arch>i386</arch>"))
+    guest = oz.GuestFactory.guest_factory(tdl, config, None)
+    assert guest._install_timeout(None, 2000) == 2000
+
+def test_stream_install_log(tmpdir):
+    tdl = oz.TDL.TDL(tdlxml)
+
+    config = configparser.SafeConfigParser()
+    config.readfp(BytesIO("[libvirt]\nuri=qemu:///session\nbridge_name=%s\n[install_log]\nfailure_patterns_fedora=^fatal:" % route))
+
+    diskimage = os.path.join(str(tmpdir), 'tester.dsk')
+    guest = oz.GuestFactory.guest_factory(tdl, config, None, diskimage)
+    guest._reset_install_console()
+    assert guest._stream_install_log() is None
+
+    with open(guest.install_console, 'a') as f:
+        f.write("Starting installer\r\nRunning transaction")
+    assert guest._stream_install_log() is None
+
+    # a new boot of the install starts with a new console file
+    guest._reset_install_console()
+    with open(guest.install_console, 'a') as f:
+        f.write("Traceback (most recent call last):\n  File \"anaconda\"\n")
+    # anaconda survives some tracebacks; only its exception handler is fatal
+    assert guest._stream_install_log() is None
+
+    with open(guest.install_console, 'a') as f:
+        f.write("An unhandled exception has occurred.  This is most likely a bug.\n")
+    failure = guest._stream_install_log()
+    assert failure.endswith("An unhandled exception has occurred.  This is most likely a bug.")
+
+    assert open(guest.install_log).read() == "Starting installer\r\nRunning transactionTraceback (most recent call last):\n  File \"anaconda\"\nAn unhandled exception has occurred.  This is most likely a bug.\n"
+
+    with open(guest.install_console, 'a') as f:
+        f.write("fatal: from the config\n")
+    assert guest._stream_install_log().endswith("fatal: from the config")
+
+def test_parse_guest_announcement():
+    tdl = oz.TDL.TDL(tdlxml)
+
+    config = configparser.SafeConfigParser()
+    config.readfp(BytesIO("[libvirt]\nuri=qemu:///session\nbridge_name=%s" % route))
+
+    guest = oz.GuestFactory.guest_factory(tdl, config, None)
+    uuidstr = str(guest.uuid)
+
+    assert guest._parse_guest_announcement("", uuidstr) is None
+    assert guest._parse_guest_announcement("garbage!192.168.122.5,", uuidstr) is None
+    assert guest._parse_guest_announcement("garbage!192.168.122.5,%s!" % (uuidstr), uuidstr) == "192.168.122.5"
+    # the cron job and the boot announcement can both check in
+    assert guest._parse_guest_announcement("!192.168.122.5,%s!!192.168.122.5,%s!" % (uuidstr, uuidstr), uuidstr) == "192.168.122.5"
+
+    with py.test.raises(oz.OzException.OzException):
+        guest._parse_guest_announcement("!192.168.122.5,%s!" % (uuidstr), "other")
+    with py.test.raises(oz.OzException.OzException):
+        guest._parse_guest_announcement("!bogus,%s!" % (uuidstr), uuidstr)
+
+def test_modify_libvirt_xml_for_agent():
+    import lxml.etree
+
+    tdl = oz.TDL.TDL(tdlxml)
+
+    config = configparser.SafeConfigParser()
+    config.readfp(BytesIO("[libvirt]\nuri=qemu:///session\nbridge_name=%s\n[customize]\ntransport=agent" % route))
+
+    guest = oz.GuestFactory.guest_factory(tdl, config, None)
+    xml = guest._modify_libvirt_xml_for_agent(guest._generate_xml("hd", None))
+    doc = lxml.etree.fromstring(xml)
+    targets = doc.xpath("/domain/devices/channel/target[@name='org.qemu.guest_agent.0']")
+    assert len(targets) == 1
+    assert targets[0].get('type') == 'virtio'
+
+    # a channel that is already there is left alone
+    assert guest._modify_libvirt_xml_for_agent(xml) == xml
+
+def test_modify_libvirt_xml_for_package_cache(tmpdir):
+    import lxml.etree
+
+    tdl = oz.TDL.TDL(tdlxml)
+
+    config = configparser.SafeConfigParser()
+    config.readfp(BytesIO("[paths]\ndata_dir=%s\n[libvirt]\nuri=qemu:///session\nbridge_name=%s\n[customize]\npackage_cache=yes" % (str(tmpdir), route)))
+
+    guest = oz.GuestFactory.guest_factory(tdl, config, None)
+    xml = guest._modify_libvirt_xml_for_package_cache(guest._generate_xml("hd", None))
+    doc = lxml.etree.fromstring(xml)
+    filesystems = doc.xpath("/domain/devices/filesystem[target/@dir='ozpkgcache']")
+    assert len(filesystems) == 1
+    source = filesystems[0].xpath("source")[0].get('dir')
+    assert source == guest.package_cache_dir
+    assert source.startswith(os.path.join(str(tmpdir), "packagecache"))
+    assert os.path.isdir(source)
+
+    # a filesystem that is already there is left alone
+    assert guest._modify_libvirt_xml_for_package_cache(xml) == xml
+
+def test_invalid_customize_transport():
+    tdl = oz.TDL.TDL(tdlxml)
+
+    config = configparser.SafeConfigParser()
+    config.readfp(BytesIO("[libvirt]\nuri=qemu:///session\nbridge_name=%s\n[customize]\ntransport=telnet" % route))
+
+    with py.test.raises(oz.OzException.OzException):
+        oz.GuestFactory.guest_factory(tdl, config, None)
+
+def test_ssh_control_path(tmpdir):
+    tdl = oz.TDL.TDL(tdlxml)
+
+    config = configparser.SafeConfigParser()
+    config.readfp(BytesIO("[paths]\ndata_dir=%s\n[libvirt]\nuri=qemu:///session\nbridge_name=%s" % (str(tmpdir), route)))
+
+    guest = oz.GuestFactory.guest_factory(tdl, config, None)
+    assert guest.ssh_control_path.startswith(guest.icicle_tmp)
+    assert "ControlPath=" + guest.ssh_control_path in guest._ssh_options(10)
+
+    # unix socket paths are limited in length
+    deep = os.path.join(str(tmpdir), 'a' * 100)
+    config.set('paths', 'data_dir', deep)
+    guest = oz.GuestFactory.guest_factory(tdl, config, None)
+    assert len(guest.ssh_control_path) <= 100
+
+def test_offline_customize_stage_names():
+    files = """
+  <files>
+    <file name='/etc/foo'>foo</file>
+  </files>
+"""
+    commands = """
+  <commands>
+    <command name='bar'>echo bar</command>
+  </commands>
+"""
+    packages = """
+  <packages>
+    <package name='baz'/>
+  </packages>
+"""
+
+    config = configparser.SafeConfigParser()
+    config.readfp(BytesIO("[libvirt]\nuri=qemu:///session\nbridge_name=%s" % route))
+
+    # files alone, or files followed by commands, can be written offline
+    tdl = oz.TDL.TDL(tdlxml.replace("</template>", files + "</template>"))
+    guest = oz.GuestFactory.guest_factory(tdl, config, None)
+    assert guest._offline_customize_stage_names() == ["repos", "packages",
+                                                      "files", "commands"]
+
+    tdl = oz.TDL.TDL(tdlxml.replace("</template>",
+                                    files + commands + "</template>"))
+    guest = oz.GuestFactory.guest_factory(tdl, config, None)
+    assert guest._offline_customize_stage_names() == ["repos", "packages",
+                                                      "files"]
+
+    # the files come after the packages, so they have to wait for them
+    tdl = oz.TDL.TDL(tdlxml.replace("</template>",
+                                    packages + files + "</template>"))
+    guest = oz.GuestFactory.guest_factory(tdl, config, None)
+    assert guest._offline_customize_stage_names() == ["repos"]
+
+def test_icicle_cache(tmpdir):
+    tdl = oz.TDL.TDL(tdlxml)
+
+    config = configparser.SafeConfigParser()
+    config.readfp(BytesIO("[paths]\ndata_dir=%s\n[libvirt]\nuri=qemu:///session\nbridge_name=%s\n[icicle]\ncache=yes\ncache_sample=yes" % (str(tmpdir), route)))
+
+    guest = oz.GuestFactory.guest_factory(tdl, config, None)
+
+    diskimage = os.path.join(str(tmpdir), 'disk.img')
+    with open(diskimage, 'w') as f:
+        f.write('\0' * 1024 * 1024)
+    libvirt_xml = "<domain><name>tester</name><devices><disk><source file='%s'/></disk></devices></domain>" % (diskimage)
+
+    assert guest._read_icicle_cache(libvirt_xml) is None
+    guest._write_icicle_cache(libvirt_xml, '<icicle/>')
+    assert guest._read_icicle_cache(libvirt_xml) == '<icicle/>'
+
+    # a write that keeps the size and the modification time is still seen
+    st = os.stat(diskimage)
+    with open(diskimage, 'r+') as f:
+        f.seek(512 * 1024)
+        f.write('x')
+    os.utime(diskimage, (st.st_atime, st.st_mtime))
+    assert guest._read_icicle_cache(libvirt_xml) is None
+
+    guest._write_icicle_cache(libvirt_xml, '<icicle/>')
+    guest._invalidate_icicle_cache(libvirt_xml)
+    assert guest._read_icicle_cache(libvirt_xml) is None
+
+def test_running_domain_index(tmpdir):
+    tdl = oz.TDL.TDL(tdlxml)
+
+    config = configparser.SafeConfigParser()
+    config.readfp(BytesIO("[paths]\ndata_dir=%s\n[libvirt]\nuri=qemu:///session\nbridge_name=%s" % (str(tmpdir), route)))
+
+    guest = oz.GuestFactory.guest_factory(tdl, config, None)
+
+    class FakeDomain(object):
+        def __init__(self, domid, name):
+            self.domid = domid
+            self.name = name
+            self.xmldescs = 0
+
+        def ID(self):
+            return self.domid
+
+        def UUIDString(self):
+            return "5ea2a9ec-3f9b-4a3c-a4b0-5a4c9f0e1d%02d" % (self.domid)
+
+        def XMLDesc(self, flags):
+            self.xmldescs += 1
+            return "<domain><name>%s</name><devices><disk><source file='/var/lib/libvirt/images/%s.dsk'/></disk><disk><source dev='/dev/sdb'/></disk></devices></domain>" % (self.name, self.name)
+
+    class FakeConnection(object):
+        def __init__(self, domains):
+            self.domains = domains
+
+        def listAllDomains(self, flags):
+            return self.domains
+
+    dom1 = FakeDomain(1, 'one')
+    dom2 = FakeDomain(2, 'two')
+    guest.libvirt_conn = FakeConnection([dom1, dom2])
+
+    names, disks = guest._running_domain_index()
+    assert names == set(['one', 'two'])
+    assert disks == {'/var/lib/libvirt/images/one.dsk':'one',
+                     '/var/lib/libvirt/images/two.dsk':'two'}
+
+    # the XML of a domain is only looked at the first time it is seen
+    guest.libvirt_conn = FakeConnection([dom2, FakeDomain(3, 'three')])
+    names, disks = guest._running_domain_index()
+    assert names == set(['two', 'three'])
+    assert dom2.xmldescs == 1
+
+def test_lock_disk(tmpdir):
+    tdl = oz.TDL.TDL(tdlxml)
+
+    config = configparser.SafeConfigParser()
+    config.readfp(BytesIO("[paths]\ndata_dir=%s\n[libvirt]\nuri=qemu:///session\nbridge_name=%s" % (str(tmpdir), route)))
+
+    guest = oz.GuestFactory.guest_factory(tdl, config, None)
+    diskimage = os.path.join(str(tmpdir), 'disk.img')
+
+    def lock_in_child(shared):
+        # locks are per process, so try to take it from another one
+        pid = os.fork()
+        if pid == 0:
+            try:
+                guest._lock_disk(diskimage, shared)
+            except oz.OzException.OzException:
+                os._exit(1)
+            os._exit(0)
+        return os.waitpid(pid, 0)[1] == 0
+
+    lock = guest._lock_disk(diskimage, True)
+    assert lock_in_child(True)
+    assert not lock_in_child(False)
+    os.close(lock)
+
+    lock = guest._lock_disk(diskimage, False)
+    assert not lock_in_child(True)
+    os.close(lock)
+    assert lock_in_child(False)
+
+def test_domain_lifecycle_events():
+    import libvirt
+    import oz.Guest
+
+    class FakeDomain(object):
+        def UUIDString(self):
+            return "5ea2a9ec-3f9b-4a3c-a4b0-5a4c9f0e1d2b"
+
+    dom = FakeDomain()
+    stop_event = oz.Guest._get_domain_stop_event(dom.UUIDString())
+
+    oz.Guest._domain_lifecycle_callback(None, dom,
+                                        libvirt.VIR_DOMAIN_EVENT_STARTED, 0,
+                                        None)
+    assert not stop_event.is_set()
+
+    oz.Guest._domain_lifecycle_callback(None, dom,
+                                        libvirt.VIR_DOMAIN_EVENT_STOPPED, 0,
+                                        None)
+    assert stop_event.is_set()
+
+    # once the stop has been seen, the event is dropped
+    oz.Guest._forget_domain_stop_event(dom.UUIDString(), True)
+    assert dom.UUIDString() not in oz.Guest._domain_stop_events
@@ -0,0 +1,157 @@
+#!/usr/bin/python
+
+import sys
+import os
+
+try:
+    import py.test
+except ImportError:
+    print('Unable to import py.test.  Is py.test installed?')
+    sys.exit(1)
+
+# Find oz
+prefix = '.'
+for i in range(0,3):
+    if os.path.isdir(os.path.join(prefix, 'oz')):
+        sys.path.insert(0, prefix)
+        break
+    else:
+        prefix = '../' + prefix
+
+try:
+    import oz.GuestfsPool
+except ImportError:
+    print('Unable to import oz.  Is oz installed?')
+    sys.exit(1)
+
+class FakeGuestFS(object):
+    # records what the pool does with a handle, without an appliance
+    def __init__(self, hotplug=True, discard=True):
+        self.hotplug = hotplug
+        self.discard = discard
+        self.bad_discard = False
+        self.launched = False
+        self.closed = False
+        self.labels = {}
+
+    def add_drive_opts(self, filename, format, readonly, label, discard=None):
+        if self.launched and not self.hotplug:
+            raise RuntimeError("hot-adding drives is not supported")
+        if discard is not None and not self.discard:
+            # like libguestfs, only notice this when the drive is opened
+            if self.launched:
+                raise RuntimeError("discard cannot be enabled on this drive")
+            self.bad_discard = True
+        self.labels[label] = "/dev/sd%s" % ("abcdefgh"[len(self.labels)])
+
+    def launch(self):
+        if self.bad_discard:
+            raise RuntimeError("discard cannot be enabled on this drive")
+        self.launched = True
+
+    def list_disk_labels(self):
+        return self.labels
+
+    def vgscan(self):
+        pass
+
+    def vg_activate_all(self, activate):
+        pass
+
+    def umount_all(self):
+        pass
+
+    def remove_drive(self, label):
+        if not self.hotplug:
+            raise RuntimeError("hot-removing drives is not supported")
+        del self.labels[label]
+
+    def close(self):
+        self.closed = True
+
+def make_pool(monkeypatch, size, hotplug=True, discard=True):
+    handles = []
+    def _guestfs():
+        handles.append(FakeGuestFS(hotplug, discard))
+        return handles[-1]
+    monkeypatch.setattr(oz.GuestfsPool.guestfs, 'GuestFS', _guestfs)
+    return oz.GuestfsPool.GuestfsPool(size), handles
+
+def test_pool_reuse(monkeypatch):
+    pool, handles = make_pool(monkeypatch, 1)
+
+    g_handle, device = pool.lease('/tmp/disk1.img', 'raw')
+    assert device == '/dev/sda'
+    pool.release(g_handle)
+    assert not g_handle.closed
+
+    # the second lease hot-plugs into the same appliance
+    g_handle2, device = pool.lease('/tmp/disk2.img', 'qcow2')
+    assert g_handle2 is g_handle
+    assert device == '/dev/sda'
+    assert len(handles) == 1
+    pool.release(g_handle2)
+
+    pool.close()
+    assert g_handle.closed
+
+def test_pool_full(monkeypatch):
+    pool, handles = make_pool(monkeypatch, 1)
+
+    g_handle1 = pool.lease('/tmp/disk1.img', 'raw')[0]
+    g_handle2 = pool.lease('/tmp/disk2.img', 'raw')[0]
+    assert g_handle1 is not g_handle2
+    pool.release(g_handle1)
+    pool.release(g_handle2)
+    assert not g_handle1.closed
+    assert g_handle2.closed
+
+def test_pool_size_zero(monkeypatch):
+    pool, handles = make_pool(monkeypatch, 0)
+
+    g_handle = pool.lease('/tmp/disk1.img', 'raw')[0]
+    pool.release(g_handle)
+    assert g_handle.closed
+
+def test_pool_no_hotplug(monkeypatch):
+    pool, handles = make_pool(monkeypatch, 1, hotplug=False)
+
+    g_handle = pool.lease('/tmp/disk1.img', 'raw')[0]
+    pool.release(g_handle)
+    assert g_handle.closed
+    assert not pool.hotplug
+
+    g_handle = pool.lease('/tmp/disk2.img', 'raw')[0]
+    assert g_handle.launched
+    assert len(handles) == 2
+    pool.release(g_handle)
+    assert g_handle.closed
+
+def test_pool_discard(monkeypatch):
+    pool, handles = make_pool(monkeypatch, 1)
+
+    g_handle = pool.lease('/tmp/disk1.img', 'raw', discard=True)[0]
+    assert pool.discard_enabled(g_handle)
+    pool.release(g_handle)
+
+    g_handle = pool.lease('/tmp/disk2.img', 'raw')[0]
+    assert not pool.discard_enabled(g_handle)
+    pool.release(g_handle)
+
+def test_pool_no_discard(monkeypatch):
+    pool, handles = make_pool(monkeypatch, 1, discard=False)
+
+    # the disk image is still added, just without discard; a new appliance
+    # finds out at launch, a running one when the drive is hot-plugged
+    g_handle, device = pool.lease('/tmp/disk1.img', 'raw', discard=True)
+    assert device == '/dev/sda'
+    assert not pool.discard_enabled(g_handle)
+    assert len(handles) == 2
+    assert handles[0].closed
+    pool.release(g_handle)
+
+    g_handle2, device = pool.lease('/tmp/disk2.img', 'raw', discard=True)
+    assert g_handle2 is g_handle
+    assert device == '/dev/sda'
+    assert not pool.discard_enabled(g_handle2)
+    pool.release(g_handle2)
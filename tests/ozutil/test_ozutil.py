@@ -446,3 +446,185 @@ def test_md5sum_regular_no_space(tmpdir):
     f.close()
 
     oz.ozutil.get_md5sum_from_file(src, 'Fedora-11-i386-DVD.iso')
+
+# test oz.ozutil.subprocess_run
+def test_subprocess_run():
+    lines = []
+    result = oz.ozutil.subprocess_run(['/bin/sh', '-c',
+                                       'echo one; echo two >&2; printf three'],
+                                      printfn=lines.append)
+    assert result.stdout == 'one\nthree'
+    assert result.stderr == 'two\n'
+    assert result.retcode == 0
+    assert sorted(lines) == ['one', 'three', 'two']
+
+def test_subprocess_run_spill():
+    result = oz.ozutil.subprocess_run(['/bin/sh', '-c', 'seq 1 10000'],
+                                      max_capture=1024)
+    assert result.stdout.split() == [str(i) for i in range(1, 10001)]
+
+def test_subprocess_run_failure():
+    with py.test.raises(oz.ozutil.SubprocessException):
+        oz.ozutil.subprocess_run(['/bin/false'])
+    assert oz.ozutil.subprocess_run(['/bin/false'], check=False).retcode == 1
+
+def test_subprocess_run_timeout():
+    with py.test.raises(oz.ozutil.SubprocessException):
+        oz.ozutil.subprocess_run(['/bin/sleep', '10'], timeout=0.2)
+
+# test oz.ozutil.parse_mirrorlist
+def test_parse_mirrorlist():
+    mirrorlist = b"""# repo = fedora-install-20 arch = x86_64 country = US
+http://mirror1.example.com/fedora/releases/20/Fedora/x86_64/os/
+rsync://mirror2.example.com/fedora/releases/20/Fedora/x86_64/os/
+
+ftp://mirror3.example.com/fedora/releases/20/Fedora/x86_64/os/
+"""
+    assert oz.ozutil.parse_mirrorlist(mirrorlist) == \
+        ["http://mirror1.example.com/fedora/releases/20/Fedora/x86_64/os/",
+         "ftp://mirror3.example.com/fedora/releases/20/Fedora/x86_64/os/"]
+
+def test_parse_mirrorlist_metalink():
+    metalink = b"""<?xml version="1.0" encoding="utf-8"?>
+<metalink version="3.0" xmlns="http://www.metalinker.org/">
+ <files>
+  <file name="repomd.xml">
+   <resources maxconnections="1">
+    <url protocol="https" type="https" location="US" preference="100">https://mirror1.example.com/fedora/updates/20/x86_64/repodata/repomd.xml</url>
+    <url protocol="rsync" type="rsync" location="US" preference="99">rsync://mirror2.example.com/fedora/updates/20/x86_64/repodata/repomd.xml</url>
+   </resources>
+  </file>
+ </files>
+</metalink>
+"""
+    assert oz.ozutil.parse_mirrorlist(metalink) == \
+        ["https://mirror1.example.com/fedora/updates/20/x86_64/"]
+
+# test oz.ozutil.parse_metalink
+def test_parse_metalink():
+    metalink = b"""<?xml version="1.0" encoding="UTF-8"?>
+<metalink xmlns="urn:ietf:params:xml:ns:metalink">
+ <file name="CHECKSUM">
+  <size>1024</size>
+ </file>
+ <file name="Fedora-20-x86_64-DVD.iso">
+  <size>4614782976</size>
+  <hash type="md5">0123456789abcdef0123456789abcdef</hash>
+  <hash type="sha-256">F2EEED5102B8890E9E6F4B9053717FE73031E699C4B76DC7028749AB66E7F917</hash>
+  <pieces length="262144" type="sha-1">
+   <hash>a9993e364706816aba3e25717850c26c9cd0d89d</hash>
+   <hash>84983e441c3bd26ebaae4aa1f95129e5e54670f1</hash>
+  </pieces>
+  <url location="de">ftp://mirror2.example.com/fedora/Fedora-20-x86_64-DVD.iso</url>
+  <url location="us" priority="2">http://mirror1.example.com/fedora/Fedora-20-x86_64-DVD.iso</url>
+  <url priority="1">https://mirror3.example.com/fedora/Fedora-20-x86_64-DVD.iso</url>
+  <url priority="1">rsync://mirror4.example.com/fedora/Fedora-20-x86_64-DVD.iso</url>
+ </file>
+</metalink>
+"""
+    parsed = oz.ozutil.parse_metalink(metalink, 'Fedora-20-x86_64-DVD.iso')
+    assert parsed['size'] == 4614782976
+    assert parsed['hash'] == ('sha256', 'f2eeed5102b8890e9e6f4b9053717fe73031e699c4b76dc7028749ab66e7f917')
+    assert parsed['pieces'] == ('sha1', 262144,
+                                ['a9993e364706816aba3e25717850c26c9cd0d89d',
+                                 '84983e441c3bd26ebaae4aa1f95129e5e54670f1'])
+    assert parsed['urls'] == \
+        ["https://mirror3.example.com/fedora/Fedora-20-x86_64-DVD.iso",
+         "http://mirror1.example.com/fedora/Fedora-20-x86_64-DVD.iso",
+         "ftp://mirror2.example.com/fedora/Fedora-20-x86_64-DVD.iso"]
+
+def test_parse_metalink_unknown_file():
+    metalink = b"""<?xml version="1.0" encoding="UTF-8"?>
+<metalink xmlns="urn:ietf:params:xml:ns:metalink">
+ <file name="a.iso"><size>1</size></file>
+ <file name="b.iso"><size>2</size></file>
+</metalink>
+"""
+    with py.test.raises(Exception):
+        oz.ozutil.parse_metalink(metalink, 'c.iso')
+
+# test oz.ozutil.find_bad_pieces
+def test_find_bad_pieces(tmpdir):
+    src = os.path.join(str(tmpdir), 'src')
+    open(src, 'w').write('abcxyzab')
+    fd = os.open(src, os.O_RDONLY)
+    try:
+        # sha1 of 'abc', 'abc' and 'ab'; the second piece does not match
+        piece_hashes = ['a9993e364706816aba3e25717850c26c9cd0d89d',
+                        'a9993e364706816aba3e25717850c26c9cd0d89d',
+                        'da23614e02469a0d7c7bd1bdab5c9c474b1904dc']
+        assert oz.ozutil.find_bad_pieces(fd, 8, 3, piece_hashes, 'sha1') == [1]
+    finally:
+        os.close(fd)
+
+# test oz.ozutil.dpkg_get_selections
+def test_dpkg_get_selections():
+    status = """Package: libc6
+Status: install ok installed
+Architecture: amd64
+Multi-Arch: same
+Description: GNU C Library
+ the continuation: of the description
+
+Package: dpkg
+Status: install ok installed
+Architecture: amd64
+
+Package: removed
+Status: deinstall ok config-files
+Architecture: amd64
+
+Package: gone
+Status: purge ok not-installed
+Architecture: amd64
+
+Package: a-package-with-a-very-long-name-indeed-yes-really
+Status: hold ok installed
+Architecture: all
+
+Package: foreign
+Status: install ok installed
+Architecture: i386
+"""
+    assert oz.ozutil.dpkg_get_selections(status) == \
+        "a-package-with-a-very-long-name-indeed-yes-really\thold\n" \
+        "dpkg\t\t\t\t\t\tinstall\n" \
+        "foreign:i386\t\t\t\t\tinstall\n" \
+        "libc6:amd64\t\t\t\t\tinstall\n" \
+        "removed\t\t\t\t\t\tdeinstall\n"
+
+# test oz.ozutil.subprocess_check_output_many
+def test_subprocess_many():
+    results = oz.ozutil.subprocess_check_output_many([['/bin/echo', 'one'],
+                                                      ['/bin/echo', 'two']])
+    assert results[0][0] == 'one\n'
+    assert results[1][0] == 'two\n'
+
+def test_subprocess_many_failure():
+    with py.test.raises(oz.ozutil.SubprocessException):
+        oz.ozutil.subprocess_check_output_many([['/bin/true'],
+                                                ['/bin/false']])
+
+# test oz.ozutil.sha256_file
+def test_sha256_file(tmpdir):
+    src = os.path.join(str(tmpdir), 'src')
+    open(src, 'w').write('abc')
+    assert oz.ozutil.sha256_file(src) == 'ba7816bf8f01cfea414140de5dae2223b00361a396177a9cb410ff61f20015ad'
+
+# test oz.ozutil.get_meminfo
+def test_get_meminfo(tmpdir):
+    meminfo = os.path.join(str(tmpdir), 'meminfo')
+    open(meminfo, 'w').write("MemTotal:        8052604 kB\nMemAvailable:    5321984 kB\nHugePages_Free:        0\nHugepagesize:       2048 kB\n")
+    info = oz.ozutil.get_meminfo(meminfo)
+    assert info['MemAvailable'] == 5321984
+    assert info['HugePages_Free'] == 0
+    assert info['Hugepagesize'] == 2048
+
+def test_percentile():
+    assert oz.ozutil.percentile([3, 1, 2], 99) == 3
+    assert oz.ozutil.percentile([3, 1, 2], 50) == 2
+    assert oz.ozutil.percentile(list(range(1, 201)), 99) == 198
+
+def test_percentile_empty():
+    with py.test.raises(Exception):
+        oz.ozutil.percentile([], 99)
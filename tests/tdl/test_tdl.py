@@ -90,6 +90,10 @@ tests = {
     "test-53-command-http-url.tdl": True,
     "test-54-files-file-url.tdl": True,
     "test-55-files-http-url.tdl": True,
+    "test-56-url-mirrors.tdl": True,
+    "test-57-iso-mirror.tdl": False,
+    "test-58-metalink.tdl": True,
+    "test-59-metalink-and-sha256sum.tdl": False,
 }
 
 # Validate oz handling of tdl file
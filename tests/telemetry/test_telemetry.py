@@ -0,0 +1,95 @@
+#!/usr/bin/python
+
+import sys
+import os
+import json
+
+try:
+    import py.test
+except ImportError:
+    print('Unable to import py.test.  Is py.test installed?')
+    sys.exit(1)
+
+# Find oz
+prefix = '.'
+for i in range(0,3):
+    if os.path.isdir(os.path.join(prefix, 'oz')):
+        sys.path.insert(0, prefix)
+        break
+    else:
+        prefix = '../' + prefix
+
+try:
+    import oz.Telemetry
+    import oz.OzException
+except ImportError:
+    print('Unable to import oz.  Is oz installed?')
+    sys.exit(1)
+
+def sample(t, disk_req, net_bytes, wr_bytes=0):
+    return {'type':'sample', 'phase':1, 'time':t, 'rd_req':0,
+            'rd_bytes':0, 'wr_req':disk_req, 'wr_bytes':wr_bytes,
+            'rx_bytes':net_bytes, 'tx_bytes':0, 'cpu_time':t * 1000000000}
+
+def write_records(filename, records):
+    f = open(filename, 'w')
+    for record in records:
+        f.write(json.dumps(record) + "\n")
+    f.close()
+
+def test_recorder(tmpdir):
+    filename = os.path.join(str(tmpdir), 'image.dsk.telemetry')
+    # a new recorder starts a new file
+    write_records(filename, [{'type':'phase', 'phase':1, 'name':'old',
+                              'time':0}])
+
+    recorder = oz.Telemetry.Recorder(filename)
+    stats = sample(0, 1, 2)
+    recorder.start_phase("install")
+    recorder.sample(stats)
+    recorder.end_phase("finished")
+    recorder.start_phase("install")
+    recorder.sample(stats)
+
+    phases = oz.Telemetry.read_phases(filename)
+    assert(len(phases) == 2)
+    assert(phases[0]['phase'] == 1)
+    assert(phases[0]['name'] == "install")
+    assert(phases[0]['result'] == "finished")
+    assert(len(phases[0]['samples']) == 1)
+    assert(phases[0]['samples'][0]['wr_req'] == 1)
+    assert(phases[1]['phase'] == 2)
+    assert(phases[1]['result'] is None)
+
+def test_summarize_phase(tmpdir):
+    filename = os.path.join(str(tmpdir), 'image.dsk.telemetry')
+    records = [{'type':'phase', 'phase':1, 'name':'install', 'time':100}]
+    # busy for 20 seconds, idle for 60, then busy again
+    records.append(sample(100, 0, 0))
+    records.append(sample(110, 10, 0, 10*1024*1024))
+    records.append(sample(120, 20, 100000, 10*1024*1024))
+    for t in range(130, 190, 10):
+        records.append(sample(t, 20, 100000 + t, 10*1024*1024))
+    records.append(sample(190, 30, 200000, 20*1024*1024))
+    records.append({'type':'end', 'phase':1, 'result':'finished',
+                    'time':195})
+    write_records(filename, records)
+
+    summary = oz.Telemetry.summarize_phase(oz.Telemetry.read_phases(filename)[0])
+    assert(summary['duration'] == 95)
+    assert(summary['totals']['wr_req'] == 30)
+    assert(summary['totals']['wr_bytes'] == 20*1024*1024)
+    assert(summary['totals']['cpu_time'] == 90 * 1000000000)
+    assert(summary['peaks']['wr_bytes'] == 1024*1024)
+    assert(summary['peaks']['rx_bytes'] == 10000)
+    assert(summary['idle_gaps'] == [(20, 60)])
+
+    # shorter gaps are not reported
+    summary = oz.Telemetry.summarize_phase(oz.Telemetry.read_phases(filename)[0], 90)
+    assert(summary['idle_gaps'] == [])
+
+def test_read_phases_invalid(tmpdir):
+    filename = os.path.join(str(tmpdir), 'image.dsk.telemetry')
+    write_records(filename, [sample(0, 0, 0)])
+    with py.test.raises(oz.OzException.OzException):
+        oz.Telemetry.read_phases(filename)